@@ -0,0 +1,8 @@
+"""Load generation and benchmarks for the chat server.
+
+Run with ``python -m bench --help``. The benchmark starts server.py in a
+temporary directory (or connects to a running server), connects many
+headless protocol clients from a single asyncio event loop, and drives
+chat bursts, GET_FILE_LIST polling and file transfers against it. The
+measurements are printed and saved as JSON so runs can be compared.
+"""
@@ -0,0 +1,124 @@
+"""python -m bench: run the load benchmark and save the results as JSON"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+from datetime import datetime
+
+from bench.local_server import LocalServer
+from bench.scenario import Benchmark
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+SIZE_SUFFIXES = {"k": 1024, "m": 1024 ** 2, "g": 1024 ** 3}
+
+
+def parse_size(text):
+    """Byte count such as 65536, 512k or 10M"""
+    text = text.strip().lower().rstrip("b")
+    multiplier = SIZE_SUFFIXES.get(text[-1:], 1)
+    if multiplier != 1:
+        text = text[:-1]
+    return int(float(text) * multiplier)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m bench", description="Load benchmark for the chat server")
+    target = parser.add_argument_group("server")
+    target.add_argument("--connect", metavar="HOST:PORT", help="benchmark a running server instead of starting one")
+    target.add_argument("--mode", choices=("threaded", "asyncio"), default="threaded", help="server.mode of the started server")
+    target.add_argument("--workers", type=int, default=1, help="server.workers of the started server")
+    target.add_argument("--password", default="", help="server password")
+    target.add_argument("--keep-server-dir", action="store_true", help="keep the started server's directory and log")
+    load = parser.add_argument_group("load")
+    load.add_argument("--users", type=int, default=200, help="simulated chat users")
+    load.add_argument("--connect-concurrency", type=int, default=100, help="handshakes in flight at once")
+    load.add_argument("--duration", type=float, default=10.0, help="seconds of chat, polling and transfers")
+    load.add_argument("--drain", type=float, default=2.0, help="seconds to wait for chat still in flight")
+    load.add_argument("--senders", type=int, default=20, help="users that send chat")
+    load.add_argument("--chat-rate", type=float, default=2.0, help="chat lines per second per sender")
+    load.add_argument("--burst", type=int, default=1, help="lines each sender sends back to back")
+    load.add_argument("--channels", type=int, default=0, help="spread the users over this many channels (0: all in the default one)")
+    load.add_argument("--pollers", type=int, default=10, help="users that poll GET_FILE_LIST")
+    load.add_argument("--poll-interval", type=float, default=1.0, help="seconds between a poller's requests")
+    load.add_argument("--uploads", type=int, default=2, help="connections uploading in a loop")
+    load.add_argument("--downloads", type=int, default=2, help="connections downloading in a loop")
+    load.add_argument("--file-size", type=parse_size, default=parse_size("1M"), help="size of the transferred file, e.g. 512k or 10M")
+    load.add_argument("--rss-interval", type=float, default=0.5, help="seconds between server memory samples")
+    parser.add_argument("--output", help="results file (default: bench-<time>.json)")
+    options = parser.parse_args(argv)
+    options.senders = min(options.senders, options.users)
+    return options
+
+
+def raise_open_file_limit():
+    """Thousands of users need thousands of descriptors here and in the started server"""
+    if resource is None:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY or soft < hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ValueError, OSError):
+            pass
+
+
+def megabytes(value):
+    return f"{value / 1024 ** 2:.1f} MiB" if value else "n/a"
+
+
+def print_results(results):
+    join, chat = results["join"], results["chat"]
+    fanout = chat["fanout_latency"]
+    print(f"Join: {join['joined']}/{join['requested']} in {join['seconds']:.2f}s, "
+          f"p50 {join['latency'].get('p50_ms', 0):.1f}ms p99 {join['latency'].get('p99_ms', 0):.1f}ms")
+    print(f"Chat: {chat['sent_per_s']:.1f} sent/s, {chat['delivered_per_s']:.1f} delivered/s, "
+          f"fan-out p50 {fanout.get('p50_ms', 0):.1f}ms p99 {fanout.get('p99_ms', 0):.1f}ms")
+    if chat["delivery_ratio"] is not None:
+        print(f"      {chat['delivery_ratio'] * 100:.1f}% of {chat['expected']} copies of {chat['sent']} lines delivered")
+    listing = results["file_list"]
+    if listing["count"]:
+        print(f"File list: {listing['count']} requests, p50 {listing['p50_ms']:.1f}ms p99 {listing['p99_ms']:.1f}ms")
+    for kind in ("uploads", "downloads"):
+        transfers = results[kind]
+        if transfers["count"]:
+            rate = transfers["mb_per_s"]
+            print(f"{kind.capitalize()}: {transfers['count']} at {rate:.1f} MB/s" if rate else f"{kind.capitalize()}: {transfers['count']}")
+    rss = results["server_rss"]
+    print(f"Server RSS: idle {megabytes(rss['idle_bytes'])}, joined {megabytes(rss['joined_bytes'])}, "
+          f"peak {megabytes(rss['peak_bytes'])}")
+    if results["errors"]:
+        print(f"Errors: {results['errors']}")
+
+
+def main(argv=None):
+    options = parse_args(argv)
+    raise_open_file_limit()
+    local = None
+    if options.connect:
+        host, _, port = options.connect.rpartition(":")
+        host, port, rss = host or "127.0.0.1", int(port), None
+    else:
+        local = LocalServer(options.mode, options.workers, options.password).start()
+        host, port, rss = "127.0.0.1", local.port, local.rss_bytes
+        print(f"Started server.py ({options.mode}, {options.workers} worker(s)) in {local.directory}")
+    try:
+        results = asyncio.run(Benchmark(options, host, port, rss).run())
+    finally:
+        if local:
+            local.stop(keep_directory=options.keep_server_dir)
+    results["server"] = {"host": host, "port": port, "started": local is not None}
+    print_results(results)
+    output = options.output or f"bench-{datetime.now():%Y%m%d_%H%M%S}.json"
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results saved to {os.path.abspath(output)}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,141 @@
+"""Start server.py in a scratch directory and watch its memory use"""
+import ast
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVER_SCRIPT = os.path.join(REPO_DIR, "server.py")
+READY_MARKER = "Server is listening"
+
+
+def default_config():
+    """DEFAULT_CONFIG from server.py, read without importing (importing starts a server)"""
+    with open(SERVER_SCRIPT, "r", encoding="utf-8") as f:
+        tree = ast.parse(f.read(), SERVER_SCRIPT)
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and any(
+            isinstance(target, ast.Name) and target.id == "DEFAULT_CONFIG" for target in node.targets
+        ):
+            return ast.literal_eval(node.value)
+    raise RuntimeError("DEFAULT_CONFIG not found in server.py")
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+
+class LocalServer:
+    """server.py running with its own server_config.json, uploads and history"""
+
+    def __init__(self, mode="threaded", workers=1, password="", port=None, extra_config=None):
+        self.mode = mode
+        self.workers = workers
+        self.password = password
+        self.port = port or free_port()
+        self.extra_config = extra_config or {}
+        self.directory = None
+        self.process = None
+        self.log_path = None
+
+    def write_config(self):
+        config = default_config()
+        config["server"].update(
+            host="127.0.0.1",
+            port=self.port,
+            password=self.password,
+            interactive_password_setup=False,
+            mode=self.mode,
+            workers=self.workers,
+        )
+        for section, values in self.extra_config.items():
+            config.setdefault(section, {}).update(values)
+        with open(os.path.join(self.directory, "server_config.json"), "w", encoding="utf-8") as f:
+            json.dump(config, f, indent=4)
+
+    def start(self, timeout=30):
+        self.directory = tempfile.mkdtemp(prefix="chat_bench_")
+        self.write_config()
+        self.log_path = os.path.join(self.directory, "server.log")
+        with open(self.log_path, "wb") as log:
+            self.process = subprocess.Popen(
+                [sys.executable, "-u", SERVER_SCRIPT],
+                cwd=self.directory,
+                stdin=subprocess.DEVNULL,
+                stdout=log,
+                stderr=subprocess.STDOUT,
+            )
+        # Every worker prints the marker once its socket is bound
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"server exited during startup, see {self.log_path}")
+            with open(self.log_path, "r", encoding="utf-8", errors="replace") as log:
+                if log.read().count(READY_MARKER) >= self.workers:
+                    return self
+            time.sleep(0.1)
+        self.stop()
+        raise RuntimeError(f"server did not start within {timeout}s, see {self.log_path}")
+
+    def rss_bytes(self):
+        """Resident memory of the server and its worker processes, None without /proc"""
+        if self.process is None or self.process.poll() is not None:
+            return None
+        return process_tree_rss(self.process.pid)
+
+    def stop(self, keep_directory=False):
+        if self.process and self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+        if self.directory and not keep_directory:
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def _read_rss(pid):
+    with open(f"/proc/{pid}/status", "r", encoding="ascii", errors="replace") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def _children(pid):
+    children = []
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat", "r", encoding="ascii", errors="replace") as f:
+                # The command name may contain spaces, the fields after it do not
+                fields = f.read().rsplit(")", 1)[1].split()
+        except (OSError, IndexError):
+            continue
+        if int(fields[1]) == pid:
+            children.append(int(entry))
+    return children
+
+
+def process_tree_rss(pid):
+    if not os.path.isdir("/proc"):
+        return None
+    try:
+        total = _read_rss(pid)
+    except OSError:
+        return None
+    for child in _children(pid):
+        try:
+            total += _read_rss(child)
+        except OSError:
+            pass
+    return total
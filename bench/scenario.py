@@ -0,0 +1,284 @@
+"""The benchmark run: join, then chat, poll and transfer for a fixed time.
+
+All simulated users live in one asyncio event loop. Chat lines carry the
+send time, so every copy the server fans out gives a broadcast latency
+sample. With --channels the users are spread over that many channels and
+each sender talks in its own, so a line only reaches its channel. Receive times include any delay in the benchmark's own loop, so
+keep an eye on its CPU use when pushing thousands of users.
+"""
+import asyncio
+import os
+import shutil
+import tempfile
+import time
+from collections import Counter
+from datetime import datetime
+
+from chat_client import AsyncChatClient, ClientError
+from protocol import DEFAULT_CHANNEL
+
+BENCH_MARKER = " BENCH "
+
+
+def summarize(samples):
+    """count, mean, p50, p99 and max of latency samples, in milliseconds"""
+    if not samples:
+        return {"count": 0}
+    ordered = sorted(samples)
+
+    def percentile(p):
+        return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))] * 1000
+
+    return {
+        "count": len(ordered),
+        "mean_ms": sum(ordered) / len(ordered) * 1000,
+        "p50_ms": percentile(50),
+        "p99_ms": percentile(99),
+        "max_ms": ordered[-1] * 1000,
+    }
+
+
+def throughput(transfers):
+    """Aggregate MB/s over the span of (start, end, bytes) transfers"""
+    if not transfers:
+        return {"count": 0}
+    total = sum(size for _, _, size in transfers)
+    span = max(end for _, end, _ in transfers) - min(start for start, _, _ in transfers)
+    return {
+        "count": len(transfers),
+        "bytes": total,
+        "mb_per_s": total / span / 1e6 if span > 0 else None,
+        "latency": summarize([end - start for start, end, _ in transfers]),
+    }
+
+
+class Benchmark:
+    def __init__(self, options, host, port, rss=None):
+        self.options = options
+        self.host = host
+        self.port = port
+        self.rss = rss  # Callable returning the server's RSS in bytes, or None
+        self.clients = []
+        self.join_latencies = []
+        self.fanout_latencies = []
+        self.list_latencies = []
+        self.uploads = []
+        self.downloads = []
+        self.rss_samples = []
+        self.errors = Counter()
+        self.sent = 0
+        self.sent_by_channel = Counter()
+        self.members = Counter()  # Users joined per channel, default channel excluded
+        self.delivered = 0
+        self.running = False
+        self.directory = None  # Files uploaded and downloaded by the benchmark
+
+    def on_chat(self, message):
+        position = message.find(BENCH_MARKER)
+        if position < 0:
+            return  # Join notices, upload announcements and other users' chat
+        try:
+            sent_ns = int(message[position + len(BENCH_MARKER):].split()[1])
+        except (IndexError, ValueError):
+            return
+        self.delivered += 1
+        self.fanout_latencies.append((time.perf_counter_ns() - sent_ns) / 1e9)
+
+    def on_channel_chat(self, channel, message):
+        self.on_chat(message)
+
+    def channel_for(self, index):
+        """Channel of the user at index, the default one without --channels"""
+        if not self.options.channels:
+            return DEFAULT_CHANNEL
+        return f"bench-{index % self.options.channels}"
+
+    def error(self, kind, exc):
+        self.errors[f"{kind}: {type(exc).__name__}"] += 1
+
+    async def join(self, nickname, slots, channel=DEFAULT_CHANNEL):
+        async with slots:
+            client = AsyncChatClient(
+                self.host,
+                self.port,
+                nickname,
+                self.options.password,
+                on_chat=self.on_chat,
+                on_channel_chat=self.on_channel_chat,
+            )
+            started = time.perf_counter()
+            try:
+                await client.connect()
+                self.join_latencies.append(time.perf_counter() - started)
+                if channel != DEFAULT_CHANNEL:
+                    await client.join(channel)
+                    self.members[channel] += 1
+            except (ClientError, ConnectionError, OSError, asyncio.TimeoutError) as e:
+                self.error("join", e)
+                await client.close()
+                return None
+            return client
+
+    async def join_all(self, prefix, count, channels=False):
+        slots = asyncio.Semaphore(self.options.connect_concurrency)
+        clients = await asyncio.gather(
+            *(
+                self.join(f"{prefix}{i}", slots, self.channel_for(i) if channels else DEFAULT_CHANNEL)
+                for i in range(count)
+            )
+        )
+        joined = [client for client in clients if client is not None]
+        self.clients.extend(joined)
+        return joined
+
+    async def chat(self, client, index):
+        interval = self.options.burst / self.options.chat_rate
+        channel = self.channel_for(index)
+        sequence = 0
+        # Spread the senders over one interval so the bursts do not all line up
+        await asyncio.sleep(interval * index / max(1, self.options.senders))
+        while self.running and not client.closed:
+            for _ in range(self.options.burst):
+                text = f"{BENCH_MARKER.strip()} {sequence} {time.perf_counter_ns()}"
+                try:
+                    await client.send_chat(text, channel)
+                except (ClientError, ConnectionError, OSError) as e:
+                    self.error("chat", e)
+                    return
+                self.sent += 1
+                self.sent_by_channel[channel] += 1
+                sequence += 1
+            await asyncio.sleep(interval)
+
+    async def poll(self, client):
+        while self.running and not client.closed:
+            started = time.perf_counter()
+            try:
+                await client.list_files()
+            except (ClientError, ConnectionError, OSError) as e:
+                self.error("file_list", e)
+                return
+            self.list_latencies.append(time.perf_counter() - started)
+            await asyncio.sleep(self.options.poll_interval)
+
+    def write_file(self, name):
+        """A file of --file-size random bytes; each uploader gets its own content"""
+        path = os.path.join(self.directory, name)
+        with open(path, "wb") as f:
+            f.write(os.urandom(self.options.file_size))
+        return path
+
+    async def upload_loop(self, client, index):
+        path = self.write_file(f"bench-upload-{index}.bin")
+        while self.running and not client.closed:
+            started = time.perf_counter()
+            try:
+                upload = await client.upload(path)
+            except (ClientError, ConnectionError, OSError) as e:
+                self.error("upload", e)
+                return
+            self.uploads.append((started, time.perf_counter(), upload.size))
+
+    async def download_loop(self, client, file_info, index):
+        path = os.path.join(self.directory, f"bench-download-{index}.bin")
+        while self.running and not client.closed:
+            started = time.perf_counter()
+            try:
+                downloaded = await client.download(file_info, path)
+            except (ClientError, ConnectionError, OSError) as e:
+                self.error("download", e)
+                return
+            self.downloads.append((started, time.perf_counter(), downloaded["size"]))
+
+    async def seed_download(self, client):
+        """Upload the file the downloaders fetch and return its FILE_LIST entry"""
+        upload = await client.upload(self.write_file(f"bench-seed-{os.getpid()}.bin"))
+        files = await client.list_files()
+        return next(f for f in files if f["filename"] == upload.filename)
+
+    async def sample_rss(self):
+        while self.rss:
+            value = self.rss()
+            if value is not None:
+                self.rss_samples.append(value)
+            await asyncio.sleep(self.options.rss_interval)
+
+    async def run(self):
+        options = self.options
+        sampler = asyncio.ensure_future(self.sample_rss())
+        rss_idle = self.rss() if self.rss else None
+        started = time.perf_counter()
+        users = await self.join_all("user", options.users, channels=True)
+        join_seconds = time.perf_counter() - started
+        transferring = options.uploads + options.downloads
+        movers = await self.join_all("mover", transferring) if transferring else []
+        rss_joined = self.rss() if self.rss else None
+
+        self.directory = tempfile.mkdtemp(prefix="chat_bench_files_")
+        seed = None
+        if options.downloads and movers:
+            try:
+                seed = await self.seed_download(movers[0])
+            except (ClientError, ConnectionError, OSError, StopIteration) as e:
+                self.error("seed", e)
+
+        self.running = True
+        tasks = [self.chat(client, i) for i, client in enumerate(users[: options.senders])]
+        tasks += [self.poll(client) for client in users[options.senders:][: options.pollers]]
+        tasks += [self.upload_loop(client, i) for i, client in enumerate(movers[: options.uploads])]
+        if seed:
+            tasks += [self.download_loop(client, seed, i) for i, client in enumerate(movers[options.uploads:])]
+        running = [asyncio.ensure_future(task) for task in tasks]
+        phase_started = time.perf_counter()
+        await asyncio.sleep(options.duration)
+        self.running = False
+        # Let chat already on the wire arrive before counting deliveries
+        await asyncio.sleep(options.drain)
+        phase_seconds = time.perf_counter() - phase_started
+        for task in running:
+            task.cancel()
+        await asyncio.gather(*running, return_exceptions=True)
+        sent = self.sent
+        rss_final = self.rss() if self.rss else None
+        sampler.cancel()
+        await asyncio.gather(sampler, return_exceptions=True)
+        await asyncio.gather(*(client.close() for client in self.clients), return_exceptions=True)
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+        receivers = len(self.clients)
+        # Every client is in the default channel, only users are in the others
+        expected = sum(
+            count * (receivers if channel == DEFAULT_CHANNEL else self.members[channel])
+            for channel, count in self.sent_by_channel.items()
+        )
+        return {
+            "time": datetime.now().isoformat(timespec="seconds"),
+            "config": vars(options),
+            "join": {
+                "requested": options.users + transferring,
+                "joined": len(self.clients),
+                "seconds": join_seconds,
+                "per_s": len(users) / join_seconds if join_seconds > 0 else None,
+                "latency": summarize(self.join_latencies),
+            },
+            "chat": {
+                "sent": sent,
+                "sent_per_s": sent / options.duration,
+                "receivers": receivers,
+                "delivered": self.delivered,
+                "delivered_per_s": self.delivered / phase_seconds,
+                "expected": expected,
+                "delivery_ratio": self.delivered / expected if expected else None,
+                "fanout_latency": summarize(self.fanout_latencies),
+            },
+            "file_list": summarize(self.list_latencies),
+            "uploads": throughput(self.uploads),
+            "downloads": throughput(self.downloads),
+            "server_rss": {
+                "idle_bytes": rss_idle,
+                "joined_bytes": rss_joined,
+                "peak_bytes": max(self.rss_samples) if self.rss_samples else None,
+                "final_bytes": rss_final,
+            },
+            "errors": dict(self.errors),
+        }
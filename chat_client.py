@@ -0,0 +1,995 @@
+"""Headless client for the chat server, usable without tkinter.
+
+AsyncChatClient speaks the protocol on an asyncio event loop, so one
+process can hold many connections (bots, bridges, probes, bulk
+importers). ChatClient offers the same operations as blocking calls; its
+coroutines run on one background event loop thread shared by every
+ChatClient, so it never needs a Tk interpreter or a thread per
+connection. client.py is a Tk front end over ChatClient.
+
+Both work with framed servers and with older servers that only speak the
+plain text protocol. Callbacks (on_chat, on_channel_chat,
+on_direct_message, on_message, on_history, on_close) run on the event loop thread and must not block; progress
+callbacks of transfers may also run on worker threads.
+"""
+import asyncio
+import hashlib
+import json
+import os
+import tempfile
+import threading
+
+from chunked_transfer import chunk_checksum
+from parallel_transfer import download_parallel, parse_transfer_grant, upload_parallel
+from protocol import (
+    AUTH_SUCCESS_PREFIX,
+    DEFAULT_CHANNEL,
+    FRAME_COMMAND,
+    FRAME_DATA,
+    FRAME_TEXT,
+    FrameBuffer,
+    ProtocolError,
+    encode_channel_text,
+    encode_frame,
+    is_channel_name,
+    offer_nickname,
+    parse_channel_text,
+)
+from transfer_codecs import (
+    CODECS,
+    DEFAULT_CODEC,
+    SAMPLE_SIZE,
+    StreamDecompressor,
+    choose_codec,
+    compressor,
+    parse_codecs,
+)
+
+BUFFER_SIZE = 65536
+CONNECT_TIMEOUT = 10
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+PARALLEL_STREAMS = 4  # Data connections per transfer, 1 keeps everything on the chat connection
+PARALLEL_MIN_SIZE = 8 * 1024 * 1024  # Smaller files are not worth the extra connections
+UPLOAD_CODEC = "gzip"  # Codec for compressible uploads when the server supports it
+UPLOAD_COMPRESS_LEVEL = 6
+CANCEL_POLL_INTERVAL = 0.2
+
+# Replies the server sends as commands; anything else on a legacy connection is chat
+REPLY_PREFIXES = (
+    "AUTH_",
+    "CODECS:",
+    "HISTORY:",
+    "FILE_LIST:",
+    "FILE_INFO:",
+    "FILE_DATA_START:",
+    "FILE_RANGE_START:",
+    "FILE_NOT_FOUND",
+    "DOWNLOAD_",
+    "UPLOAD_",
+    "CHUNK_",
+    "TRANSFER_TOKEN:",
+    "STATS:",
+    "STATS_DENIED",
+    "TRACE:",
+    "TRACE_DENIED",
+    "TRACE_ERROR:",
+    "JOINED:",
+    "PARTED:",
+    "CHANNEL_ERROR:",
+    "DM:",
+    "DM_SENT:",
+    "DM_QUEUED:",
+    "DM_ERROR:",
+)
+UPLOAD_REPLIES = (
+    "UPLOAD_HASH_UNKNOWN",
+    "UPLOAD_SUCCESS",
+    "UPLOAD_ERROR",
+    "UPLOAD_OFFSET:",
+    "CHUNK_ACK:",
+    "CHUNK_NACK:",
+    "TRANSFER_TOKEN:",
+)
+
+
+class ClientError(Exception):
+    pass
+
+
+class AuthenticationError(ClientError):
+    pass
+
+
+class TransferCancelled(ClientError):
+    pass
+
+
+class Transfer:
+    """Progress reporting and cancellation of one upload or download.
+
+    on_progress(stage, percent) is called with stage one of "hash",
+    "compress", "upload", "parallel_upload", "confirm", "download" or
+    "parallel_download".
+    """
+
+    def __init__(self, on_progress=None):
+        self.on_progress = on_progress
+        self.cancelled = threading.Event()
+        # Set once a legacy upload starts streaming; that protocol has no way to stop halfway
+        self.committed = False
+
+    def cancel(self):
+        """Stop the transfer; False if it is past the point where it can be stopped"""
+        if self.committed:
+            return False
+        self.cancelled.set()
+        return True
+
+    def check(self):
+        if self.cancelled.is_set() and not self.committed:
+            raise TransferCancelled("传输已取消")
+
+    def report(self, stage, done, total):
+        if self.on_progress:
+            self.on_progress(stage, int(done * 100 / total) if total else 100)
+
+
+class FileUpload:
+    """The file side of an upload: hashing, compressing and chunking.
+
+    The protocol announces the compressed size and SHA-256 before the
+    first byte, so the file is read twice in BUFFER_SIZE blocks: once to
+    hash it, once to compress it into a temporary spool file that chunks
+    are then read from. Memory use is one block or chunk at a time,
+    whatever the file size. The methods block and run on worker threads.
+    """
+
+    def __init__(self, path, transfer):
+        self.path = path
+        self.transfer = transfer
+        self.filename = os.path.basename(path)
+        self.size = os.path.getsize(path)
+        self.digest = None
+        self.codec = DEFAULT_CODEC
+        self.compressed_size = None  # Stays None when the server already had the content
+        self.spool = None
+        self.spool_lock = threading.Lock()
+
+    def read_blocks(self, stage):
+        """The file in BUFFER_SIZE blocks, reporting progress as stage"""
+        done = 0
+        with open(self.path, "rb") as f:
+            while True:
+                self.transfer.check()
+                block = f.read(BUFFER_SIZE)
+                if not block:
+                    return
+                done += len(block)
+                self.transfer.report(stage, done, self.size)
+                yield block
+
+    def hash_file(self):
+        """SHA-256 of the file and its first SAMPLE_SIZE bytes for choosing a codec"""
+        sha256 = hashlib.sha256()
+        sample = bytearray()
+        for block in self.read_blocks("hash"):
+            sha256.update(block)
+            if len(sample) < SAMPLE_SIZE:
+                sample += block[: SAMPLE_SIZE - len(sample)]
+        self.digest = sha256.hexdigest()
+        return bytes(sample)
+
+    def compress_to_spool(self, codec):
+        self.codec = codec
+        self.spool = tempfile.TemporaryFile(prefix="chat_upload_")
+        stream = compressor(codec, UPLOAD_COMPRESS_LEVEL)
+        for block in self.read_blocks("compress"):
+            self.spool.write(stream.compress(block))
+        self.spool.write(stream.flush())
+        self.compressed_size = self.spool.tell()
+
+    @property
+    def chunk_count(self):
+        return max(1, -(-self.compressed_size // UPLOAD_CHUNK_SIZE))
+
+    def read_chunk(self, index):
+        """One chunk of the compressed stream; safe to call from the parallel upload threads"""
+        with self.spool_lock:
+            self.spool.seek(index * UPLOAD_CHUNK_SIZE)
+            return self.spool.read(UPLOAD_CHUNK_SIZE)
+
+    def close(self):
+        if self.spool:
+            self.spool.close()
+
+
+class DownloadSink:
+    """Decompress a download block by block into a temp file next to its destination.
+
+    The temp file is renamed to the destination only once the compressed
+    and decompressed sizes match the FILE_INFO, so an interrupted or
+    corrupted download never leaves a partial file under the chosen name.
+    """
+
+    def __init__(self, path, file_info):
+        self.path = path
+        self.file_info = file_info
+        self.decompressor = StreamDecompressor(file_info.get("codec", DEFAULT_CODEC))
+        descriptor, self.temp_path = tempfile.mkstemp(
+            prefix=".chat_download_", suffix=".part", dir=os.path.dirname(path) or "."
+        )
+        self.file = os.fdopen(descriptor, "wb")
+        self.compressed_received = 0
+        self.written = 0
+
+    def write(self, data):
+        self.compressed_received += len(data)
+        for block in self.decompressor.decompress(data, BUFFER_SIZE):
+            self.file.write(block)
+            self.written += len(block)
+        if self.written > self.file_info["size"]:
+            raise ValueError("下载的数据比文件信息中的大小多")
+
+    def finish(self):
+        tail = self.decompressor.flush()
+        self.file.write(tail)
+        self.written += len(tail)
+        self.file.close()
+        if not self.decompressor.eof:
+            raise ValueError("压缩数据不完整")
+        if (self.compressed_received, self.written) != (
+            self.file_info["compressed_size"],
+            self.file_info["size"],
+        ):
+            raise ValueError(
+                f"收到 {self.written} 字节（压缩 {self.compressed_received}），"
+                f"文件信息为 {self.file_info['size']} 字节（压缩 {self.file_info['compressed_size']}）"
+            )
+        os.replace(self.temp_path, self.path)
+
+    def abort(self):
+        self.file.close()
+        if os.path.exists(self.temp_path):
+            os.remove(self.temp_path)
+
+
+class SingleDownload:
+    """A DOWNLOAD_FILE in progress on the chat connection.
+
+    The read loop feeds it FILE_INFO, FILE_DATA_START and the data as they
+    arrive. It stays installed until every announced byte was read, even
+    after a failure or cancellation, so the data of one download never
+    ends up in the next one; `done` resolves at that point.
+    """
+
+    def __init__(self, path, transfer, done):
+        self.path = path
+        self.transfer = transfer
+        self.done = done
+        self.file_info = None
+        self.sink = None
+        self.expected = None
+        self.received = 0
+        self.error = None
+
+    def handles(self, message):
+        """Take the download's own replies; True if message was one of them"""
+        if message.startswith("FILE_INFO:"):
+            self.file_info = json.loads(message.split(":", 2)[2])
+        elif message.startswith("FILE_DATA_START:"):
+            self.expected = int(message.split(":")[1])
+            try:
+                self.sink = DownloadSink(self.path, self.file_info)
+            except Exception as e:
+                self.error = e
+            if self.expected == 0:
+                self.finish()
+        elif message in ("FILE_NOT_FOUND", "DOWNLOAD_ERROR"):
+            reason = "服务器上没有这个文件" if message == "FILE_NOT_FOUND" else "服务器读取文件失败"
+            self.resolve(ClientError(reason))
+        elif message != "DOWNLOAD_COMPLETE":
+            return False  # DOWNLOAD_COMPLETE adds nothing once the announced bytes arrived
+        return True
+
+    def feed(self, data):
+        if self.expected is None or self.done.done():
+            return
+        self.received += len(data)
+        if self.sink and not self.error and not self.transfer.cancelled.is_set():
+            try:
+                self.sink.write(data)
+            except Exception as e:
+                self.error = e
+            self.transfer.report("download", self.received, self.expected)
+        if self.received >= self.expected:
+            self.finish()
+
+    def finish(self):
+        if self.sink:
+            try:
+                if self.error or self.transfer.cancelled.is_set():
+                    self.sink.abort()
+                else:
+                    self.sink.finish()
+            except Exception as e:
+                self.sink.abort()
+                self.error = e
+        if self.transfer.cancelled.is_set():
+            self.resolve(TransferCancelled("下载已取消"))
+        elif self.error:
+            self.resolve(ClientError(f"文件下载失败: {self.error}"))
+        else:
+            self.resolve(None)
+
+    def resolve(self, error):
+        if self.done.done():
+            return
+        if error:
+            self.done.set_exception(error)
+        else:
+            self.done.set_result(self.file_info)
+
+
+def fetch_parallel(host, port, grant, path, transfer, max_streams):
+    """Fetch the ranges of a granted download into a spool file, then decompress it into path.
+
+    Returns the file's FILE_INFO, or None if the data connections failed
+    and the download should be retried on the chat connection.
+    """
+    token, streams, file_info = parse_transfer_grant(grant)
+    streams = min(streams, max_streams)
+    total_size = file_info["compressed_size"]
+    spool_lock = threading.Lock()
+
+    def on_progress(done):
+        transfer.check()
+        transfer.report("parallel_download", done, total_size)
+
+    with tempfile.TemporaryFile(prefix="chat_download_") as spool:
+
+        def write_at(offset, data):
+            with spool_lock:
+                spool.seek(offset)
+                spool.write(data)
+
+        try:
+            download_parallel(host, port, token, file_info, streams, on_progress, write_at)
+        except TransferCancelled:
+            raise
+        except Exception as e:
+            print(f"并行下载失败，改用单连接下载: {e}")
+            return None
+        sink = DownloadSink(path, file_info)
+        try:
+            spool.seek(0)
+            while True:
+                block = spool.read(BUFFER_SIZE)
+                if not block:
+                    break
+                sink.write(block)
+            sink.finish()
+        except Exception as e:
+            sink.abort()
+            raise ClientError(f"文件下载失败: {e}") from e
+    return file_info
+
+
+class AsyncChatClient:
+    """One connection to the chat server, driven from an asyncio event loop"""
+
+    def __init__(
+        self,
+        host,
+        port,
+        nickname,
+        password="",
+        on_chat=None,
+        on_channel_chat=None,
+        on_direct_message=None,
+        on_message=None,
+        on_history=None,
+        on_close=None,
+        parallel_streams=PARALLEL_STREAMS,
+    ):
+        self.host = host
+        self.port = port
+        self.nickname = nickname
+        self.password = password
+        self.on_chat = on_chat  # on_chat(text) for every chat line of the default channel
+        self.on_channel_chat = on_channel_chat  # on_channel_chat(channel, text) for the other channels joined
+        self.on_direct_message = on_direct_message  # on_direct_message(message) with "from", "to", "text", "time", "offline"
+        self.on_message = on_message  # on_message(text) for server messages no request is waiting for
+        self.on_history = on_history  # on_history(history) for the backlog sent after login
+        self.on_close = on_close  # on_close(error) once the connection ends, error None after close()
+        self.parallel_streams = parallel_streams
+        self.framed = False
+        self.server_codecs = None  # Codecs the server accepts, once negotiated
+        self.channels = {DEFAULT_CHANNEL}  # Channels joined, the server puts every user in the default one
+        self.reader = None
+        self.writer = None
+        self.read_task = None
+        self.send_lock = None
+        self.transfer_lock = None
+        self.routes = []  # (prefixes, queue) of requests waiting for a reply, oldest first
+        self.receiving = None
+        self.closing = False
+
+    @property
+    def closed(self):
+        return self.read_task is None or self.read_task.done()
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def connect(self, timeout=CONNECT_TIMEOUT):
+        """Connect and log in; raises AuthenticationError for a wrong password"""
+        # Created here so they belong to the loop the client runs on
+        self.send_lock = asyncio.Lock()
+        self.transfer_lock = asyncio.Lock()
+        self.reader, self.writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port), timeout
+        )
+        try:
+            leftover = await asyncio.wait_for(self._handshake(), timeout)
+        except BaseException:
+            self.writer.close()
+            raise
+        self.read_task = asyncio.ensure_future(self._read_loop(leftover))
+        if self.framed:
+            await self.send_command("CODECS:" + ",".join(CODECS))
+
+    async def _handshake(self):
+        """NICK with a framing offer, then the length prefixed password; returns data read past the reply"""
+        if await self.reader.read(1024) != b"NICK":
+            raise ClientError("服务器没有按协议请求昵称")
+        self.writer.write(offer_nickname(self.nickname).encode("utf-8"))
+        reply = await self.reader.read(1024)
+        if reply.startswith(b"PASS"):
+            password = self.password.encode("utf-8")
+            self.writer.write(f"{len(password):04d}".encode("utf-8") + password)
+            reply = reply[4:] or await self.reader.read(1024)
+        if reply.startswith(AUTH_SUCCESS_PREFIX):
+            while b"\n" not in reply:
+                data = await self.reader.read(1024)
+                if not data:
+                    raise ConnectionError("登录过程中连接已断开")
+                reply += data
+            # The server accepted framing, everything after the acknowledgement is frames
+            self.framed = True
+            return reply.partition(b"\n")[2]
+        if reply.startswith(b"AUTH_SUCCESS"):
+            return reply[len(b"AUTH_SUCCESS"):]
+        if reply.startswith(b"AUTH_FAILED"):
+            raise AuthenticationError("服务器密码验证失败")
+        raise ClientError(f"登录时收到意外回复: {reply[:40]!r}")
+
+    async def _read_loop(self, leftover):
+        error = None
+        try:
+            if self.framed:
+                await self._read_frames(leftover)
+            else:
+                await self._read_legacy(leftover)
+        except (ConnectionError, OSError, ProtocolError, asyncio.IncompleteReadError) as e:
+            error = e
+        finally:
+            for _, queue in self.routes:
+                queue.put_nowait(None)
+            if self.receiving:
+                self.receiving.resolve(ConnectionError("下载过程中连接已断开"))
+            if self.on_close:
+                self.on_close(None if self.closing else error or ConnectionError("服务器关闭了连接"))
+
+    async def _read_frames(self, leftover):
+        frames = FrameBuffer(BUFFER_SIZE)
+        frames.feed(leftover)
+        while True:
+            frame = frames.next_frame()
+            if frame is None:
+                data = await self.reader.read(BUFFER_SIZE)
+                if not data:
+                    return
+                frames.feed(data)
+                continue
+            frame_type, payload = frame
+            if frame_type == FRAME_DATA:
+                if self.receiving:
+                    self.receiving.feed(payload)
+            elif frame_type == FRAME_TEXT:
+                channel, line = parse_channel_text(bytes(payload))
+                text = line.decode("utf-8", errors="replace")
+                if channel == DEFAULT_CHANNEL:
+                    if self.on_chat:
+                        self.on_chat(text)
+                elif self.on_channel_chat:
+                    self.on_channel_chat(channel, text)
+            else:
+                self._dispatch(bytes(payload).decode("utf-8"))
+
+    async def _read_legacy(self, leftover):
+        """The plain text protocol: one message per read, except the payloads that follow a header"""
+        data = leftover
+        while True:
+            if not data:
+                data = await self.reader.read(1024)
+                if not data:
+                    return
+            if data.startswith(b"FILE_DATA_START:"):
+                # The file's bytes may arrive in the same read as the header
+                header = data[: len(b"FILE_DATA_START:")]
+                digits = data[len(header):]
+                count = len(digits) - len(digits.lstrip(b"0123456789"))
+                data = await self._read_legacy_data(header + digits[:count], digits[count:])
+                continue
+            message, data = data.decode("utf-8", errors="replace").strip(), b""
+            if not message:
+                continue
+            if message.startswith(("FILE_LIST:", "FILE_INFO:")):
+                # Both carry a JSON body of the announced length, FILE_INFO as a separate send
+                header, length, body = message.split(":", 2)
+                body = body.encode("utf-8")
+                if len(body) < int(length):
+                    body += await self.reader.readexactly(int(length) - len(body))
+                message = f"{header}:{length}:{body.decode('utf-8')}"
+                if header == "FILE_INFO":
+                    self.writer.write(b"READY")
+            if not message.startswith(REPLY_PREFIXES):
+                if self.on_chat:
+                    self.on_chat(message)
+                continue
+            self._dispatch(message)
+
+    async def _read_legacy_data(self, header, received):
+        """Hand a legacy download's raw bytes to the download; returns what was read past them"""
+        self._dispatch(header.decode("utf-8"))
+        remaining = int(header.split(b":")[1])
+        while remaining:
+            chunk = received or await self.reader.read(min(BUFFER_SIZE, remaining))
+            if not chunk:
+                raise ConnectionError("下载过程中连接已断开")
+            chunk, received = chunk[:remaining], chunk[remaining:]
+            remaining -= len(chunk)
+            if self.receiving:
+                self.receiving.feed(chunk)
+        return received
+
+    def _dispatch(self, message):
+        if message.startswith("CODECS:"):
+            self.server_codecs = parse_codecs(message.split(":", 1)[1]) or (DEFAULT_CODEC,)
+            return
+        if message.startswith("HISTORY:"):
+            if self.on_history:
+                self.on_history(json.loads(message.split(":", 2)[2]))
+            return
+        if message.startswith("DM:"):
+            if self.on_direct_message:
+                self.on_direct_message(json.loads(message.split(":", 2)[2]))
+            return
+        if self.receiving and self.receiving.handles(message):
+            return
+        for prefixes, queue in self.routes:
+            if message.startswith(prefixes):
+                queue.put_nowait(message)
+                return
+        if self.on_message:
+            self.on_message(message)
+
+    def _route(self, prefixes):
+        """A queue receiving the replies that start with prefixes, until _unroute"""
+        queue = asyncio.Queue()
+        self.routes.append((prefixes, queue))
+        return queue
+
+    def _unroute(self, queue):
+        self.routes = [route for route in self.routes if route[1] is not queue]
+
+    async def _next_reply(self, replies, transfer=None):
+        """The next reply from a _route queue, checking for cancellation while waiting"""
+        while True:
+            if transfer:
+                transfer.check()
+            try:
+                message = await asyncio.wait_for(replies.get(), CANCEL_POLL_INTERVAL if transfer else None)
+            except asyncio.TimeoutError:
+                continue
+            if message is None:
+                raise ConnectionError("与服务器的连接已断开")
+            return message
+
+    async def _send(self, *frames):
+        """Send frames back to back, so nothing else sent on this connection lands between them"""
+        async with self.send_lock:
+            for frame in frames:
+                self.writer.write(frame)
+            await self.writer.drain()
+
+    async def send_command(self, command):
+        if self.framed:
+            await self._send(encode_frame(FRAME_COMMAND, command.encode("utf-8")))
+        else:
+            await self._send(command.encode("utf-8"))
+
+    async def send_chat(self, message, channel=DEFAULT_CHANNEL):
+        """Send message to a channel, the default one unless given, as this client's nickname"""
+        text = f"{self.nickname}: {message}".encode("utf-8")
+        if not self.framed:
+            if channel != DEFAULT_CHANNEL:
+                raise ClientError("服务器不支持频道")
+            await self._send(text)
+            return
+        await self._send(encode_frame(FRAME_TEXT, encode_channel_text(channel, text)))
+
+    async def _channel_command(self, command, channel):
+        if not self.framed:
+            raise ClientError("服务器不支持频道")
+        if not is_channel_name(channel):
+            raise ClientError("频道名只能包含文字、数字、下划线和连字符，最长32个字符")
+        replies = self._route((f"{command}ED:{channel}", f"CHANNEL_ERROR:{channel}:"))
+        try:
+            await self.send_command(f"{command}:{channel}")
+            reply = await self._next_reply(replies)
+        finally:
+            self._unroute(replies)
+        if reply.startswith("CHANNEL_ERROR:"):
+            raise ClientError(f"频道操作失败: {reply.split(':', 2)[2]}")
+
+    async def join(self, channel):
+        """Join a channel, creating it if nobody is in it yet"""
+        await self._channel_command("JOIN", channel)
+        self.channels.add(channel)
+
+    async def part(self, channel):
+        """Leave a channel"""
+        await self._channel_command("PART", channel)
+        self.channels.discard(channel)
+
+    async def focus(self, channel):
+        """Announce this client's next uploads in channel instead of the default one"""
+        if self.framed and channel in self.channels:
+            await self.send_command(f"FOCUS:{channel}")
+
+    async def send_direct_message(self, nickname, text):
+        """Send text to nickname only; True if it was delivered, False if it waits for their next login"""
+        if not self.framed:
+            raise ClientError("服务器不支持私信")
+        replies = self._route(("DM_SENT:", "DM_QUEUED:", "DM_ERROR:"))
+        try:
+            await self.send_command("DM:" + json.dumps({"to": nickname, "text": text}))
+            reply = await self._next_reply(replies)
+        finally:
+            self._unroute(replies)
+        if reply.startswith("DM_ERROR:"):
+            raise ClientError(f"私信发送失败: {reply.split(':', 1)[1]}")
+        return reply.startswith("DM_SENT:")
+
+    async def list_files(self):
+        """The server's files as FILE_LIST entries, newest first"""
+        replies = self._route(("FILE_LIST:",))
+        try:
+            await self.send_command("GET_FILE_LIST")
+            reply = await self._next_reply(replies)
+        finally:
+            self._unroute(replies)
+        return json.loads(reply.split(":", 2)[2])["files"]
+
+    async def stats(self, admin_password=""):
+        """The server's metrics summary (STATS), from the worker process serving this connection"""
+        if not self.framed:
+            raise ClientError("服务器不支持 STATS")
+        replies = self._route(("STATS:", "STATS_DENIED"))
+        try:
+            await self.send_command(f"STATS:{admin_password}" if admin_password else "STATS")
+            reply = await self._next_reply(replies)
+        finally:
+            self._unroute(replies)
+        if reply == "STATS_DENIED":
+            raise ClientError("没有查看服务器统计的权限")
+        return json.loads(reply.split(":", 2)[2])
+
+    async def trace(self, settings="", admin_password=""):
+        """Change the server's tracing (TRACE, e.g. "rate=0.1" or "profile=UPLOAD_CHUNK,count=3") and return its state"""
+        if not self.framed:
+            raise ClientError("服务器不支持 TRACE")
+        replies = self._route(("TRACE:", "TRACE_DENIED", "TRACE_ERROR:"))
+        try:
+            command = "TRACE"
+            if settings or admin_password:
+                command += f":{settings}"
+            if admin_password:
+                command += f":{admin_password}"
+            await self.send_command(command)
+            reply = await self._next_reply(replies)
+        finally:
+            self._unroute(replies)
+        if reply == "TRACE_DENIED":
+            raise ClientError("没有修改服务器跟踪设置的权限")
+        if reply.startswith("TRACE_ERROR:"):
+            raise ClientError(f"跟踪设置无效: {reply.split(':', 1)[1]}")
+        return json.loads(reply.split(":", 2)[2])
+
+    async def upload(self, path, transfer=None):
+        """Upload a file; returns its FileUpload, raises ClientError if the server refused it"""
+        transfer = transfer or Transfer()
+        loop = asyncio.get_running_loop()
+        upload = FileUpload(path, transfer)
+        async with self.transfer_lock:
+            replies = self._route(UPLOAD_REPLIES)
+            try:
+                if self.framed:
+                    outcome = await self._upload_chunked(upload, replies, loop)
+                else:
+                    outcome = await self._upload_legacy(upload, replies, loop)
+            finally:
+                self._unroute(replies)
+                upload.close()
+        if outcome != "UPLOAD_SUCCESS":
+            raise ClientError(f"文件上传失败: {outcome}")
+        return upload
+
+    async def _send_chunk(self, upload, index):
+        chunk = upload.read_chunk(index)
+        command = f"UPLOAD_CHUNK:{upload.digest}:{index}:{chunk_checksum(chunk)}"
+        await self._send(encode_frame(FRAME_COMMAND, command.encode("utf-8")), encode_frame(FRAME_DATA, chunk))
+
+    async def _handle_upload_reply(self, upload, message):
+        """Resend a chunk the server rejected; any other final reply ends the upload and is returned"""
+        if message.startswith("CHUNK_NACK:"):
+            await self._send_chunk(upload, int(message.rsplit(":", 1)[1]))
+            return None
+        if message.startswith("CHUNK_ACK:"):
+            return None
+        return message
+
+    async def _wait_for_result(self, upload, replies):
+        upload.transfer.report("confirm", 1, 1)
+        while True:
+            outcome = await self._handle_upload_reply(upload, await self._next_reply(replies, upload.transfer))
+            if outcome:
+                return outcome
+
+    async def _request_first_chunk(self, upload, replies):
+        """Ask the server where the chunked upload continues"""
+        layout = f"{upload.digest}:{upload.compressed_size}:{UPLOAD_CHUNK_SIZE}"
+        if self.server_codecs is not None:
+            layout += f":{upload.codec}"
+        await self.send_command(f"UPLOAD_RESUME:{layout}:{upload.filename}")
+        while True:
+            reply = await self._next_reply(replies, upload.transfer)
+            if not reply.startswith("CHUNK_"):
+                break
+        if not reply.startswith("UPLOAD_OFFSET:"):
+            raise ClientError(f"服务器拒绝了上传: {reply}")
+        return int(reply.rsplit(":", 1)[1])
+
+    async def _upload_chunked(self, upload, replies, loop):
+        # The server skips the transfer if it already stores this content
+        sample = await loop.run_in_executor(None, upload.hash_file)
+        await self.send_command(f"UPLOAD_HASH:{upload.filename}:{upload.size}:{upload.digest}")
+        reply = await self._next_reply(replies, upload.transfer)
+        if reply != "UPLOAD_HASH_UNKNOWN":
+            return reply
+        # Media and archives that would not shrink go out uncompressed
+        codec = choose_codec(upload.filename, sample, UPLOAD_CODEC, self.server_codecs or (DEFAULT_CODEC,))
+        await loop.run_in_executor(None, upload.compress_to_spool, codec)
+        parallel = self.parallel_streams > 1 and upload.compressed_size >= PARALLEL_MIN_SIZE
+        first_chunk = await self._request_first_chunk(upload, replies)
+        if first_chunk >= upload.chunk_count:
+            # Every chunk arrived before, resending the last one completes the upload
+            await self._send_chunk(upload, upload.chunk_count - 1)
+            return await self._wait_for_result(upload, replies)
+        if parallel:
+            await self.send_command(f"PARALLEL_UPLOAD:{upload.digest}")
+            reply = await self._next_reply(replies, upload.transfer)
+            if reply.startswith("TRANSFER_TOKEN:") and await loop.run_in_executor(
+                None, self._send_parallel, upload, reply
+            ):
+                return await self._wait_for_result(upload, replies)
+            # The server kept every acknowledged chunk, the rest goes over the chat connection
+            first_chunk = await self._request_first_chunk(upload, replies)
+        return await self._send_chunks(upload, replies, first_chunk) or await self._wait_for_result(upload, replies)
+
+    async def _send_chunks(self, upload, replies, first_chunk):
+        """Send every chunk from first_chunk on; returns the outcome if the server ends the upload early"""
+        for index in range(first_chunk, upload.chunk_count):
+            upload.transfer.check()
+            await self._send_chunk(upload, index)
+            sent = min((index + 1) * UPLOAD_CHUNK_SIZE, upload.compressed_size)
+            upload.transfer.report("upload", sent, upload.compressed_size)
+            while not replies.empty():
+                message = replies.get_nowait()
+                if message is None:
+                    raise ConnectionError("与服务器的连接已断开")
+                outcome = await self._handle_upload_reply(upload, message)
+                if outcome:
+                    return outcome
+        return None
+
+    def _send_parallel(self, upload, grant):
+        """Send the missing chunks over data connections; False if that failed"""
+        token, streams, details = parse_transfer_grant(grant)
+        streams = min(streams, self.parallel_streams)
+        missing = details["missing"]
+        already_sent = upload.compressed_size - sum(len(upload.read_chunk(i)) for i in missing)
+
+        def on_progress(done):
+            upload.transfer.check()
+            upload.transfer.report("parallel_upload", already_sent + done, upload.compressed_size)
+
+        try:
+            upload_parallel(
+                self.host, self.port, token, upload.digest, upload.read_chunk, missing, streams, on_progress
+            )
+            return True
+        except TransferCancelled:
+            raise
+        except Exception as e:
+            print(f"并行上传失败，改用单连接上传: {e}")
+            return False
+
+    async def _upload_legacy(self, upload, replies, loop):
+        await loop.run_in_executor(None, upload.compress_to_spool, DEFAULT_CODEC)
+        upload.transfer.check()
+        upload.transfer.committed = True
+        upload.spool.seek(0)
+        sent = 0
+        # Raw bytes follow the header, so nothing else may be sent until the last one
+        async with self.send_lock:
+            self.writer.write(f"UPLOAD_FILE:{upload.filename}:{upload.compressed_size}:".encode("utf-8"))
+            while True:
+                block = upload.spool.read(BUFFER_SIZE)
+                if not block:
+                    break
+                self.writer.write(block)
+                await self.writer.drain()
+                sent += len(block)
+                upload.transfer.report("upload", sent, upload.compressed_size)
+        return await self._wait_for_result(upload, replies)
+
+    async def download(self, file_info, path, transfer=None):
+        """Download a FILE_LIST entry (or a unique_filename) to path; returns the file's FILE_INFO"""
+        if isinstance(file_info, str):
+            file_info = {"unique_filename": file_info}
+        transfer = transfer or Transfer()
+        unique_filename = file_info["unique_filename"]
+        async with self.transfer_lock:
+            if (
+                self.framed
+                and self.parallel_streams > 1
+                and file_info.get("compressed_size", 0) >= PARALLEL_MIN_SIZE
+            ):
+                result = await self._download_parallel(unique_filename, path, transfer)
+                if result is not None:
+                    return result
+            self.receiving = SingleDownload(path, transfer, asyncio.get_running_loop().create_future())
+            try:
+                await self.send_command(f"DOWNLOAD_FILE:{unique_filename}")
+                return await self.receiving.done
+            finally:
+                self.receiving = None
+
+    async def _download_parallel(self, unique_filename, path, transfer):
+        """Download over data connections; None means use the chat connection instead"""
+        replies = self._route(("TRANSFER_TOKEN:",))
+        download = SingleDownload(path, transfer, asyncio.get_running_loop().create_future())
+        self.receiving = download  # An error reply is still a reply to this request
+        try:
+            await self.send_command(f"PARALLEL_DOWNLOAD:{unique_filename}")
+            waiter = asyncio.ensure_future(self._next_reply(replies))
+            await asyncio.wait((waiter, download.done), return_when=asyncio.FIRST_COMPLETED)
+            if download.done.done():
+                waiter.cancel()
+                return download.done.result()
+            grant = waiter.result()
+        finally:
+            self.receiving = None
+            self._unroute(replies)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            None, fetch_parallel, self.host, self.port, grant, path, transfer, self.parallel_streams
+        )
+
+    async def close(self):
+        if self.writer is None:
+            return
+        self.closing = True
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except (ConnectionError, OSError):
+            pass
+        if self.read_task:
+            await asyncio.gather(self.read_task, return_exceptions=True)
+
+
+_loop = None
+_loop_lock = threading.Lock()
+
+
+def background_loop():
+    """The event loop thread every ChatClient runs on, started on first use"""
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="chat-client", daemon=True).start()
+        return _loop
+
+
+class ChatClient:
+    """Blocking version of AsyncChatClient for scripts and GUI code.
+
+    Every method waits for its result. submit() starts one of the async
+    client's coroutines and returns a concurrent.futures.Future instead,
+    for callers such as the Tk client that must not block.
+    """
+
+    def __init__(self, host, port, nickname, password="", **options):
+        self.aio = AsyncChatClient(host, port, nickname, password, **options)
+
+    def __enter__(self):
+        self.connect()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @property
+    def nickname(self):
+        return self.aio.nickname
+
+    @property
+    def framed(self):
+        return self.aio.framed
+
+    @property
+    def closed(self):
+        return self.aio.closed
+
+    def submit(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, background_loop())
+
+    def _run(self, coroutine, timeout=None):
+        return self.submit(coroutine).result(timeout)
+
+    def connect(self, timeout=CONNECT_TIMEOUT):
+        return self._run(self.aio.connect(timeout))
+
+    def send_command(self, command):
+        return self._run(self.aio.send_command(command))
+
+    def send_chat(self, message, channel=DEFAULT_CHANNEL):
+        return self._run(self.aio.send_chat(message, channel))
+
+    def join(self, channel, timeout=None):
+        return self._run(self.aio.join(channel), timeout)
+
+    def part(self, channel, timeout=None):
+        return self._run(self.aio.part(channel), timeout)
+
+    def focus(self, channel):
+        return self._run(self.aio.focus(channel))
+
+    def send_direct_message(self, nickname, text, timeout=None):
+        return self._run(self.aio.send_direct_message(nickname, text), timeout)
+
+    def list_files(self, timeout=None):
+        return self._run(self.aio.list_files(), timeout)
+
+    def stats(self, admin_password="", timeout=None):
+        return self._run(self.aio.stats(admin_password), timeout)
+
+    def trace(self, settings="", admin_password="", timeout=None):
+        return self._run(self.aio.trace(settings, admin_password), timeout)
+
+    def upload(self, path, transfer=None):
+        return self._run(self.aio.upload(path, transfer))
+
+    def download(self, file_info, path, transfer=None):
+        return self._run(self.aio.download(file_info, path, transfer))
+
+    def close(self):
+        return self._run(self.aio.close())
@@ -0,0 +1,200 @@
+"""Bounded chat history: an in-memory ring over a segmented on-disk log.
+
+Every broadcast chat line gets the next offset, a message number that
+keeps growing across restarts. Lines are appended to segment files named
+after the offset of their first message:
+
+    <first offset>.log   records of (unix time, length, message bytes)
+    <first offset>.idx   the position of each record in the .log, 8 bytes each
+
+A segment is closed once it passes segment_size bytes, and the oldest
+segments are deleted beyond max_segments, so disk use is bounded too.
+Reading from an offset looks its segment up in the in-memory list of
+first offsets and its record position up in the index, so a replay never
+scans the log. The last ring_size messages are also kept in memory and
+answer most requests without touching the disk.
+
+Only one process writes the log. In multi-process mode the other workers
+open it read-only and look at the files for every request.
+"""
+import bisect
+import os
+import struct
+import threading
+import time
+from collections import deque
+
+RECORD = struct.Struct("!dI")  # unix time, message length
+INDEX_ENTRY = struct.Struct("!Q")  # position of a record in its .log
+LOG_SUFFIX = ".log"
+INDEX_SUFFIX = ".idx"
+
+
+class ChatHistory:
+    """Recent chat lines by offset, as (offset, unix time, message bytes) tuples"""
+
+    def __init__(self, directory, ring_size=1000, segment_size=4 * 1024 * 1024, max_segments=16, writable=True):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_segments = max(1, max_segments)
+        self.writable = writable
+        self.ring = deque(maxlen=ring_size)
+        self.segments = []  # first offset of every segment on disk, ascending
+        self.next_offset = 0
+        self.log = None
+        self.index = None
+        self.log_size = 0
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._scan_segments()
+        if writable:
+            self._recover()
+
+    def _path(self, first_offset, suffix):
+        return os.path.join(self.directory, f"{first_offset:020d}{suffix}")
+
+    def _scan_segments(self):
+        self.segments = sorted(
+            int(name[: -len(LOG_SUFFIX)])
+            for name in os.listdir(self.directory)
+            if name.endswith(LOG_SUFFIX) and name[: -len(LOG_SUFFIX)].isdigit()
+        )
+        if self.segments:
+            last = self.segments[-1]
+            try:
+                count = os.path.getsize(self._path(last, INDEX_SUFFIX)) // INDEX_ENTRY.size
+            except OSError:
+                count = 0
+            self.next_offset = last + count
+        else:
+            self.next_offset = 0
+
+    def _recover(self):
+        """Drop a record torn by a crash from the last segment and reopen it for appending"""
+        if not self.segments:
+            self._open_segment(0)
+            return
+        first = self.segments[-1]
+        log_path, index_path = self._path(first, LOG_SUFFIX), self._path(first, INDEX_SUFFIX)
+        if not os.path.exists(index_path):
+            open(index_path, "wb").close()
+        with open(index_path, "r+b") as index, open(log_path, "r+b") as log:
+            log_size = os.fstat(log.fileno()).st_size
+            count = os.fstat(index.fileno()).st_size // INDEX_ENTRY.size
+            end = 0
+            while count:
+                # The index is written after its record, so only the last entries can be bad
+                index.seek((count - 1) * INDEX_ENTRY.size)
+                (position,) = INDEX_ENTRY.unpack(index.read(INDEX_ENTRY.size))
+                log.seek(position)
+                header = log.read(RECORD.size)
+                if len(header) == RECORD.size:
+                    end = position + RECORD.size + RECORD.unpack(header)[1]
+                    if end <= log_size:
+                        break
+                count -= 1
+            index.truncate(count * INDEX_ENTRY.size)
+            log.truncate(end if count else 0)
+        self.next_offset = first + count
+        self._open_segment(first)
+        self.ring.extend(self._read(max(self.segments[0], self.next_offset - self.ring.maxlen), self.next_offset))
+
+    def _open_segment(self, first_offset):
+        if self.log:
+            self.log.close()
+            self.index.close()
+        self.log = open(self._path(first_offset, LOG_SUFFIX), "ab")
+        self.index = open(self._path(first_offset, INDEX_SUFFIX), "ab")
+        self.log_size = self.log.tell()
+        if not self.segments or self.segments[-1] != first_offset:
+            self.segments.append(first_offset)
+        while len(self.segments) > self.max_segments:
+            oldest = self.segments.pop(0)
+            for suffix in (LOG_SUFFIX, INDEX_SUFFIX):
+                try:
+                    os.remove(self._path(oldest, suffix))
+                except OSError:
+                    pass
+
+    def append(self, message):
+        """Record one chat line and return its offset"""
+        message = bytes(message)
+        with self.lock:
+            if self.log_size >= self.segment_size and self.next_offset > self.segments[-1]:
+                self._open_segment(self.next_offset)
+            now = time.time()
+            position = self.log_size
+            self.log.write(RECORD.pack(now, len(message)) + message)
+            self.log.flush()
+            self.index.write(INDEX_ENTRY.pack(position))
+            self.index.flush()
+            self.log_size += RECORD.size + len(message)
+            offset = self.next_offset
+            self.next_offset += 1
+            self.ring.append((offset, now, message))
+            return offset
+
+    @property
+    def first_offset(self):
+        return self.segments[0] if self.segments else self.next_offset
+
+    def recent(self, count):
+        """The last count messages, oldest first"""
+        with self.lock:
+            if not self.writable:
+                self._scan_segments()
+            return self._since(max(self.first_offset, self.next_offset - count), count)
+
+    def since(self, offset, limit):
+        """Up to limit messages from offset on; offsets already deleted are skipped"""
+        with self.lock:
+            if not self.writable:
+                self._scan_segments()
+            return self._since(max(offset, self.first_offset), limit)
+
+    def _since(self, offset, limit):
+        end = min(self.next_offset, offset + max(limit, 0))
+        if offset >= end:
+            return []
+        if self.ring and offset >= self.ring[0][0]:
+            start = offset - self.ring[0][0]
+            return [self.ring[i] for i in range(start, start + end - offset)]
+        return self._read(offset, end)
+
+    def _read(self, start, end):
+        """Messages start..end-1 from the segment files"""
+        messages = []
+        segment = bisect.bisect_right(self.segments, start) - 1
+        offset = start
+        while offset < end and 0 <= segment < len(self.segments):
+            first = self.segments[segment]
+            try:
+                with open(self._path(first, INDEX_SUFFIX), "rb") as index, open(
+                    self._path(first, LOG_SUFFIX), "rb"
+                ) as log:
+                    index.seek((offset - first) * INDEX_ENTRY.size)
+                    entry = index.read(INDEX_ENTRY.size)
+                    if len(entry) == INDEX_ENTRY.size:
+                        log.seek(INDEX_ENTRY.unpack(entry)[0])
+                        while offset < end:
+                            header = log.read(RECORD.size)
+                            if len(header) < RECORD.size:
+                                break
+                            timestamp, length = RECORD.unpack(header)
+                            message = log.read(length)
+                            if len(message) < length:
+                                break
+                            messages.append((offset, timestamp, message))
+                            offset += 1
+            except OSError:
+                pass  # Deleted by the writer while being read
+            segment += 1
+            if segment < len(self.segments):
+                offset = max(offset, self.segments[segment])
+        return messages
+
+    def close(self):
+        with self.lock:
+            if self.log:
+                self.log.close()
+                self.index.close()
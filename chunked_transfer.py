@@ -0,0 +1,212 @@
+"""Resumable chunked uploads.
+
+A chunked upload is identified by the SHA-256 of the file content. Its
+gzip stream is written chunk by chunk to .resume_<id> in the upload
+directory, next to a .resume_<id>.json sidecar holding the file name and
+sizes and a .resume_<id>.chunks list of the chunks written so far, so a
+partial upload survives both a dropped connection and a server restart.
+Every chunk carries a CRC32 and is acknowledged once it is written.
+Chunks may arrive in any order, over one connection or several, and in
+multi-process mode through several worker processes; a client that comes
+back asks which chunks are still missing.
+
+The stream has to be identical on every attempt, so clients compress with
+the deterministic compressors of transfer_codecs; the codec is part of
+the upload's layout.
+"""
+import json
+import os
+import struct
+import threading
+import time
+import zlib
+
+from transfer_codecs import DEFAULT_CODEC
+
+RESUME_PREFIX = ".resume_"
+SIDECAR_SUFFIXES = (".json", ".chunks", ".done")
+MAX_CHUNK_SIZE = 16 * 1024 * 1024
+CHUNK_INDEX = struct.Struct("!I")
+
+
+def chunk_checksum(data):
+    return format(zlib.crc32(data) & 0xFFFFFFFF, "08x")
+
+
+class PartialUpload:
+    """The chunks of a chunked upload received so far"""
+
+    def __init__(self, directory, upload_id, filename, compressed_size, chunk_size, codec=DEFAULT_CODEC):
+        self.upload_id = upload_id
+        self.filename = filename
+        self.compressed_size = compressed_size
+        self.chunk_size = chunk_size
+        self.codec = codec
+        self.data_path = os.path.join(directory, RESUME_PREFIX + upload_id)
+        self.info_path = self.data_path + ".json"
+        self.chunks_path = self.data_path + ".chunks"
+        self.done_path = self.data_path + ".done"
+        self.received = set()
+        self.completed = False
+        self.lock = threading.Lock()
+
+    @property
+    def chunk_count(self):
+        return max(1, -(-self.compressed_size // self.chunk_size))
+
+    def matches(self, compressed_size, chunk_size, codec=DEFAULT_CODEC):
+        return (self.compressed_size, self.chunk_size, self.codec) == (
+            compressed_size,
+            chunk_size,
+            codec,
+        )
+
+    @classmethod
+    def open(cls, directory, upload_id, filename, compressed_size, chunk_size, codec=DEFAULT_CODEC):
+        """Continue a partial upload with the same layout, or start it over"""
+        upload = cls(directory, upload_id, filename, compressed_size, chunk_size, codec)
+        try:
+            with open(upload.info_path, "r", encoding="utf-8") as f:
+                info = json.load(f)
+            # Partial uploads from before codecs were negotiated are gzip
+            layout = (info["compressed_size"], info["chunk_size"], info.get("codec", DEFAULT_CODEC))
+            if upload.matches(*layout):
+                upload._load_received()
+                return upload
+        except (OSError, ValueError, KeyError):
+            pass
+        for path in (upload.data_path, upload.chunks_path):
+            with open(path, "wb"):
+                pass
+        if os.path.exists(upload.done_path):
+            os.remove(upload.done_path)
+        with open(upload.info_path, "w", encoding="utf-8") as f:
+            json.dump(
+                {
+                    "filename": filename,
+                    "compressed_size": compressed_size,
+                    "chunk_size": chunk_size,
+                    "codec": codec,
+                },
+                f,
+                ensure_ascii=False,
+            )
+        return upload
+
+    @classmethod
+    def load(cls, directory, upload_id):
+        """The partial upload stored under upload_id, or None if there is none"""
+        info_path = os.path.join(directory, RESUME_PREFIX + upload_id + ".json")
+        try:
+            with open(info_path, "r", encoding="utf-8") as f:
+                info = json.load(f)
+            upload = cls(
+                directory,
+                upload_id,
+                info["filename"],
+                info["compressed_size"],
+                info["chunk_size"],
+                info.get("codec", DEFAULT_CODEC),
+            )
+            upload._load_received()
+            return upload
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def exists(self):
+        return os.path.exists(self.info_path)
+
+    def _load_received(self):
+        with open(self.chunks_path, "rb") as f:
+            records = f.read()
+        # A torn record from a crash while appending is ignored, its chunk is sent again
+        usable = len(records) - len(records) % CHUNK_INDEX.size
+        for (index,) in CHUNK_INDEX.iter_unpack(records[:usable]):
+            if index < self.chunk_count:
+                self.received.add(index)
+
+    def next_chunk(self):
+        """Index of the first chunk that has not been received"""
+        with self.lock:
+            for index in range(self.chunk_count):
+                if index not in self.received:
+                    return index
+            return self.chunk_count
+
+    def missing_chunks(self):
+        with self.lock:
+            return [index for index in range(self.chunk_count) if index not in self.received]
+
+    def write_chunk(self, index, checksum, data):
+        """Store one chunk, returning False if it fails its checksum and has to be resent"""
+        if not 0 <= index < self.chunk_count:
+            raise ValueError(f"chunk {index} is outside the upload")
+        offset = index * self.chunk_size
+        if len(data) != min(self.chunk_size, self.compressed_size - offset):
+            return False
+        if chunk_checksum(data) != checksum.lower():
+            return False
+        with open(self.data_path, "r+b") as f:
+            f.seek(offset)
+            f.write(data)
+        with self.lock:
+            if index not in self.received:
+                # Recorded only once the data is written, so a crash never skips a chunk
+                with open(self.chunks_path, "ab") as f:
+                    f.write(CHUNK_INDEX.pack(index))
+                self.received.add(index)
+        return True
+
+    def take_completion(self):
+        """True exactly once, for the caller whose chunk completed the upload.
+
+        Other processes may have written chunks of the same upload, so the
+        chunk list on disk is consulted when it holds more than this process
+        knows about, and the .done marker is created by one caller only.
+        """
+        with self.lock:
+            if self.completed:
+                return False
+            if len(self.received) < self.chunk_count:
+                try:
+                    if os.path.getsize(self.chunks_path) > len(self.received) * CHUNK_INDEX.size:
+                        self._load_received()
+                except OSError:
+                    pass
+            if len(self.received) < self.chunk_count:
+                return False
+            try:
+                os.close(os.open(self.done_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            except FileExistsError:
+                return False  # Completed by another process
+            self.completed = True
+            return True
+
+    def open_stream(self):
+        return open(self.data_path, "rb")
+
+    def discard(self):
+        for path in (self.data_path, self.info_path, self.chunks_path, self.done_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def expire_partial_uploads(directory, max_age):
+    """Delete partial uploads that have not received a chunk for max_age seconds"""
+    expired = 0
+    cutoff = time.time() - max_age
+    for name in os.listdir(directory):
+        if not name.startswith(RESUME_PREFIX) or name.endswith(SIDECAR_SUFFIXES):
+            continue
+        data_path = os.path.join(directory, name)
+        try:
+            if os.path.getmtime(data_path) >= cutoff:
+                continue
+            os.remove(data_path)
+            for suffix in SIDECAR_SUFFIXES:
+                if os.path.exists(data_path + suffix):
+                    os.remove(data_path + suffix)
+            expired += 1
+        except OSError:
+            pass
+    return expired
@@ -1,14 +1,32 @@
 import tkinter as tk
-from tkinter import messagebox, filedialog, ttk
-import socket
+from tkinter import messagebox, filedialog, simpledialog, ttk
+import asyncio
 import threading
 import json
-import gzip
 import os
+import queue
+import shutil
+import tempfile
 import time
+import atexit
+from chat_client import (
+    REPLY_PREFIXES,
+    AuthenticationError,
+    ChatClient,
+    Transfer,
+    TransferCancelled,
+)
+from chat_history import ChatHistory
+from protocol import DEFAULT_CHANNEL
 
-BUFFER_SIZE = 65536 
 MAX_FILE_SIZE = 100 * 1024 * 1024 
+UI_PUMP_INTERVAL = 30  # Milliseconds between drains of the UI event queue
+UI_PUMP_BUDGET = 0.02  # Seconds one drain may spend before Tk gets to redraw
+PROGRESS_INTERVAL = 0.1  # Seconds between progress bar redraws
+CHAT_SCROLLBACK_LINES = 2000  # Lines kept in the chat box, older ones are reloaded when scrolled to
+CHAT_TRIM_BATCH = 500  # Lines trimmed or reloaded at once, so the box is not edited on every message
+CHAT_ARCHIVE_SEGMENT_SIZE = 1024 * 1024
+CHAT_ARCHIVE_SEGMENTS = 64  # Lines older than this many archive segments are forgotten
 root = tk.Tk()
 root.withdraw()
 
@@ -120,207 +138,407 @@ root.deiconify()
 root.title("聊天室")
 root.geometry("800x600")
 root.minsize(600, 400)
-client = None
+client = None  # The ChatClient; its callbacks run on the client library's event loop thread
 available_files = []
-current_download = None
+current_transfer = None  # The Transfer shown in the progress window, if any
 progress_window = None 
-download_save_path = None 
+# Work for the Tk thread, posted by the network and transfer threads as (function, args)
+ui_events = queue.SimpleQueue()
+# Chat views by channel; the default channel's is the first tab and holds system messages
+chat_views = {}
+latest_progress = None  # (operation, percent) not drawn yet
+progress_lock = threading.Lock()
+last_progress_draw = 0.0
 
 
 
-def receive():
-    global current_download, progress_window
-    while True:
-        try:
-            raw_message = client.recv(1024).decode("utf-8")
-            messages = []
-            if "AUTH_SUCCESS" in raw_message:
-                if raw_message == "AUTH_SUCCESS":
-                    messages = ["AUTH_SUCCESS"]
-                elif raw_message.startswith("AUTH_SUCCESS"):
-                    remaining = raw_message[12:]
-                    messages = ["AUTH_SUCCESS", remaining] if remaining else ["AUTH_SUCCESS"]
-                else:
-                    messages = [raw_message]
-            else:
-                messages = [raw_message]
-            for message in messages:
-                if not message.strip():
-                    continue
-                handle_single_message(message.strip())
-        except ConnectionResetError:
-            print("连接被服务器重置")
-            messagebox.showerror("连接断开", "与服务器的连接已断开！")
-            root.quit()
-            break
-        except ConnectionAbortedError:
-            print("连接被中止")
-            messagebox.showerror("连接中止", "与服务器的连接被中止！")
-            root.quit()
-            break
-        except Exception as e:
-            print(f"接收消息错误: {e}")
-            messagebox.showerror("错误", f"与服务器通信时发生错误: {e}")
-            root.quit()
-            break
+def post_ui(func, *args):
+    """Run func(*args) on the Tk thread; safe to call from any thread"""
+    ui_events.put((func, args))
 
 
 
-def handle_single_message(message):
-    global current_download, progress_window
-    if message == "NICK":
-        client.send(nickname.encode("utf-8"))
-    elif message == "PASS":
-        if SERVER_PASSWORD:
-            password_to_send = SERVER_PASSWORD
-        else:
-            password_to_send = ""
-        
-        password_bytes = password_to_send.encode("utf-8")
-        password_length = len(password_bytes)
-        client.send(f"{password_length:04d}".encode("utf-8"))
-        if password_length > 0:
-            client.send(password_bytes)
-        time.sleep(0.1)
-    elif message == "AUTH_SUCCESS":
-        chat_box.config(state="normal")
-        auth_info = "无密码" if not SERVER_PASSWORD else "已验证密码"
-        chat_box.insert(
-            tk.END,
-            f"已成功连接到服务器 {SERVER_HOST}:{SERVER_PORT} ({auth_info}) 昵称：{nickname}\n",
-            "system",
+def pump_ui_events():
+    """Drain the UI event queue for at most UI_PUMP_BUDGET, then let Tk redraw"""
+    deadline = time.monotonic() + UI_PUMP_BUDGET
+    try:
+        while time.monotonic() < deadline:
+            try:
+                func, args = ui_events.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                func(*args)
+            except Exception as e:
+                print(f"界面更新错误: {e}")
+    finally:
+        for view in chat_views.values():
+            view.flush()
+        direct_view.flush()
+        draw_latest_progress()
+        root.after(UI_PUMP_INTERVAL, pump_ui_events)
+
+
+
+def chat_insert_args(lines):
+    """Text.insert arguments (text, tags, text, tags...) for whole lines"""
+    args = []
+    for line in lines:
+        for text, tag in line:
+            args.extend((text, tag or ()))
+        args.extend(("\n", ()))
+    return args
+
+
+
+class ChatView:
+    """The chat box and input line of one channel, in its own notebook tab.
+
+    Every line is archived on disk; the box shows archive offsets
+    shown_first..shown_end-1 and reloads older or newer lines from the
+    archive when they are scrolled to, so a busy channel never holds more
+    than CHAT_SCROLLBACK_LINES in the Text widget.
+    """
+
+    def __init__(self, channel):
+        self.channel = channel
+        self.frame = tk.Frame(notebook)
+        view_frame = tk.Frame(self.frame)
+        view_frame.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
+        self.box = tk.Text(view_frame, state="disabled", height=15)
+        self.box.tag_config("username", foreground="green")
+        self.box.tag_config("system", foreground="blue")
+        self.box.tag_config("history", foreground="gray")
+        self.scrollbar = tk.Scrollbar(view_frame, orient=tk.VERTICAL, command=self.box.yview)
+        self.box.config(yscrollcommand=self.on_scroll)
+        self.box.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        self.scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        input_frame = tk.Frame(self.frame)
+        input_frame.pack(fill=tk.X, padx=5, pady=5)
+        self.build_input(input_frame)
+        # Lines waiting for the next flush, each a list of (text, tag)
+        self.pending_lines = []
+        self.partial_line = []
+        self.archive_dir = tempfile.mkdtemp(prefix="chat_scrollback_")
+        self.archive = ChatHistory(
+            self.archive_dir,
+            ring_size=0,
+            segment_size=CHAT_ARCHIVE_SEGMENT_SIZE,
+            max_segments=CHAT_ARCHIVE_SEGMENTS,
         )
-        chat_box.see(tk.END)
-        chat_box.config(state="disabled")
-        root.after(1000, refresh_file_list)
-    elif message == "AUTH_FAILED":
-        messagebox.showerror("认证失败", "服务器密码验证失败！请检查密码是否正确。")
-        try:
-            client.close()
-        except:
-            pass
-        root.quit()
+        atexit.register(shutil.rmtree, self.archive_dir, True)
+        self.shown_first = 0
+        self.shown_end = 0
+        self.reload_pending = False
+
+    def build_input(self, input_frame):
+        self.input_box = tk.Entry(input_frame)
+        self.input_box.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=(0, 5))
+        tk.Button(input_frame, text="发送", command=self.send).pack(side=tk.LEFT)
+        tk.Button(input_frame, text="加入频道", command=ask_join_channel).pack(side=tk.LEFT, padx=(5, 0))
+        if self.channel != DEFAULT_CHANNEL:
+            tk.Button(input_frame, text="离开频道", command=lambda: leave_channel(self.channel)).pack(
+                side=tk.LEFT, padx=(5, 0)
+            )
+        self.input_box.bind("<Return>", self.send)
+
+    def destroy(self):
+        self.frame.destroy()
+        shutil.rmtree(self.archive_dir, True)
+
+    def send(self, event=None):
+        message = self.input_box.get()
+        if message.strip():
+            self.input_box.delete(0, tk.END)
+            client.submit(client.aio.send_chat(message, self.channel))
+
+    def append(self, text, tag=""):
+        """Queue text for the box; everything queued in one pump is inserted at once"""
+        parts = text.split("\n")
+        for index, part in enumerate(parts):
+            if part:
+                self.partial_line.append((part, tag))
+            if index < len(parts) - 1:
+                self.pending_lines.append(list(self.partial_line))
+                self.partial_line.clear()
+
+    def at_bottom(self):
+        return self.box.yview()[1] >= 1.0
+
+    def flush(self):
+        """Archive the queued lines and, if the box shows the newest lines, insert them in one go"""
+        if not self.pending_lines:
+            return
+        following = self.shown_end == self.archive.next_offset
+        for line in self.pending_lines:
+            self.archive.append(json.dumps(line, ensure_ascii=False).encode("utf-8"))
+        if following:
+            at_bottom = self.at_bottom()
+            self.box.config(state="normal")
+            self.box.insert(tk.END, *chat_insert_args(self.pending_lines))
+            self.shown_end += len(self.pending_lines)
+            if at_bottom:
+                self.trim_top()
+            else:
+                self.trim_bottom()
+            self.box.config(state="disabled")
+            if at_bottom:
+                self.box.see(tk.END)
+        self.pending_lines.clear()
+
+    def trim_top(self):
+        """Drop the oldest shown lines once there are CHAT_TRIM_BATCH more than the scrollback limit"""
+        count = self.shown_end - self.shown_first
+        if count >= CHAT_SCROLLBACK_LINES + CHAT_TRIM_BATCH:
+            excess = count - CHAT_SCROLLBACK_LINES
+            self.box.delete("1.0", f"{excess + 1}.0")
+            self.shown_first += excess
+
+    def trim_bottom(self):
+        """Same for the newest lines, while the user reads further up"""
+        count = self.shown_end - self.shown_first
+        if count >= CHAT_SCROLLBACK_LINES + CHAT_TRIM_BATCH:
+            excess = count - CHAT_SCROLLBACK_LINES
+            self.box.delete(f"{count - excess + 1}.0", "end-1c")
+            self.shown_end -= excess
+
+    def archived_lines(self, start, end):
+        return [json.loads(message) for _, _, message in self.archive.since(start, end - start)]
+
+    def load_older(self):
+        """Put the archived lines above the shown ones back into the box"""
+        self.reload_pending = False
+        start = max(self.archive.first_offset, self.shown_first - CHAT_TRIM_BATCH)
+        if start >= self.shown_first:
+            return
+        lines = self.archived_lines(start, self.shown_first)
+        self.box.config(state="normal")
+        self.box.insert("1.0", *chat_insert_args(lines))
+        self.shown_first = start
+        self.trim_bottom()
+        self.box.config(state="disabled")
+        self.box.yview(len(lines))  # Keep the line that was at the top in place
+
+    def load_newer(self):
+        """Put the archived lines below the shown ones back into the box"""
+        self.reload_pending = False
+        end = min(self.archive.next_offset, self.shown_end + CHAT_TRIM_BATCH)
+        if end <= self.shown_end:
+            return
+        lines = self.archived_lines(self.shown_end, end)
+        self.box.config(state="normal")
+        self.box.insert(tk.END, *chat_insert_args(lines))
+        self.shown_end = end
+        self.trim_top()
+        self.box.config(state="disabled")
+
+    def on_scroll(self, first, last):
+        self.scrollbar.set(first, last)
+        if self.reload_pending:
+            return
+        if float(first) <= 0.0 and self.shown_first > self.archive.first_offset:
+            self.reload_pending = True
+            root.after_idle(self.load_older)
+        elif float(last) >= 1.0 and self.shown_end < self.archive.next_offset:
+            self.reload_pending = True
+            root.after_idle(self.load_newer)
+
+
+
+class DirectMessageView(ChatView):
+    """Direct messages sent and received by this user, with the recipient typed above the input line"""
+
+    def __init__(self):
+        super().__init__(None)
+
+    def build_input(self, input_frame):
+        tk.Label(input_frame, text="发给:").pack(side=tk.LEFT)
+        self.recipient_box = tk.Entry(input_frame, width=16)
+        self.recipient_box.pack(side=tk.LEFT, padx=(0, 5))
+        self.input_box = tk.Entry(input_frame)
+        self.input_box.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=(0, 5))
+        tk.Button(input_frame, text="发送", command=self.send).pack(side=tk.LEFT)
+        self.input_box.bind("<Return>", self.send)
+
+    def send(self, event=None):
+        recipient = self.recipient_box.get().strip()
+        message = self.input_box.get()
+        if not message.strip():
+            return
+        if not recipient:
+            messagebox.showwarning("私信", "请先填写收信人的昵称")
+            return
+        self.input_box.delete(0, tk.END)
+        sending = client.submit(client.aio.send_direct_message(recipient, message))
+        sending.add_done_callback(lambda future: post_ui(direct_message_sent, recipient, message, future))
+
+
+
+def append_chat(text, tag=""):
+    """Queue text for the default channel's tab, where system messages go"""
+    chat_views[DEFAULT_CHANNEL].append(text, tag)
+
+
+
+def open_channel_view(channel):
+    """The tab of channel, added before the file transfer tab if it is not open yet"""
+    view = chat_views.get(channel)
+    if view is None:
+        view = chat_views[channel] = ChatView(channel)
+        notebook.insert(file_transfer_frame, view.frame, text=f"#{channel}")
+    return view
+
+
+
+def ask_join_channel():
+    channel = simpledialog.askstring("加入频道", "频道名称（文字、数字、下划线或连字符）:", parent=root)
+    if not channel or not channel.strip():
         return
-    elif message.startswith("FILE_LIST:"):
-        handle_file_list_message(message)
-    elif message.startswith("FILE_INFO:"):
-        handle_file_info_message(message)
-    elif message.startswith("FILE_DATA_START:"):
-        handle_file_data_start(message)
-    elif message == "UPLOAD_SUCCESS":
-        close_progress_window()
-        messagebox.showinfo("上传成功", "文件上传成功！")
-        notebook.select(1) 
-        refresh_file_list()
-    elif message == "UPLOAD_ERROR":
-        close_progress_window()
-        messagebox.showerror("上传失败", "文件上传失败！")
-    elif message == "DOWNLOAD_ERROR":
-        close_progress_window()
-        messagebox.showerror("下载失败", "文件下载失败！")
-    elif message == "FILE_NOT_FOUND":
-        close_progress_window()
-        messagebox.showerror("文件不存在", "要下载的文件不存在！")
-    elif message == "DOWNLOAD_COMPLETE":
-        close_progress_window()
-        messagebox.showinfo("下载完成", "文件下载完成！")
-    else:
-        chat_box.config(state="normal")
-        parts = message.split(": ", 1)
-        if len(parts) > 1:
-            username, text = parts
-            chat_box.insert(tk.END, username, "username")
-            chat_box.insert(tk.END, ": " + text + "\n")
-        else:
-            chat_box.insert(tk.END, message + "\n")
-        chat_box.see(tk.END) 
-        chat_box.config(state="disabled")
+    channel = channel.strip().lstrip("#")
+    joining = client.submit(client.aio.join(channel))
+    joining.add_done_callback(lambda future: post_ui(channel_joined, channel, future))
 
 
 
-def handle_file_list_message(message):
+def channel_joined(channel, future):
     try:
-        parts = message.split(":", 2)
-        if len(parts) >= 3:
-            data_length = int(parts[1])
-            json_data = parts[2]
-            while len(json_data.encode("utf-8")) < data_length:
-                more_data = client.recv(
-                    min(1024, data_length - len(json_data.encode("utf-8")))
-                ).decode("utf-8")
-                json_data += more_data
-            file_list_data = json.loads(json_data)
-            update_file_list(file_list_data["files"])
+        future.result()
     except Exception as e:
-        print(f"处理文件列表错误: {e}")
+        messagebox.showerror("加入频道失败", f"无法加入频道 #{channel}: {e}")
+        return
+    notebook.select(open_channel_view(channel).frame)
+
+
 
+def leave_channel(channel):
+    leaving = client.submit(client.aio.part(channel))
+    leaving.add_done_callback(lambda future: post_ui(channel_left, channel, future))
 
 
-def handle_file_info_message(message):
-    """处理文件信息消息"""
-    global current_download
+
+def channel_left(channel, future):
     try:
-        parts = message.split(":", 2)
-        if len(parts) >= 3:
-            data_length = int(parts[1])
-            json_data = client.recv(data_length).decode("utf-8")
-            file_info = json.loads(json_data)
-            current_download = file_info
-            start_download_progress(file_info)
-            client.send("READY".encode("utf-8"))
+        future.result()
     except Exception as e:
-        print(f"处理文件信息错误: {e}")
+        messagebox.showerror("离开频道失败", f"无法离开频道 #{channel}: {e}")
+        return
+    view = chat_views.pop(channel, None)
+    if view is not None:
+        view.destroy()
 
 
 
-def handle_file_data_start(message):
-    global current_download
-    try:
-        if not current_download:
+def on_tab_changed(event=None):
+    """Uploads are announced in the channel whose tab was looked at last"""
+    selected = notebook.select()
+    if selected == str(direct_view.frame):
+        notebook.tab(direct_view.frame, text="私信")
+        return
+    for channel, view in chat_views.items():
+        if str(view.frame) == selected:
+            if client is not None and not client.closed:
+                client.submit(client.aio.focus(channel))
             return
-        file_size = int(message.split(":")[1])
-        compressed_data = b""
-        bytes_received = 0
-        while bytes_received < file_size:
-            chunk_size = min(BUFFER_SIZE, file_size - bytes_received)
-            chunk = client.recv(chunk_size)
-            if not chunk:
-                break
-            compressed_data += chunk
-            bytes_received += len(chunk)
-            progress = int((bytes_received / file_size) * 100)
-            update_progress("下载中", progress)
-        save_received_file(compressed_data)
+
+
+
+STAGE_LABELS = {
+    "hash": "检查服务器是否已有该文件",
+    "compress": "压缩中",
+    "upload": "上传中",
+    "parallel_upload": "并行上传中",
+    "confirm": "等待服务器确认",
+    "download": "下载中",
+    "parallel_download": "并行下载中",
+}
+
+
+
+def connection_closed(error):
+    """on_close of the ChatClient; error is None when the client closed it"""
+    if error is None:
+        return
+    print(f"与服务器的连接已断开: {error}")
+    if isinstance(error, ConnectionError):
+        post_ui(connection_lost, "连接断开", "与服务器的连接已断开！")
+    else:
+        post_ui(connection_lost, "错误", f"与服务器通信时发生错误: {error}")
+
+
+
+def connection_lost(title, text):
+    messagebox.showerror(title, text)
+    root.quit()
+
+
+
+def handle_single_message(message):
+    """Server messages no request was waiting for"""
+    if message.startswith(REPLY_PREFIXES):
+        return  # Replies to a transfer that was cancelled
+    display_chat_message(message)
+
+
+
+def display_chat_message(message, channel=DEFAULT_CHANNEL):
+    view = chat_views.get(channel) or open_channel_view(channel)
+    parts = message.split(": ", 1)
+    if len(parts) > 1:
+        username, text = parts
+        view.append(username, "username")
+        view.append(": " + text + "\n")
+    else:
+        view.append(message + "\n")
+
+
+
+def display_direct_message(message):
+    """A direct message to this user; answering goes to its sender unless another recipient is typed in"""
+    sent_at = time.strftime("%H:%M", time.localtime(message["time"]))
+    direct_view.append(f"[{sent_at}] ")
+    direct_view.append(message["from"], "username")
+    direct_view.append(f": {message['text']}\n")
+    if message.get("offline"):
+        direct_view.append("（离线时收到）\n", "history")
+    if not direct_view.recipient_box.get().strip():
+        direct_view.recipient_box.insert(0, message["from"])
+    if notebook.select() != str(direct_view.frame):
+        notebook.tab(direct_view.frame, text="私信 *")
+
+
+
+def direct_message_sent(recipient, text, future):
+    try:
+        delivered = future.result()
     except Exception as e:
-        print(f"处理文件数据错误: {e}")
-        close_progress_window()
-        messagebox.showerror("下载错误", f"文件下载失败: {e}")
+        direct_view.append(f"发给 {recipient} 的私信未发送: {e}\n", "system")
+        return
+    direct_view.append(f"[{time.strftime('%H:%M')}] 我 → ")
+    direct_view.append(recipient, "username")
+    direct_view.append(f": {text}\n")
+    if not delivered:
+        direct_view.append(f"{recipient} 当前不在线，将在其下次登录时送达\n", "system")
 
 
 
-def send(event=None):
-    message = input_box.get()
-    if message.strip():
-        input_box.delete(0, tk.END)
-        full_message = f"{nickname}: {message}"
-        client.send(full_message.encode("utf-8"))
+def handle_history_message(history):
+    """Show chat lines sent before this client connected, greyed out"""
+    if not history["messages"]:
+        return
+    for entry in history["messages"]:
+        sent_at = time.strftime("%m-%d %H:%M", time.localtime(entry["time"]))
+        append_chat(f"[{sent_at}] {entry['text']}\n", "history")
+    append_chat("—— 以上为历史消息 ——\n", "history")
 
 
 
 notebook = ttk.Notebook(root)
 notebook.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
-chat_frame = tk.Frame(notebook)
-notebook.add(chat_frame, text="聊天")
-chat_box = tk.Text(chat_frame, state="disabled", height=15)
-chat_box.tag_config("username", foreground="green")
-chat_box.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
-input_frame = tk.Frame(chat_frame)
-input_frame.pack(fill=tk.X, padx=5, pady=5)
-input_box = tk.Entry(input_frame)
-input_box.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=(0, 5))
-send_button = tk.Button(input_frame, text="发送", command=send)
-send_button.pack(side=tk.LEFT)
-input_box.bind("<Return>", send)
+chat_views[DEFAULT_CHANNEL] = ChatView(DEFAULT_CHANNEL)
+notebook.add(chat_views[DEFAULT_CHANNEL].frame, text="聊天")
+direct_view = DirectMessageView()
+notebook.add(direct_view.frame, text="私信")
+notebook.bind("<<NotebookTabChanged>>", on_tab_changed)
 file_transfer_frame = tk.Frame(notebook)
 notebook.add(file_transfer_frame, text="文件传输")
 main_file_frame = tk.Frame(file_transfer_frame)
@@ -354,27 +572,50 @@ download_button.pack(fill=tk.X)
 
 def connect_to_server():
     global client
+    client = ChatClient(
+        SERVER_HOST,
+        SERVER_PORT,
+        nickname,
+        SERVER_PASSWORD,
+        on_chat=lambda text: post_ui(display_chat_message, text),
+        on_channel_chat=lambda channel, text: post_ui(display_chat_message, text, channel),
+        on_direct_message=lambda message: post_ui(display_direct_message, message),
+        on_message=lambda message: post_ui(handle_single_message, message),
+        on_history=lambda history: post_ui(handle_history_message, history),
+        on_close=connection_closed,
+    )
+    connecting = client.submit(client.aio.connect())
+    connecting.add_done_callback(lambda future: post_ui(finish_connecting, future))
+
+
+
+def finish_connecting(future):
     try:
-        client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        client.settimeout(10)
-        client.connect((SERVER_HOST, SERVER_PORT))
-        client.settimeout(None)
-        receive_thread = threading.Thread(target=receive, daemon=True)
-        receive_thread.start()
-    except socket.timeout:
+        future.result()
+    except (TimeoutError, asyncio.TimeoutError):
         messagebox.showerror("连接超时", f"连接到服务器 {SERVER_HOST}:{SERVER_PORT} 超时！\n请检查服务器是否正在运行。")
         root.quit()
     except ConnectionRefusedError:
         messagebox.showerror("连接被拒绝", f"无法连接到服务器 {SERVER_HOST}:{SERVER_PORT}！\n请检查服务器地址和端口是否正确。")
         root.quit()
+    except AuthenticationError:
+        messagebox.showerror("认证失败", "服务器密码验证失败！请检查密码是否正确。")
+        root.quit()
     except Exception as e:
         messagebox.showerror("连接错误", f"无法连接到服务器: {e}")
         root.quit()
+    else:
+        auth_info = "无密码" if not SERVER_PASSWORD else "已验证密码"
+        append_chat(
+            f"已成功连接到服务器 {SERVER_HOST}:{SERVER_PORT} ({auth_info}) 昵称：{nickname}\n",
+            "system",
+        )
+        root.after(1000, refresh_file_list)
 
 
 
-chat_box.tag_config("system", foreground="blue")
 root.after(100, connect_to_server)
+root.after(UI_PUMP_INTERVAL, pump_ui_events)
 
 
 
@@ -389,7 +630,11 @@ def format_file_size(size_bytes):
 
 
 def upload_file():
+    global current_transfer
     try:
+        if current_transfer is not None:
+            messagebox.showwarning("正在传输", "请等待当前文件传输完成或取消后再上传")
+            return
         file_path = filedialog.askopenfilename(
             title=f"选择要上传的文件 (最大 {MAX_FILE_SIZE // (1024*1024)} MB)",
             filetypes=[("所有文件", "*.*")],
@@ -404,43 +649,90 @@ def upload_file():
                     f"请选择更小的文件。",
                 )
                 return
-            with open(file_path, "rb") as f:
-                file_data = f.read()
-            compressed_data = gzip.compress(file_data)
-            compression_ratio = (1 - len(compressed_data) / len(file_data)) * 100
-            show_progress_window("上传文件", filename)
-            upload_message = f"UPLOAD_FILE:{filename}:{len(compressed_data)}:"
-            client.send(upload_message.encode("utf-8"))
-            bytes_sent = 0
-            total_size = len(compressed_data)
-            while bytes_sent < total_size:
-                chunk_size = min(BUFFER_SIZE, total_size - bytes_sent)
-                chunk = compressed_data[bytes_sent : bytes_sent + chunk_size]
-                client.send(chunk)
-                bytes_sent += chunk_size
-                progress = int((bytes_sent / total_size) * 100)
-                update_progress("上传中", progress)
-                root.update_idletasks()
-            update_progress("等待服务器确认", 100)
-            chat_box.config(state="normal")
-            chat_box.insert(
-                tk.END,
-                f"文件上传完成: {filename} (原始: {format_file_size(len(file_data))}, 压缩: {format_file_size(len(compressed_data))}, 压缩率: {compression_ratio:.1f}%)\n",
-                "system",
-            )
-            chat_box.see(tk.END)
-            chat_box.config(state="disabled")
+            transfer = Transfer(report_stage)
+            current_transfer = transfer
+            show_progress_window("上传文件", filename, on_cancel=cancel_transfer)
+            uploading = client.submit(client.aio.upload(file_path, transfer))
+            uploading.add_done_callback(lambda future: post_ui(finish_upload, transfer, filename, future))
     except Exception as e:
+        current_transfer = None
         close_progress_window()
         messagebox.showerror("上传错误", f"文件上传失败: {e}")
 
 
 
+def report_stage(stage, progress):
+    """on_progress of a Transfer, called from the client library's threads"""
+    report_progress(STAGE_LABELS[stage], progress)
+
+
+
+def cancel_transfer():
+    """Cancel button of the progress window"""
+    global current_transfer
+    if current_transfer is not None:
+        if not current_transfer.cancel():
+            messagebox.showinfo("无法取消", "服务器使用旧版协议，上传开始后无法取消，请等待完成")
+            return
+        current_transfer = None
+    close_progress_window()
+
+
+
+def end_transfer(transfer):
+    """Close the progress window if it still shows transfer; False if it was cancelled"""
+    global current_transfer
+    if current_transfer is not transfer:
+        return False
+    current_transfer = None
+    close_progress_window()
+    return True
+
+
+
+def finish_upload(transfer, filename, future):
+    try:
+        upload = future.result()
+    except TransferCancelled:
+        # The server keeps the chunks it acknowledged, uploading the file again continues from there
+        append_chat(f"已取消上传: {filename}\n", "system")
+        return
+    except Exception as e:
+        if end_transfer(transfer):
+            messagebox.showerror("上传失败", f"文件上传失败！\n{e}")
+        return
+    if not end_transfer(transfer):
+        return
+    show_upload_summary(upload)
+    messagebox.showinfo("上传成功", "文件上传成功！")
+    notebook.select(file_transfer_frame)
+    refresh_file_list()
+
+
+
+def show_upload_summary(upload):
+    if upload.compressed_size is not None:
+        compression_ratio = (1 - upload.compressed_size / upload.size) * 100 if upload.size else 0
+        summary = f"文件上传完成: {upload.filename} (原始: {format_file_size(upload.size)}, 压缩: {format_file_size(upload.compressed_size)}, 压缩率: {compression_ratio:.1f}%, 编码: {upload.codec})\n"
+    else:
+        summary = f"文件上传完成: {upload.filename} (原始: {format_file_size(upload.size)}, 服务器已有相同内容，无需传输)\n"
+    append_chat(summary, "system")
+
+
+
 def refresh_file_list():
+    listing = client.submit(client.aio.list_files())
+    listing.add_done_callback(lambda future: post_ui(show_file_list, future))
+
+
+
+def show_file_list(future):
     try:
-        client.send("GET_FILE_LIST".encode("utf-8"))
+        files = future.result()
     except Exception as e:
         messagebox.showerror("刷新错误", f"刷新文件列表失败: {e}")
+        return
+    update_file_list(files)
 
 
 
@@ -457,8 +749,11 @@ def update_file_list(files):
 
 
 def download_file():
-    global download_save_path
+    global current_transfer
     try:
+        if current_transfer is not None:
+            messagebox.showwarning("正在传输", "请等待当前文件传输完成或取消后再下载")
+            return
         selection = file_listbox.curselection()
         if not selection:
             messagebox.showwarning("选择文件", "请先选择要下载的文件")
@@ -472,31 +767,28 @@ def download_file():
                 if "_" in unique_filename
                 else unique_filename
             )
-            download_save_path = filedialog.asksaveasfilename(
+            save_path = filedialog.asksaveasfilename(
                 title="选择下载保存位置",
                 initialfile=original_filename,
                 defaultextension="",
                 filetypes=[("所有文件", "*.*")],
             )
-            if not download_save_path:
+            if not save_path:
                 return 
-            download_message = f"DOWNLOAD_FILE:{unique_filename}"
-            client.send(download_message.encode("utf-8"))
-            chat_box.config(state="normal")
-            chat_box.insert(
-                tk.END,
-                f"正在下载文件: {file_info['filename']} 到 {download_save_path}\n",
-                "system",
-            )
-            chat_box.see(tk.END)
-            chat_box.config(state="disabled")
+            transfer = Transfer(report_stage)
+            current_transfer = transfer
+            show_progress_window("下载文件", file_info["filename"], on_cancel=cancel_transfer)
+            downloading = client.submit(client.aio.download(file_info, save_path, transfer))
+            downloading.add_done_callback(lambda future: post_ui(download_finished, transfer, save_path, future))
+            append_chat(f"正在下载文件: {file_info['filename']} 到 {save_path}\n", "system")
     except Exception as e:
+        current_transfer = None
+        close_progress_window()
         messagebox.showerror("下载错误", f"文件下载失败: {e}")
-        download_save_path = None
 
 
 
-def show_progress_window(title, filename):
+def show_progress_window(title, filename, on_cancel=None):
     global progress_window
     progress_window = tk.Toplevel(root)
     progress_window.title(title)
@@ -512,8 +804,9 @@ def show_progress_window(title, filename):
     progress_window.progress_label = tk.Label(progress_window, text="0%")
     progress_window.progress_label.pack(pady=5)
     cancel_button = tk.Button(
-        progress_window, text="取消", command=close_progress_window
+        progress_window, text="取消", command=on_cancel or close_progress_window
     )
+    progress_window.protocol("WM_DELETE_WINDOW", on_cancel or close_progress_window)
     cancel_button.pack(pady=10)
     progress_window.transient(root)
     progress_window.grab_set()
@@ -521,58 +814,69 @@ def show_progress_window(title, filename):
 
 
 def update_progress(operation, progress):
-    if progress_window:
-        progress_window.progress_var.set(progress)
-        progress_window.progress_label.config(text=f"{operation}: {progress}%")
-        progress_window.update()
+    """Redraw the progress bar, at most every PROGRESS_INTERVAL except for the final state"""
+    global last_progress_draw
+    if not progress_window:
+        return
+    now = time.monotonic()
+    if progress < 100 and now - last_progress_draw < PROGRESS_INTERVAL:
+        report_progress(operation, progress)  # Drawn by a later pump if nothing newer comes
+        return
+    last_progress_draw = now
+    progress_window.progress_var.set(progress)
+    progress_window.progress_label.config(text=f"{operation}: {progress}%")
+    progress_window.update_idletasks()
+
+
+
+def report_progress(operation, progress):
+    """Progress from any thread; only the latest value is drawn"""
+    global latest_progress
+    with progress_lock:
+        latest_progress = (operation, progress)
+
+
+
+def draw_latest_progress():
+    global latest_progress
+    with progress_lock:
+        progress, latest_progress = latest_progress, None
+    if progress is not None:
+        update_progress(*progress)
 
 
 
 def close_progress_window():
-    global progress_window
+    global progress_window, latest_progress
+    with progress_lock:
+        latest_progress = None
     if progress_window:
         progress_window.destroy()
         progress_window = None
 
 
 
-def start_download_progress(file_info):
-    show_progress_window("下载文件", file_info["filename"])
-
-
-
-def save_received_file(compressed_data):
-    global current_download, download_save_path
+def download_finished(transfer, path, future):
     try:
-        if not current_download or not download_save_path:
-            return
-        file_data = gzip.decompress(compressed_data)
-        with open(download_save_path, "wb") as f:
-            f.write(file_data)
-        close_progress_window()
-        compression_ratio = (
-            1 - current_download["compressed_size"] / current_download["size"]
-        ) * 100
-        messagebox.showinfo(
-            "下载完成",
-            f"文件已保存到: {download_save_path}\n"
-            f"原始大小: {format_file_size(current_download['size'])}\n"
-            f"压缩大小: {format_file_size(current_download['compressed_size'])}\n"
-            f"压缩率: {compression_ratio:.1f}%",
-        )
-        chat_box.config(state="normal")
-        chat_box.insert(
-            tk.END, f"文件下载完成: {os.path.basename(download_save_path)}\n", "system"
-        )
-        chat_box.see(tk.END)
-        chat_box.config(state="disabled")
-        current_download = None
-        download_save_path = None
+        download = future.result()
+    except TransferCancelled:
+        return
     except Exception as e:
-        close_progress_window()
-        messagebox.showerror("保存错误", f"文件保存失败: {e}")
-        current_download = None
-        download_save_path = None
+        if end_transfer(transfer):
+            messagebox.showerror("下载错误", f"文件下载失败: {e}")
+        return
+    end_transfer(transfer)
+    compression_ratio = (
+        1 - download["compressed_size"] / download["size"]
+    ) * 100 if download["size"] else 0
+    messagebox.showinfo(
+        "下载完成",
+        f"文件已保存到: {path}\n"
+        f"原始大小: {format_file_size(download['size'])}\n"
+        f"压缩大小: {format_file_size(download['compressed_size'])}\n"
+        f"压缩率: {compression_ratio:.1f}%",
+    )
+    append_chat(f"文件下载完成: {os.path.basename(path)}\n", "system")
 
 
 
@@ -0,0 +1,131 @@
+"""Compressed-at-rest renditions of uploaded files for the download path.
+
+Renditions are compressed files named after the stored file's
+unique_filename, size, mtime and codec, so a file that changes on disk
+simply misses the cache. Files sent with the "none" codec need no
+rendition and are never cached.
+The directory is bounded by a size cap with least-recently-used eviction.
+"""
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+from transfer_codecs import DEFAULT_CODEC, SUFFIXES, compressor
+
+TEMP_PREFIX = ".tmp_"
+
+
+class CompressedCache:
+    """LRU cache of compressed renditions keyed by unique_filename plus size, mtime and codec"""
+
+    def __init__(self, cache_dir, max_size, compress_level=6, buffer_size=65536):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.compress_level = compress_level
+        self.buffer_size = buffer_size
+        self.entries = OrderedDict()  # rendition name -> size, least recently used first
+        self.total_size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        self._load()
+
+    @property
+    def enabled(self):
+        return self.max_size > 0
+
+    def _load(self):
+        existing = []
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if name.startswith(TEMP_PREFIX):
+                # Left behind by a rendition that was being written when the server stopped
+                os.remove(path)
+                continue
+            stats = os.stat(path)
+            existing.append((stats.st_atime, name, stats.st_size))
+        with self.lock:
+            for _, name, size in sorted(existing):
+                self.entries[name] = size
+                self.total_size += size
+            self._evict()
+
+    @staticmethod
+    def key(unique_filename, stats, codec=DEFAULT_CODEC):
+        return f"{unique_filename}.{stats.st_size}.{stats.st_mtime_ns}{SUFFIXES[codec]}"
+
+    def open(self, unique_filename, stats, codec=DEFAULT_CODEC):
+        """Open the cached rendition for reading, or return None on a miss"""
+        name = self.key(unique_filename, stats, codec)
+        path = os.path.join(self.cache_dir, name)
+        with self.lock:
+            if name not in self.entries:
+                try:
+                    # Written by another worker process sharing the directory
+                    size = os.path.getsize(path)
+                except OSError:
+                    self.misses += 1
+                    return None
+                self.entries[name] = size
+                self.total_size += size
+            self.entries.move_to_end(name)
+            self.hits += 1
+        try:
+            return open(path, "rb")
+        except OSError:
+            with self.lock:
+                self.total_size -= self.entries.pop(name, 0)
+            return None
+
+    def create_temp(self):
+        """Return (file, path) for a rendition that is about to be written"""
+        fd, path = tempfile.mkstemp(prefix=TEMP_PREFIX, dir=self.cache_dir)
+        return os.fdopen(fd, "wb"), path
+
+    def discard_temp(self, temp_path):
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+    def commit(self, temp_path, unique_filename, stats, codec=DEFAULT_CODEC):
+        """Move a finished rendition into the cache and return it opened for reading"""
+        name = self.key(unique_filename, stats, codec)
+        path = os.path.join(self.cache_dir, name)
+        os.replace(temp_path, path)
+        # Opened before eviction so an oversized rendition can still be served once
+        rendition = open(path, "rb")
+        size = os.fstat(rendition.fileno()).st_size
+        with self.lock:
+            self.total_size -= self.entries.pop(name, 0)
+            self.entries[name] = size
+            self.total_size += size
+            self._evict()
+        return rendition
+
+    def build(self, unique_filename, source_path, stats, codec=DEFAULT_CODEC):
+        """Compress a stored file into the cache, for the first download of a file"""
+        temp_file, temp_path = self.create_temp()
+        stream = compressor(codec, self.compress_level)
+        try:
+            with temp_file, open(source_path, "rb") as source:
+                while True:
+                    block = source.read(self.buffer_size)
+                    if not block:
+                        break
+                    temp_file.write(stream.compress(block))
+                temp_file.write(stream.flush())
+        except Exception:
+            self.discard_temp(temp_path)
+            raise
+        return self.commit(temp_path, unique_filename, stats, codec)
+
+    def _evict(self):
+        while self.total_size > self.max_size and self.entries:
+            name, size = self.entries.popitem(last=False)
+            self.total_size -= size
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except OSError:
+                pass  # Still open for a download on Windows; dropped again on next start
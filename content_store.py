@@ -0,0 +1,101 @@
+"""Content-addressed storage for deduplicated uploads.
+
+Each distinct file content is stored once, named after its SHA-256 digest.
+Catalog entries refer to a blob through their "sha256" field, and a blob
+is deleted when the last entry referring to it is removed. Reference
+counts are rebuilt from the catalog at startup, so they never have to be
+written to disk.
+"""
+import os
+import string
+import threading
+
+DIGEST_LENGTH = 64
+
+
+def is_digest(value):
+    return len(value) == DIGEST_LENGTH and all(c in string.hexdigits for c in value)
+
+
+class BlobStore:
+    """Blobs in blob_dir named by lowercase hex SHA-256, with reference counts"""
+
+    def __init__(self, blob_dir):
+        self.blob_dir = blob_dir
+        self.refcounts = {}  # digest -> number of catalog entries using the blob
+        self.lock = threading.Lock()
+
+    def path(self, digest):
+        if not is_digest(digest):
+            raise ValueError(f"invalid digest: {digest!r}")
+        return os.path.join(self.blob_dir, digest.lower())
+
+    def exists(self, digest):
+        return os.path.isfile(self.path(digest))
+
+    def rebuild(self, records):
+        """Count references from catalog records and delete blobs nobody refers to"""
+        refcounts = {}
+        for file_info in records:
+            digest = file_info.get("sha256")
+            if digest:
+                refcounts[digest] = refcounts.get(digest, 0) + 1
+        orphans = 0
+        with self.lock:
+            self.refcounts = refcounts
+            if os.path.isdir(self.blob_dir):
+                for name in os.listdir(self.blob_dir):
+                    if name not in refcounts:
+                        os.remove(os.path.join(self.blob_dir, name))
+                        orphans += 1
+        return orphans
+
+    def store(self, temp_path, digest):
+        """Take a reference on the blob for digest, filling it from temp_path if it is new.
+
+        temp_path is consumed either way. Returns True if the content was new.
+        """
+        path = self.path(digest)
+        with self.lock:
+            if digest in self.refcounts and os.path.isfile(path):
+                os.remove(temp_path)  # Duplicate content, nothing more to keep on disk
+                self.refcounts[digest] += 1
+                return False
+            os.makedirs(self.blob_dir, exist_ok=True)
+            os.replace(temp_path, path)
+            self.refcounts[digest] = self.refcounts.get(digest, 0) + 1
+            return True
+
+    def add_reference(self, digest, size):
+        """Take a reference on an existing blob of the given size, for an upload announced by hash"""
+        if not is_digest(digest):
+            return False
+        path = self.path(digest)
+        with self.lock:
+            if digest not in self.refcounts:
+                return False
+            try:
+                if os.path.getsize(path) != size:
+                    return False
+            except OSError:
+                return False
+            self.refcounts[digest] += 1
+            return True
+
+    def retain(self, digest):
+        """Count a reference that another worker process took on a blob"""
+        with self.lock:
+            self.refcounts[digest] = self.refcounts.get(digest, 0) + 1
+
+    def release(self, digest):
+        """Drop one reference; the blob is deleted with its last reference"""
+        with self.lock:
+            count = self.refcounts.get(digest, 0) - 1
+            if count > 0:
+                self.refcounts[digest] = count
+                return
+            self.refcounts.pop(digest, None)
+            try:
+                os.remove(self.path(digest))
+            except OSError:
+                pass  # Already gone, or still open for a download on Windows
@@ -0,0 +1,58 @@
+"""Bounded mailboxes holding direct messages for users who are offline."""
+import threading
+from collections import OrderedDict, deque
+
+
+class Mailboxes:
+    """Direct messages waiting for their recipient's next login, by nickname.
+
+    A mailbox keeps the newest `size` messages. Past `max_users` mailboxes
+    the one written to longest ago is dropped, so messages to nicknames
+    that never log in cannot grow memory without bound.
+    """
+
+    def __init__(self, size=50, max_users=10000):
+        self.size = size
+        self.max_users = max_users
+        self.boxes = OrderedDict()  # nickname -> deque of messages, least recently written first
+        self.lock = threading.Lock()
+        self.queued = 0
+        self.dropped = 0
+
+    def __len__(self):
+        return self.queued
+
+    def put(self, nickname, message):
+        """Queue message for nickname; False if that pushed an older message out"""
+        with self.lock:
+            box = self.boxes.get(nickname)
+            if box is None:
+                box = self.boxes[nickname] = deque()
+                while len(self.boxes) > self.max_users:
+                    _, evicted = self.boxes.popitem(last=False)
+                    self.queued -= len(evicted)
+                    self.dropped += len(evicted)
+            else:
+                self.boxes.move_to_end(nickname)
+            box.append(message)
+            self.queued += 1
+            if len(box) <= self.size:
+                return True
+            box.popleft()
+            self.queued -= 1
+            self.dropped += 1
+            return False
+
+    def nicknames(self):
+        """Nicknames with messages waiting"""
+        with self.lock:
+            return list(self.boxes)
+
+    def take(self, nickname):
+        """Empty nickname's mailbox, returning its messages oldest first"""
+        with self.lock:
+            box = self.boxes.pop(nickname, None)
+            if not box:
+                return []
+            self.queued -= len(box)
+            return list(box)
@@ -0,0 +1,111 @@
+"""In-memory index of stored files with a cached FILE_LIST response."""
+import bisect
+import json
+import threading
+
+
+class FileCatalog:
+    """Stored files keyed by unique_filename, indexed by uploader and upload time.
+
+    The serialized FILE_LIST message is built once and reused until the
+    catalog changes, so listing files costs nothing while it is unchanged.
+    """
+
+    def __init__(self):
+        self.files = {}  # unique_filename -> file info
+        self.by_uploader = {}  # uploader -> set of unique_filename
+        self.by_time = []  # sorted (upload_time, unique_filename)
+        self.version = 0
+        self.lock = threading.RLock()
+        self._list_message = None
+
+    def __len__(self):
+        return len(self.files)
+
+    def __contains__(self, unique_filename):
+        return unique_filename in self.files
+
+    def get(self, unique_filename):
+        return self.files.get(unique_filename)
+
+    def _index(self, file_info):
+        unique_filename = file_info["unique_filename"]
+        self.files[unique_filename] = file_info
+        self.by_uploader.setdefault(file_info["uploader"], set()).add(unique_filename)
+        bisect.insort(self.by_time, (file_info["upload_time"], unique_filename))
+
+    def _unindex(self, unique_filename):
+        file_info = self.files.pop(unique_filename)
+        names = self.by_uploader.get(file_info["uploader"])
+        if names is not None:
+            names.discard(unique_filename)
+            if not names:
+                del self.by_uploader[file_info["uploader"]]
+        key = (file_info["upload_time"], unique_filename)
+        index = bisect.bisect_left(self.by_time, key)
+        if index < len(self.by_time) and self.by_time[index] == key:
+            del self.by_time[index]
+        return file_info
+
+    def _changed(self):
+        self.version += 1
+        self._list_message = None
+
+    def add(self, file_info):
+        """Add or replace the entry for file_info["unique_filename"]"""
+        with self.lock:
+            if file_info["unique_filename"] in self.files:
+                self._unindex(file_info["unique_filename"])
+            self._index(file_info)
+            self._changed()
+
+    def remove(self, unique_filename):
+        """Remove an entry, returning its file info or None if it was not catalogued"""
+        with self.lock:
+            if unique_filename not in self.files:
+                return None
+            file_info = self._unindex(unique_filename)
+            self._changed()
+            return file_info
+
+    def replace_all(self, records):
+        with self.lock:
+            self.files = {}
+            self.by_uploader = {}
+            for file_info in records:
+                self.files[file_info["unique_filename"]] = file_info
+                self.by_uploader.setdefault(file_info["uploader"], set()).add(
+                    file_info["unique_filename"]
+                )
+            self.by_time = sorted(
+                (file_info["upload_time"], name) for name, file_info in self.files.items()
+            )
+            self._changed()
+
+    def records(self):
+        """All entries, oldest upload first"""
+        with self.lock:
+            return [self.files[name] for _, name in self.by_time]
+
+    def newest_first(self):
+        with self.lock:
+            return [self.files[name] for _, name in reversed(self.by_time)]
+
+    def uploaded_by(self, uploader):
+        """Entries from one uploader, newest first"""
+        with self.lock:
+            names = self.by_uploader.get(uploader, ())
+            return sorted(
+                (self.files[name] for name in names),
+                key=lambda file_info: file_info["upload_time"],
+                reverse=True,
+            )
+
+    def list_message(self):
+        """The FILE_LIST:<length>:<json> response, rebuilt only after a change"""
+        with self.lock:
+            if self._list_message is None:
+                file_list = {"type": "file_list", "files": self.newest_first()}
+                message = json.dumps(file_list).encode("utf-8")
+                self._list_message = f"FILE_LIST:{len(message)}:".encode("utf-8") + message
+            return self._list_message
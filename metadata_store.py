@@ -0,0 +1,200 @@
+"""Persistent stores for file metadata.
+
+Every change is written on its own, so recording one upload costs the same
+I/O no matter how many files are stored. Two backends are available:
+
+    journal  append-only JSON lines, compacted once most lines are stale
+    sqlite   sqlite3 database in WAL mode, indexed on uploader and upload time
+
+Both import the legacy file_metadata.json the first time they start and
+rename it to file_metadata.json.imported afterwards. Both can be shared
+by the worker processes of a multi-process server: sqlite locks the
+database, and a shared journal appends each entry with a single write and
+is only compacted when a store is opened unshared.
+"""
+import json
+import os
+import sqlite3
+import threading
+
+METADATA_PREFIX = "file_metadata."
+LEGACY_FILE = "file_metadata.json"
+JOURNAL_FILE = "file_metadata.journal"
+SQLITE_FILE = "file_metadata.db"
+BACKENDS = ("journal", "sqlite")
+
+
+def is_metadata_file(filename):
+    """True for the legacy JSON file and every file belonging to a store"""
+    return filename.startswith(METADATA_PREFIX)
+
+
+def read_legacy_metadata(directory):
+    """Records from file_metadata.json, or None when there is nothing to import"""
+    path = os.path.join(directory, LEGACY_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def retire_legacy_metadata(directory):
+    path = os.path.join(directory, LEGACY_FILE)
+    if os.path.exists(path):
+        os.replace(path, path + ".imported")
+
+
+class JournalStore:
+    """Append-only journal of add/remove entries with periodic compaction"""
+
+    def __init__(self, directory, compact_min_entries=1000, shared=False):
+        self.path = os.path.join(directory, JOURNAL_FILE)
+        self.compact_min_entries = compact_min_entries
+        self.shared = shared
+        self.files = {}  # unique_filename -> file info, the journal replayed
+        self.entries = 0
+        self.journal = None
+        self.lock = threading.Lock()
+        if os.path.exists(self.path):
+            self._replay()
+            if self._needs_compaction():
+                self._compact()
+            else:
+                self.journal = open(self.path, "ab", buffering=0)
+        else:
+            legacy = read_legacy_metadata(directory) or []
+            for file_info in legacy:
+                self.files[file_info["unique_filename"]] = file_info
+            self._compact()
+            retire_legacy_metadata(directory)
+
+    def _replay(self):
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue  # Torn last line from a crash while appending
+                self.entries += 1
+                if entry["op"] == "add":
+                    file_info = entry["file"]
+                    self.files[file_info["unique_filename"]] = file_info
+                elif entry["op"] == "remove":
+                    self.files.pop(entry["unique_filename"], None)
+
+    def _compact(self):
+        """Rewrite the journal with one add entry per live record"""
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            for file_info in self.files.values():
+                f.write(json.dumps({"op": "add", "file": file_info}, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        if self.journal is not None:
+            self.journal.close()
+        os.replace(temp_path, self.path)
+        self.journal = open(self.path, "ab", buffering=0)
+        self.entries = len(self.files)
+
+    def _needs_compaction(self):
+        # Other processes keep appending to a shared journal, it must not be replaced under them
+        return not self.shared and self.entries > max(self.compact_min_entries, 2 * len(self.files))
+
+    def _append(self, entry):
+        # One unbuffered write per entry, so appends from several processes never interleave
+        self.journal.write((json.dumps(entry, ensure_ascii=False) + "\n").encode("utf-8"))
+        self.entries += 1
+        if self._needs_compaction():
+            self._compact()
+
+    def load(self):
+        with self.lock:
+            return list(self.files.values())
+
+    def add(self, file_info):
+        with self.lock:
+            self.files[file_info["unique_filename"]] = file_info
+            self._append({"op": "add", "file": file_info})
+
+    def remove(self, unique_filename):
+        with self.lock:
+            # Journaled even if unknown here, it may have been added by another process
+            self.files.pop(unique_filename, None)
+            self._append({"op": "remove", "unique_filename": unique_filename})
+
+    def close(self):
+        with self.lock:
+            self.journal.close()
+
+
+class SqliteStore:
+    """sqlite3 database in WAL mode; the full record is kept as JSON next to indexed columns"""
+
+    def __init__(self, directory):
+        self.path = os.path.join(directory, SQLITE_FILE)
+        created = not os.path.exists(self.path)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        with self.db:
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS files ("
+                "unique_filename TEXT PRIMARY KEY, "
+                "uploader TEXT NOT NULL, "
+                "upload_time TEXT NOT NULL, "
+                "info TEXT NOT NULL)"
+            )
+            self.db.execute("CREATE INDEX IF NOT EXISTS files_uploader ON files (uploader)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS files_upload_time ON files (upload_time)")
+        if created:
+            legacy = read_legacy_metadata(directory)
+            if legacy:
+                with self.db:
+                    self.db.executemany(
+                        "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)",
+                        [self._row(file_info) for file_info in legacy],
+                    )
+            retire_legacy_metadata(directory)
+
+    @staticmethod
+    def _row(file_info):
+        return (
+            file_info["unique_filename"],
+            file_info["uploader"],
+            file_info["upload_time"],
+            json.dumps(file_info, ensure_ascii=False),
+        )
+
+    def load(self):
+        with self.lock:
+            rows = self.db.execute("SELECT info FROM files ORDER BY upload_time").fetchall()
+        return [json.loads(info) for (info,) in rows]
+
+    def uploaded_by(self, uploader):
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT info FROM files WHERE uploader = ? ORDER BY upload_time DESC",
+                (uploader,),
+            ).fetchall()
+        return [json.loads(info) for (info,) in rows]
+
+    def add(self, file_info):
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)", self._row(file_info)
+            )
+
+    def remove(self, unique_filename):
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM files WHERE unique_filename = ?", (unique_filename,))
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+def open_metadata_store(backend, directory, shared=False):
+    if backend == "sqlite":
+        return SqliteStore(directory)
+    return JournalStore(directory, shared=shared)
@@ -0,0 +1,197 @@
+"""Parallel data connections for large transfers.
+
+A client asks for a transfer token on its chat connection with
+PARALLEL_DOWNLOAD:<unique_filename> or PARALLEL_UPLOAD:<sha256> and gets
+back TRANSFER_TOKEN:<token>:<streams>:<json>. It then opens up to <streams>
+extra connections that answer NICK with TRANSFER:<token> and are framed
+from then on. A download is split into byte ranges fetched with
+DOWNLOAD_RANGE, an upload into the chunks of a chunked upload sent with
+UPLOAD_CHUNK, so both reuse the single-connection commands.
+
+Nothing here depends on tkinter; callers pass a progress callback.
+"""
+import json
+import socket
+import threading
+
+from chunked_transfer import chunk_checksum
+from protocol import (
+    AUTH_SUCCESS_PREFIX,
+    FRAME_COMMAND,
+    FRAME_DATA,
+    FrameReader,
+    encode_frame,
+    offer_transfer,
+)
+
+
+def parse_transfer_grant(message):
+    """Split TRANSFER_TOKEN:<token>:<streams>:<json> into (token, streams, details)"""
+    _, token, streams, details = message.split(":", 3)
+    return token, int(streams), json.loads(details)
+
+
+def open_data_connection(host, port, token, timeout=30):
+    """Connect and redeem a transfer token, returning (socket, FrameReader)"""
+    sock = socket.create_connection((host, port), timeout=timeout)
+    try:
+        if sock.recv(1024) != b"NICK":
+            raise ConnectionError("unexpected greeting from server")
+        sock.sendall(offer_transfer(token).encode("utf-8"))
+        reply = b""
+        while b"\n" not in reply:
+            data = sock.recv(1024)
+            if not data:
+                raise ConnectionError("transfer token rejected by server")
+            reply += data
+        line, _, rest = reply.partition(b"\n")
+        if not line.startswith(AUTH_SUCCESS_PREFIX):
+            raise ConnectionError("transfer token rejected by server")
+        reader = FrameReader(sock)
+        reader.buffer.feed(rest)
+        return sock, reader
+    except Exception:
+        sock.close()
+        raise
+
+
+def split_ranges(total_size, streams):
+    """Split [0, total_size) into at most `streams` contiguous (start, end) ranges"""
+    streams = max(1, min(streams, total_size))
+    step = -(-total_size // streams)
+    return [(start, min(start + step, total_size)) for start in range(0, total_size, step)]
+
+
+class _Progress:
+    def __init__(self, callback):
+        self.callback = callback
+        self.done = 0
+        self.lock = threading.Lock()
+
+    def add(self, count):
+        with self.lock:
+            self.done += count
+            done = self.done
+        if self.callback:
+            self.callback(done)
+
+
+def _run_workers(target, assignments):
+    """Run target(assignment) on one thread each and re-raise the first failure"""
+    errors = []
+
+    def run(assignment):
+        try:
+            target(assignment)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=run, args=(a,), daemon=True) for a in assignments]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+
+
+def download_parallel(host, port, token, file_info, streams, on_progress=None, write_at=None):
+    """Fetch a file's compressed rendition over parallel ranges.
+
+    file_info is the FILE_INFO from the TRANSFER_TOKEN reply; every range
+    must come from a rendition with the same etag, so a rendition rebuilt
+    mid-transfer fails the download instead of mixing two streams.
+    Without write_at the rendition is returned as bytes; with it, every
+    received piece is passed to write_at(offset, data) from the thread
+    that received it, and nothing is kept in memory.
+    """
+    unique_filename = file_info["filename"]
+    total_size = file_info["compressed_size"]
+    buffer = None
+    if write_at is None:
+        buffer = bytearray(total_size)
+
+        def write_at(offset, data):
+            buffer[offset:offset + len(data)] = data
+
+    progress = _Progress(on_progress)
+
+    def fetch(byte_range):
+        start, end = byte_range
+        sock, reader = open_data_connection(host, port, token)
+        with sock:
+            request = f"DOWNLOAD_RANGE:bytes={start}-{end - 1}:{unique_filename}"
+            sock.sendall(encode_frame(FRAME_COMMAND, request.encode("utf-8")))
+            offset = None
+            while True:
+                frame_type, payload = reader.read_frame()
+                if frame_type == FRAME_DATA:
+                    if offset is None or offset + len(payload) > end:
+                        raise ValueError("unexpected data on data connection")
+                    write_at(offset, payload)
+                    offset += len(payload)
+                    progress.add(len(payload))
+                    continue
+                message = bytes(payload).decode("utf-8")
+                if message.startswith("FILE_INFO:"):
+                    range_info = json.loads(message.split(":", 2)[2])
+                    if range_info.get("etag") != file_info.get("etag"):
+                        raise ValueError("file changed during the transfer")
+                elif message.startswith("FILE_RANGE_START:"):
+                    _, range_start, count = message.split(":")
+                    if (int(range_start), int(count)) != (start, end - start):
+                        raise ValueError(f"server sent the wrong range: {message}")
+                    offset = start
+                elif message == "DOWNLOAD_COMPLETE":
+                    if offset != end:
+                        raise ValueError("range ended early")
+                    return
+                else:
+                    raise ValueError(f"download failed: {message}")
+
+    _run_workers(fetch, split_ranges(total_size, streams))
+    return None if buffer is None else bytes(buffer)
+
+
+def upload_parallel(host, port, token, upload_id, read_chunk, missing, streams, on_progress=None):
+    """Send the missing chunks of a chunked upload over parallel connections.
+
+    read_chunk(index) returns the bytes of one chunk and is called from
+    several threads. Returns once every chunk is acknowledged; the server
+    announces the finished upload (UPLOAD_SUCCESS) on the chat connection.
+    """
+    progress = _Progress(on_progress)
+    streams = max(1, min(streams, len(missing)))
+    assignments = [missing[i::streams] for i in range(streams)]
+
+    def send_chunks(indices):
+        sock, reader = open_data_connection(host, port, token)
+        with sock:
+
+            def send_chunk(index):
+                chunk = read_chunk(index)
+                command = f"UPLOAD_CHUNK:{upload_id}:{index}:{chunk_checksum(chunk)}"
+                sock.sendall(
+                    encode_frame(FRAME_COMMAND, command.encode("utf-8"))
+                    + encode_frame(FRAME_DATA, chunk)
+                )
+                return len(chunk)
+
+            sizes = {index: send_chunk(index) for index in indices}
+            pending = set(indices)
+            while pending:
+                frame_type, payload = reader.read_frame()
+                if frame_type != FRAME_COMMAND:
+                    continue
+                message = bytes(payload).decode("utf-8")
+                if message.startswith("CHUNK_ACK:"):
+                    index = int(message.rsplit(":", 1)[1])
+                    if index in pending:
+                        pending.discard(index)
+                        progress.add(sizes[index])
+                elif message.startswith("CHUNK_NACK:"):
+                    send_chunk(int(message.rsplit(":", 1)[1]))
+                else:
+                    raise ValueError(f"upload failed: {message}")
+
+    _run_workers(send_chunks, [indices for indices in assignments if indices])
@@ -0,0 +1,202 @@
+"""Length-prefixed framing shared by server.py and client.py.
+
+Every frame is a 6 byte header followed by the payload:
+
+    version (1 byte) | frame type (1 byte) | payload length (4 bytes, big endian)
+
+Framing is negotiated during the handshake: a capable client appends
+"\\0PROTO=<version>" to its nickname and the server answers with
+"AUTH_SUCCESS:PROTO=<version>\\n". Everything after that line is framed in
+both directions. Clients that send a bare nickname keep the text protocol.
+
+Parallel transfers open extra data connections that answer NICK with
+"TRANSFER:<token>" instead of a nickname. The token was handed out on an
+authenticated connection, so no password is asked and the data
+connection is framed right after the acknowledgement.
+
+Chat lines belong to a channel. Text frames of the default channel carry
+the bare line, so clients that know nothing of channels keep working;
+text frames of any other channel carry "<channel>\0<line>".
+"""
+import re
+import struct
+
+PROTOCOL_VERSION = 1
+
+FRAME_TEXT = 1  # Chat lines and room notifications
+FRAME_COMMAND = 2  # Commands and status strings (GET_FILE_LIST, UPLOAD_SUCCESS, FILE_INFO:...)
+FRAME_DATA = 3  # Raw file transfer bytes
+
+HEADER = struct.Struct("!BBI")
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+
+OFFER_SEPARATOR = "\x00"
+OFFER_PREFIX = "PROTO="
+AUTH_SUCCESS_PREFIX = b"AUTH_SUCCESS:" + OFFER_PREFIX.encode("utf-8")
+TRANSFER_PREFIX = "TRANSFER:"
+
+DEFAULT_CHANNEL = "general"  # Every user joins it at login
+CHANNEL_SEPARATOR = b"\x00"
+CHANNEL_NAME = re.compile(r"[\w-]{1,32}")
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def encode_header(frame_type, length):
+    return HEADER.pack(PROTOCOL_VERSION, frame_type, length)
+
+
+def encode_frame(frame_type, payload):
+    return encode_header(frame_type, len(payload)) + payload
+
+
+def offer_nickname(nickname):
+    """Nickname reply advertising framing support to the server"""
+    return f"{nickname}{OFFER_SEPARATOR}{OFFER_PREFIX}{PROTOCOL_VERSION}"
+
+
+def parse_nickname(raw_nickname):
+    """Split a nickname reply into (nickname, negotiated version or None)"""
+    nickname, _, offer = raw_nickname.partition(OFFER_SEPARATOR)
+    if not offer.startswith(OFFER_PREFIX):
+        return nickname, None
+    try:
+        offered_version = int(offer[len(OFFER_PREFIX):])
+    except ValueError:
+        return nickname, None
+    if offered_version < 1:
+        return nickname, None
+    return nickname, min(offered_version, PROTOCOL_VERSION)
+
+
+def offer_transfer(token):
+    """Reply to NICK that opens a parallel data connection instead of a chat session"""
+    return f"{TRANSFER_PREFIX}{token}"
+
+
+def parse_transfer_token(raw_nickname):
+    """The transfer token of a data connection, or None for a chat client"""
+    if not raw_nickname.startswith(TRANSFER_PREFIX):
+        return None
+    return raw_nickname[len(TRANSFER_PREFIX):]
+
+
+def auth_success_ack(version):
+    return AUTH_SUCCESS_PREFIX + f"{version}\n".encode("utf-8")
+
+
+def is_channel_name(name):
+    return CHANNEL_NAME.fullmatch(name) is not None
+
+
+def encode_channel_text(channel, line):
+    """Text frame payload of a chat line (bytes) in channel"""
+    if channel == DEFAULT_CHANNEL:
+        return line
+    return channel.encode("utf-8") + CHANNEL_SEPARATOR + line
+
+
+def parse_channel_text(payload):
+    """Split a text frame payload into (channel, line)"""
+    channel, separator, line = payload.partition(CHANNEL_SEPARATOR)
+    if not separator:
+        return DEFAULT_CHANNEL, payload
+    return channel.decode("utf-8", errors="replace"), line
+
+
+class FrameBuffer:
+    """Reusable receive buffer that parses frames in place.
+
+    Payloads are returned as memoryviews into the buffer and stay valid
+    until the next call to writable() or feed().
+    """
+
+    def __init__(self, size=65536):
+        self._initial_size = size
+        self._buffer = bytearray(size)
+        self._view = memoryview(self._buffer)
+        self._start = 0
+        self._end = 0
+
+    def _reallocate(self, size):
+        # A fresh bytearray keeps payload views handed out earlier intact
+        pending = self._end - self._start
+        buffer = bytearray(size)
+        buffer[:pending] = self._view[self._start:self._end]
+        self._buffer = buffer
+        self._view = memoryview(buffer)
+        self._start = 0
+        self._end = pending
+
+    def _compact(self):
+        pending = self._end - self._start
+        self._view[:pending] = self._view[self._start:self._end]
+        self._start = 0
+        self._end = pending
+
+    def writable(self):
+        """Free space at the end of the buffer, to be filled with recv_into()"""
+        if self._start == self._end:
+            if len(self._buffer) > self._initial_size:
+                self._reallocate(self._initial_size)
+            self._start = self._end = 0
+        elif self._end == len(self._buffer):
+            self._compact()
+        return self._view[self._end:]
+
+    def advance(self, count):
+        self._end += count
+
+    def feed(self, data):
+        """Copy bytes that were received outside recv_into() into the buffer"""
+        data = memoryview(data)
+        while data:
+            space = self.writable()
+            count = min(len(space), len(data))
+            if count == 0:
+                self._reallocate(len(self._buffer) * 2)
+                continue
+            space[:count] = data[:count]
+            self.advance(count)
+            data = data[count:]
+
+    def next_frame(self):
+        """Return (frame_type, payload) for the next complete frame, or None"""
+        available = self._end - self._start
+        if available < HEADER.size:
+            return None
+        version, frame_type, length = HEADER.unpack_from(self._buffer, self._start)
+        if version != PROTOCOL_VERSION:
+            raise ProtocolError(f"Unsupported frame version {version}")
+        if length > MAX_FRAME_SIZE:
+            raise ProtocolError(f"Frame too large: {length} bytes")
+        total = HEADER.size + length
+        if available < total:
+            if total > len(self._buffer):
+                self._reallocate(total)
+            elif self._start + total > len(self._buffer):
+                self._compact()
+            return None
+        payload = self._view[self._start + HEADER.size:self._start + total]
+        self._start += total
+        return frame_type, payload
+
+
+class FrameReader:
+    """Blocking frame reader that fills a FrameBuffer with recv_into()"""
+
+    def __init__(self, sock, buffer_size=65536):
+        self.sock = sock
+        self.buffer = FrameBuffer(buffer_size)
+
+    def read_frame(self):
+        while True:
+            frame = self.buffer.next_frame()
+            if frame is not None:
+                return frame
+            count = self.sock.recv_into(self.buffer.writable())
+            if count == 0:
+                raise ConnectionError("Connection closed by peer")
+            self.buffer.advance(count)
@@ -2,10 +2,68 @@ import socket
 import threading
 import os
 import json
-import gzip
+import tempfile
 import time
 import sys
+import asyncio
+import hashlib
+import secrets
+import shutil
+import signal
+import ipaddress
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from chunked_transfer import (
+    MAX_CHUNK_SIZE,
+    RESUME_PREFIX,
+    PartialUpload,
+    expire_partial_uploads,
+)
+from chat_history import ChatHistory
+from compressed_cache import CompressedCache
+from content_store import BlobStore, is_digest
+from direct_messages import Mailboxes
+from file_catalog import FileCatalog
+from metadata_store import BACKENDS, is_metadata_file, open_metadata_store
+from worker_bus import WorkerBus
+from server_metrics import RATIO_BUCKETS, Metrics, MetricsHTTPServer
+from server_tracing import NULL_TRACE, Tracer, parse_settings
+from session_registry import SessionRegistry
+from transfer_codecs import (
+    CODECS,
+    DEFAULT_CODEC,
+    INCOMPRESSIBLE_RATIO,
+    StreamDecompressor,
+    choose_codec,
+    compression_ratio,
+    parse_codecs,
+    read_sample,
+)
+from protocol import (
+    DEFAULT_CHANNEL,
+    FRAME_COMMAND,
+    FRAME_DATA,
+    FRAME_TEXT,
+    HEADER,
+    PROTOCOL_VERSION,
+    FrameBuffer,
+    FrameReader,
+    ProtocolError,
+    auth_success_ack,
+    encode_channel_text,
+    encode_frame,
+    encode_header,
+    is_channel_name,
+    parse_channel_text,
+    parse_nickname,
+    parse_transfer_token,
+)
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
 
 # Default configuration
 DEFAULT_CONFIG = {
@@ -13,12 +71,56 @@ DEFAULT_CONFIG = {
         "host": "0.0.0.0",
         "port": 55555,
         "password": "",
-        "interactive_password_setup": True
+        "interactive_password_setup": True,
+        "mode": "threaded",  # "threaded" or "asyncio"
+        "executor_workers": 4,
+        "workers": 1,  # Processes sharing the port through SO_REUSEPORT
+        "handshake_workers": 32,  # Threads running NICK/PASS handshakes in threaded mode
+        "handshake_timeout": 5  # Seconds each handshake stage may take
     },
     "file_transfer": {
         "upload_dir": "uploads",
         "buffer_size": 65536,
-        "max_file_size": 104857600  # 100MB
+        "max_file_size": 104857600,  # 100MB
+        "cache_dir": "uploads_cache",
+        "cache_max_size": 1073741824,  # 1GB
+        "compress_level": 6,
+        "codec": "gzip",
+        "adaptive_compression": True,
+        "catalog_rescan_interval": 300,
+        "metadata_backend": "journal",
+        "dedup": False,
+        "chunk_size": 1048576,  # 1MB
+        "resume_expiry": 86400,  # 1 day
+        "parallel_streams": 4
+    },
+    "history": {
+        "directory": "chat_history",
+        "ring_size": 1000,
+        "segment_size": 4194304,  # 4MB
+        "max_segments": 16,
+        "backlog": 50
+    },
+    "direct_messages": {
+        "mailbox_size": 50,  # Messages kept for a user who is offline, older ones are dropped
+        "max_mailboxes": 10000,  # Offline users with waiting messages, per worker process
+        "presence_sync_interval": 10  # Seconds between full presence snapshots on the worker bus
+    },
+    "outbound": {
+        "queue_high_water": 1048576,  # 1MB queued per client
+        "slow_consumer_policy": "drop_oldest"  # "drop_oldest" or "disconnect"
+    },
+    "metrics": {
+        "enabled": True,
+        "http_host": "127.0.0.1",
+        "http_port": 0,  # 0 disables the Prometheus endpoint
+        "admin_password": ""  # Empty: STATS and TRACE are answered on loopback connections only
+    },
+    "tracing": {
+        "file": "traces/trace.jsonl",
+        "max_bytes": 10485760,  # 10MB per file
+        "backups": 5,
+        "sample_rate": 0.0  # Share of operations traced, changeable at runtime with TRACE
     },
     "logging": {
         "enable_logging": True,
@@ -42,9 +144,44 @@ def create_default_config():
         print("- server.port: Server port number")
         print("- server.password: Server password (empty string means no password)")
         print("- server.interactive_password_setup: Whether to enable interactive password setup")
+        print("- server.mode: Connection engine, \"threaded\" (one thread per client) or \"asyncio\" (single event loop)")
+        print("- server.executor_workers: Worker threads for disk and compression work in asyncio mode")
+        print("- server.workers: Server processes accepting on the same port (SO_REUSEPORT, Linux only)")
+        print("- server.handshake_workers: Threads running login handshakes in threaded mode")
+        print("- server.handshake_timeout: Seconds each handshake stage (nickname, password) may take")
         print("- file_transfer.upload_dir: File upload directory")
         print("- file_transfer.buffer_size: Transfer buffer size")
         print("- file_transfer.max_file_size: Maximum file size limit")
+        print("- file_transfer.cache_dir: Directory for compressed download renditions")
+        print("- file_transfer.cache_max_size: Size cap of the download cache (0 disables caching)")
+        print("- file_transfer.compress_level: Compression level used when a download is not cached yet")
+        print("- file_transfer.codec: Codec for compressible files ('gzip', 'bz2', 'lzma' or 'none'), for clients that support it")
+        print("- file_transfer.adaptive_compression: Send already-compressed files (media, archives) without compressing them again")
+        print("- file_transfer.catalog_rescan_interval: Seconds between upload directory rescans (0 rescans only at startup)")
+        print("- file_transfer.metadata_backend: File metadata store ('journal' or 'sqlite')")
+        print("- file_transfer.dedup: Store identical uploads once, addressed by their SHA-256 digest")
+        print("- file_transfer.chunk_size: Chunk size used by DOWNLOAD_RANGE chunk=<index> requests")
+        print("- file_transfer.resume_expiry: Seconds an interrupted chunked upload is kept for resuming")
+        print("- file_transfer.parallel_streams: Data connections a client may open for one large transfer")
+        print("- history.directory: Directory of the chat history log")
+        print("- history.ring_size: Recent chat lines kept in memory for HISTORY requests")
+        print("- history.segment_size: Size at which a history log segment is closed and a new one started")
+        print("- history.max_segments: Log segments kept on disk, older ones are deleted")
+        print("- history.backlog: Chat lines sent to a client right after it logs in (0 sends none)")
+        print("- direct_messages.mailbox_size: Direct messages kept for an offline user until their next login")
+        print("- direct_messages.max_mailboxes: Offline users with waiting direct messages; the oldest mailbox is dropped past it")
+        print("  Mailboxes are keyed on the nickname, which is not authenticated: whoever logs in first under it gets the mail")
+        print("- direct_messages.presence_sync_interval: Seconds between the full lists of logged-in users workers send each other")
+        print("- outbound.queue_high_water: Bytes that may be queued for one client before the slow consumer policy applies")
+        print("- outbound.slow_consumer_policy: \"drop_oldest\" drops the oldest queued chat messages, \"disconnect\" disconnects the client")
+        print("- metrics.enabled: Record counters and latency histograms (cheap enough to leave on)")
+        print("- metrics.http_host: Address of the Prometheus metrics endpoint")
+        print("- metrics.http_port: Port of the Prometheus metrics endpoint, worker N uses port + N (0 disables it)")
+        print("- metrics.admin_password: Password of the STATS and TRACE commands (empty allows them from loopback connections only)")
+        print("- tracing.file: Trace file (JSON lines), worker N writes <name>.N<extension>; cProfile dumps go to the same directory")
+        print("- tracing.max_bytes: Size at which the trace file is rotated")
+        print("- tracing.backups: Rotated trace files kept")
+        print("- tracing.sample_rate: Share of uploads, downloads, file lists and handshakes traced (0 disables, TRACE changes it at runtime)")
         print("\nPlease restart the server program after modification.")
         
         return False
@@ -89,9 +226,53 @@ SERVER_HOST = config["server"]["host"]
 SERVER_PORT = config["server"]["port"]
 SERVER_PASSWORD = config["server"]["password"]
 INTERACTIVE_PASSWORD_SETUP = config["server"]["interactive_password_setup"]
+SERVER_MODE = config["server"].get("mode", "threaded")
+EXECUTOR_WORKERS = config["server"].get("executor_workers", 4)
+SERVER_WORKERS = max(1, config["server"].get("workers", 1))
+HANDSHAKE_WORKERS = max(1, config["server"].get("handshake_workers", 32))
+HANDSHAKE_TIMEOUT = config["server"].get("handshake_timeout", 5)
+# Accepted connections waiting for a handshake thread beyond this are closed at once
+HANDSHAKE_QUEUE_LIMIT = HANDSHAKE_WORKERS * 64
 UPLOAD_DIR = config["file_transfer"]["upload_dir"]
 BUFFER_SIZE = config["file_transfer"]["buffer_size"]
-METADATA_FILE = os.path.join(UPLOAD_DIR, "file_metadata.json")
+MAX_FILE_SIZE = config["file_transfer"].get("max_file_size", 104857600)
+METADATA_BACKEND = config["file_transfer"].get("metadata_backend", "journal")
+DEDUP_UPLOADS = config["file_transfer"].get("dedup", False)
+BLOB_DIR = os.path.join(UPLOAD_DIR, ".blobs")
+CHUNK_SIZE = config["file_transfer"].get("chunk_size", 1048576)
+RESUME_EXPIRY = config["file_transfer"].get("resume_expiry", 86400)
+PARALLEL_STREAMS = max(1, config["file_transfer"].get("parallel_streams", 4))
+TRANSFER_TOKEN_TTL = 300  # Seconds a parallel transfer token accepts new data connections
+# Seconds an expired grant is kept, so an upload still running on its data connections
+# can be acknowledged by the worker process holding the chat connection
+TRANSFER_GRANT_RETENTION = 3600
+UPLOAD_TEMP_PREFIX = ".upload_"
+CACHE_DIR = config["file_transfer"].get("cache_dir", UPLOAD_DIR.rstrip("/\\") + "_cache")
+CACHE_MAX_SIZE = config["file_transfer"].get("cache_max_size", 1073741824)
+COMPRESS_LEVEL = config["file_transfer"].get("compress_level", 6)
+COMPRESS_CODEC = config["file_transfer"].get("codec", DEFAULT_CODEC)
+ADAPTIVE_COMPRESSION = config["file_transfer"].get("adaptive_compression", True)
+CATALOG_RESCAN_INTERVAL = config["file_transfer"].get("catalog_rescan_interval", 300)
+HISTORY_DIR = config.get("history", {}).get("directory", "chat_history")
+HISTORY_RING_SIZE = config.get("history", {}).get("ring_size", 1000)
+HISTORY_SEGMENT_SIZE = config.get("history", {}).get("segment_size", 4194304)
+HISTORY_MAX_SEGMENTS = config.get("history", {}).get("max_segments", 16)
+HISTORY_BACKLOG = config.get("history", {}).get("backlog", 50)
+DM_MAILBOX_SIZE = config.get("direct_messages", {}).get("mailbox_size", 50)
+DM_MAX_MAILBOXES = config.get("direct_messages", {}).get("max_mailboxes", 10000)
+PRESENCE_SYNC_INTERVAL = config.get("direct_messages", {}).get("presence_sync_interval", 10)
+DM_MAX_LENGTH = 4096  # Characters in one direct message
+HISTORY_MAX_MESSAGES = 500  # Most chat lines returned by one HISTORY request
+OUTBOUND_HIGH_WATER = config.get("outbound", {}).get("queue_high_water", 1048576)
+SLOW_CONSUMER_POLICY = config.get("outbound", {}).get("slow_consumer_policy", "drop_oldest")
+METRICS_ENABLED = config.get("metrics", {}).get("enabled", True)
+METRICS_HTTP_HOST = config.get("metrics", {}).get("http_host", "127.0.0.1")
+METRICS_HTTP_PORT = config.get("metrics", {}).get("http_port", 0)
+STATS_PASSWORD = config.get("metrics", {}).get("admin_password", "")
+TRACE_FILE = config.get("tracing", {}).get("file", "traces/trace.jsonl")
+TRACE_MAX_BYTES = config.get("tracing", {}).get("max_bytes", 10485760)
+TRACE_BACKUPS = config.get("tracing", {}).get("backups", 5)
+TRACE_SAMPLE_RATE = config.get("tracing", {}).get("sample_rate", 0.0)
 
 # Display loaded configuration information
 print(f"📋 Server Configuration:")
@@ -99,68 +280,379 @@ print(f"   Listen Address: {SERVER_HOST}")
 print(f"   Listen Port: {SERVER_PORT}")
 print(f"   Upload Directory: {UPLOAD_DIR}")
 print(f"   Buffer Size: {BUFFER_SIZE}")
+print(f"   Max File Size: {MAX_FILE_SIZE}")
+print(f"   Download Cache: {CACHE_DIR} (max {CACHE_MAX_SIZE} bytes)")
+print(f"   Compression: {COMPRESS_CODEC} level {COMPRESS_LEVEL}, adaptive {'Enabled' if ADAPTIVE_COMPRESSION else 'Disabled'}")
+print(f"   Catalog Rescan Interval: {CATALOG_RESCAN_INTERVAL}s")
+print(f"   Metadata Backend: {METADATA_BACKEND}")
+print(f"   Deduplicated Storage: {'Enabled' if DEDUP_UPLOADS else 'Disabled'}")
+print(f"   Chunk Size: {CHUNK_SIZE}, partial uploads kept for {RESUME_EXPIRY}s")
+print(f"   Parallel Streams: {PARALLEL_STREAMS}")
+print(f"   Server Mode: {SERVER_MODE}")
+print(f"   Worker Processes: {SERVER_WORKERS}")
+print(
+    f"   Chat History: {HISTORY_DIR} ({HISTORY_RING_SIZE} in memory, {HISTORY_MAX_SEGMENTS} segments of {HISTORY_SEGMENT_SIZE} bytes), backlog {HISTORY_BACKLOG}"
+)
+print(f"   Direct Messages: mailboxes of {DM_MAILBOX_SIZE} messages for up to {DM_MAX_MAILBOXES} offline users")
+print(f"   Outbound Queue: {OUTBOUND_HIGH_WATER} bytes per client, slow consumers: {SLOW_CONSUMER_POLICY}")
+print(
+    f"   Metrics: {'Enabled' if METRICS_ENABLED else 'Disabled'}, endpoint {f'{METRICS_HTTP_HOST}:{METRICS_HTTP_PORT}' if METRICS_HTTP_PORT else 'disabled'}, STATS {'password protected' if STATS_PASSWORD else 'loopback only'}"
+)
+print(f"   Tracing: {TRACE_FILE}, sample rate {TRACE_SAMPLE_RATE}")
+print(f"   Handshakes: {HANDSHAKE_WORKERS} threads, {HANDSHAKE_TIMEOUT}s per stage")
 print(f"   Interactive Password Setup: {'Enabled' if INTERACTIVE_PASSWORD_SETUP else 'Disabled'}")
 
+if SERVER_MODE not in ("threaded", "asyncio"):
+    print(f"❌ Unknown server.mode '{SERVER_MODE}', expected 'threaded' or 'asyncio'")
+    sys.exit(1)
+
+if SERVER_WORKERS > 1 and not (hasattr(os, "fork") and hasattr(socket, "SO_REUSEPORT")):
+    print("❌ server.workers above 1 needs os.fork and SO_REUSEPORT, which this platform does not provide")
+    sys.exit(1)
+
+if METADATA_BACKEND not in BACKENDS:
+    print(f"❌ Unknown file_transfer.metadata_backend '{METADATA_BACKEND}', expected one of {', '.join(BACKENDS)}")
+    sys.exit(1)
+
+if COMPRESS_CODEC not in CODECS:
+    print(f"❌ Unknown file_transfer.codec '{COMPRESS_CODEC}', expected one of {', '.join(CODECS)}")
+    sys.exit(1)
+
+if SLOW_CONSUMER_POLICY not in ("drop_oldest", "disconnect"):
+    print(
+        f"❌ Unknown outbound.slow_consumer_policy '{SLOW_CONSUMER_POLICY}', expected 'drop_oldest' or 'disconnect'"
+    )
+    sys.exit(1)
+
 if not os.path.exists(UPLOAD_DIR):
     os.makedirs(UPLOAD_DIR)
     print(f"📁 Created upload directory: {UPLOAD_DIR}")
 
 # Global variables
-clients = []
-nicknames = []
-uploaded_files = []
+# Logged-in chat users of this process
+sessions = SessionRegistry()
+# Direct messages for users who are offline
+mailboxes = Mailboxes(DM_MAILBOX_SIZE, DM_MAX_MAILBOXES)
+# Users logged in on the other worker processes: nickname -> {worker index: sessions}
+remote_presence = {}
+remote_presence_lock = threading.Lock()
+# Held while logging in or out and announcing it, so presence snapshots never race a change
+local_presence_lock = threading.Lock()
+handshake_slots = threading.BoundedSemaphore(HANDSHAKE_QUEUE_LIMIT)
+catalog = FileCatalog()
+metadata_store = None
+# Blobs are always resolvable, dedup only decides whether new uploads go there
+blob_store = BlobStore(BLOB_DIR)
+metadata_lock = threading.Lock()
+# Chunked uploads in progress, by upload id
+partial_uploads = {}
+partial_uploads_lock = threading.Lock()
+# Parallel transfer grants, by transfer token
+transfers = {}
+transfers_lock = threading.Lock()
+# Events to and from the other worker processes, in multi-process mode
+bus = None
+# Broadcast chat lines; only one process writes them, the others read the log
+history = None
+# How often the slow consumer policy fired, across all clients
+outbound_counters = {"dropped_messages": 0, "slow_consumer_disconnects": 0}
+outbound_counters_lock = threading.Lock()
+# Index of this worker process, None when a single process serves everything
+worker_index = None
+
+metrics = Metrics(enabled=METRICS_ENABLED)
+metrics.counter("connections_total", "Connections accepted, parallel transfer data connections included")
+metrics.counter("auth_failures_total", "Handshakes rejected for a wrong password or an unknown transfer token")
+metrics.counter("handshake_timeouts_total", "Handshakes closed because a stage missed its deadline")
+metrics.counter("handshakes_rejected_total", "Connections closed because too many handshakes were pending")
+metrics.histogram("handshake_seconds", "Time from accepting a connection to AUTH_SUCCESS")
+metrics.histogram("command_seconds", "Time spent serving one client command, by command")
+metrics.histogram("broadcast_seconds", "Time to queue one chat line for every client of this process")
+metrics.counter("bytes_received_total", "Bytes read from client connections after the handshake")
+metrics.counter("bytes_sent_total", "Bytes written to client connections")
+metrics.histogram("compression_ratio", "Compressed size as a share of the original size", RATIO_BUCKETS)
+metrics.counter("compression_cpu_seconds_total", "CPU time spent compressing and decompressing file content")
+metrics.histogram("metadata_save_seconds", "Time to write one change to the metadata store")
+metrics.gauge("clients_connected", "Chat clients connected to this process", lambda: len(sessions))
+metrics.gauge("channels", "Channels with members on this process", lambda: len(sessions.channels))
+metrics.counter("direct_messages_total", "Direct messages by outcome: sent to a session or queued for an offline user")
+metrics.gauge("mailbox_messages", "Direct messages waiting for offline users", lambda: len(mailboxes))
+metrics.gauge("mailbox_dropped_messages", "Direct messages dropped from full mailboxes", lambda: mailboxes.dropped)
+metrics.gauge("bus_dropped_events", "Worker bus events a peer never got", lambda: bus.dropped if bus else 0)
+metrics.gauge("catalog_files", "Files in the catalog", lambda: len(catalog))
+metrics.gauge("outbound_dropped_messages", "Queued chat messages dropped for slow consumers", lambda: outbound_counters["dropped_messages"])
+metrics.gauge("slow_consumer_disconnects", "Clients disconnected as slow consumers", lambda: outbound_counters["slow_consumer_disconnects"])
+metrics.gauge("process_cpu_seconds", "CPU time used by this process", time.process_time)
+if resource is not None:
+    # ru_maxrss is in kilobytes on Linux
+    metrics.gauge("max_rss_bytes", "Peak resident memory of this process", lambda: resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024)
+
+# Sampled traces and requested cProfile runs; each worker process writes its own file
+tracer = Tracer(TRACE_FILE, TRACE_MAX_BYTES, TRACE_BACKUPS, TRACE_SAMPLE_RATE)
+
+# Commands timed by command_seconds, traced and profiled; anything else is chat or ignored
+TIMED_COMMANDS = {
+    b"UPLOAD_FILE", b"UPLOAD_HASH", b"GET_FILE_LIST", b"HISTORY", b"DOWNLOAD_FILE", b"DOWNLOAD_RANGE",
+    b"CODECS", b"UPLOAD_RESUME", b"UPLOAD_CHUNK", b"PARALLEL_DOWNLOAD", b"PARALLEL_UPLOAD", b"STATS",
+    b"TRACE", b"JOIN", b"PART", b"DM",
+}
+
+
+def command_name(message):
+    """The command a client message starts with, None for chat and unknown commands"""
+    command = message.split(b":", 1)[0]
+    return command.decode("ascii") if command in TIMED_COMMANDS else None
+
+
+def record_command(command, started):
+    """Observe the time since started under command_seconds"""
+    if command is not None:
+        metrics.observe("command_seconds", time.perf_counter() - started, command=command)
+
+
+def is_admin(password, peer_host):
+    """STATS and TRACE need metrics.admin_password, or a loopback connection when it is empty"""
+    if STATS_PASSWORD:
+        return secrets.compare_digest(password.encode("utf-8"), STATS_PASSWORD.encode("utf-8"))
+    try:
+        return ipaddress.ip_address(peer_host).is_loopback
+    except ValueError:
+        return False
+
+
+def build_stats_message(request, peer_host):
+    """Answer STATS[:<password>] with STATS:<length>:<json>, or STATS_DENIED"""
+    password = request.decode("utf-8", errors="replace").partition(":")[2]
+    if not is_admin(password, peer_host):
+        return b"STATS_DENIED"
+    stats = metrics.as_dict()
+    stats.update(type="stats", worker=worker_index, pid=os.getpid(), sessions=sessions.describe())
+    message = json.dumps(stats).encode("utf-8")
+    return f"STATS:{len(message)}:".encode("utf-8") + message
+
+
+def build_trace_message(request, peer_host):
+    """Answer TRACE[:<settings>[:<password>]] with TRACE:<length>:<json>, TRACE_DENIED or TRACE_ERROR:<reason>.
+
+    The settings (see Tracer.configure) apply to every worker process; the
+    reply describes the tracing state of the one serving this connection.
+    """
+    settings, _, password = request.decode("utf-8", errors="replace").partition(":")[2].partition(":")
+    if not is_admin(password, peer_host):
+        return b"TRACE_DENIED"
+    try:
+        settings = parse_settings(settings)
+        tracer.configure(settings)
+    except ValueError as e:
+        return f"TRACE_ERROR:{e}".encode("utf-8")
+    if settings and bus:
+        bus.publish("tracing", settings)
+    state = tracer.state()
+    state.update(type="tracing", worker=worker_index, pid=os.getpid())
+    message = json.dumps(state).encode("utf-8")
+    return f"TRACE:{len(message)}:".encode("utf-8") + message
+
+
+def start_metrics_endpoint():
+    """Serve GET /metrics in the Prometheus text format on a daemon thread"""
+    if not METRICS_HTTP_PORT:
+        return
+    port = METRICS_HTTP_PORT + (worker_index or 0)
+    try:
+        endpoint = MetricsHTTPServer((METRICS_HTTP_HOST, port), metrics)
+    except OSError as e:
+        print(f"\033[91mFailed to start the metrics endpoint on {METRICS_HTTP_HOST}:{port}: {e}\033[0m")
+        return
+    threading.Thread(target=endpoint.serve_forever, daemon=True).start()
+    print(f"📈 Metrics endpoint: http://{METRICS_HTTP_HOST}:{port}/metrics")
 
 
 def load_file_metadata():
-    global uploaded_files
+    global metadata_store
     try:
-        if os.path.exists(METADATA_FILE):
-            with open(METADATA_FILE, "r", encoding="utf-8") as f:
-                uploaded_files = json.load(f)
-        print(f"Loaded metadata for {len(uploaded_files)} files")
+        metadata_store = open_metadata_store(METADATA_BACKEND, UPLOAD_DIR)
+        catalog.replace_all(metadata_store.load())
+        print(f"Loaded metadata for {len(catalog)} files ({METADATA_BACKEND} store)")
+        orphans = blob_store.rebuild(catalog.records())
+        if orphans:
+            print(f"Removed {orphans} unreferenced blobs")
     except Exception as e:
         print(f"\033[91mFailed to load metadata: {e}\033[0m")
-        uploaded_files = []
+        sys.exit(1)
 
 
-def save_file_metadata():
+def record_file_metadata(file_info):
+    """Add or replace one file in the catalog and the metadata store; caller holds metadata_lock"""
+    add_to_catalog(file_info)
     try:
-        with open(METADATA_FILE, "w", encoding="utf-8") as f:
-            json.dump(uploaded_files, f, ensure_ascii=False, indent=2)
+        with metrics.timer("metadata_save_seconds", operation="add"):
+            metadata_store.add(file_info)
     except Exception as e:
         print(f"\033[91mFailed to save metadata: {e}\033[0m")
+    if bus:
+        bus.publish("file_added", file_info)
+
 
+def add_to_catalog(file_info, retain_blob=False):
+    """Catalog a new entry; a blob reference taken by another worker is counted here too"""
+    replaced = catalog.get(file_info["unique_filename"])
+    catalog.add(file_info)
+    if retain_blob and file_info.get("sha256"):
+        blob_store.retain(file_info["sha256"])
+    if replaced and replaced.get("sha256"):
+        blob_store.release(replaced["sha256"])
 
-def sync_files_and_metadata():
-    global uploaded_files
+
+def remove_from_catalog(unique_filename):
+    file_info = catalog.remove(unique_filename)
+    if file_info is not None and file_info.get("sha256"):
+        blob_store.release(file_info["sha256"])
+    return file_info
+
+
+def update_file_metadata(file_info):
+    """Rewrite the details of a catalogued file, keeping its blob reference; caller holds metadata_lock"""
+    catalog.add(file_info)
+    try:
+        with metrics.timer("metadata_save_seconds", operation="update"):
+            metadata_store.add(file_info)
+    except Exception as e:
+        print(f"\033[91mFailed to save metadata: {e}\033[0m")
+    if bus:
+        bus.publish("file_updated", file_info)
+
+
+def forget_file_metadata(unique_filename):
+    """Drop one file from the catalog and the metadata store; caller holds metadata_lock"""
+    if remove_from_catalog(unique_filename) is None:
+        return False
+    try:
+        with metrics.timer("metadata_save_seconds", operation="remove"):
+            metadata_store.remove(unique_filename)
+    except Exception as e:
+        print(f"\033[91mFailed to save metadata: {e}\033[0m")
+    if bus:
+        bus.publish("file_removed", {"unique_filename": unique_filename})
+    return True
+
+
+def reopen_metadata_store():
+    """Give a forked worker its own store handle; the catalog it inherited is current"""
+    global metadata_store
+    metadata_store = open_metadata_store(METADATA_BACKEND, UPLOAD_DIR, shared=True)
+
+
+def stored_file_location(unique_filename):
+    """Return (path on disk, download cache name) for a stored file"""
+    file_info = catalog.get(unique_filename)
+    if file_info and file_info.get("sha256"):
+        # Renditions are shared by every entry with the same content
+        return blob_store.path(file_info["sha256"]), file_info["sha256"]
+    return os.path.join(UPLOAD_DIR, unique_filename), unique_filename
+
+
+def is_stored_file(filename):
+    """True for uploaded files, false for the metadata file and in-progress uploads"""
+    return (
+        not is_metadata_file(filename)
+        and not filename.startswith(UPLOAD_TEMP_PREFIX)
+        and not filename.startswith(RESUME_PREFIX)
+    )
+
+
+def describe_untracked_file(filename):
+    """Catalog entry for a file that was placed in UPLOAD_DIR without metadata"""
+    file_stats = os.stat(os.path.join(UPLOAD_DIR, filename))
+    original_filename = filename
+    if "_" in filename:
+        original_filename = "_".join(filename.split("_")[1:])
+    return {
+        "filename": original_filename,
+        "unique_filename": filename,
+        "uploader": "Unknown",
+        "upload_time": datetime.fromtimestamp(file_stats.st_mtime).strftime(
+            "%Y-%m-%d %H:%M:%S"
+        ),
+        "size": file_stats.st_size,
+        "compressed_size": file_stats.st_size,
+    }
+
+
+def sync_files_and_metadata(remove_partial_uploads=False):
+    """Reconcile the catalog with the files actually present in UPLOAD_DIR"""
     try:
-        if not os.path.exists(UPLOAD_DIR):
-            uploaded_files = []
-            save_file_metadata()
-            return
         existing_files = set()
-        for filename in os.listdir(UPLOAD_DIR):
-            if filename != "file_metadata.json" and os.path.isfile(
-                os.path.join(UPLOAD_DIR, filename)
-            ):
-                existing_files.add(filename)
-        original_count = len(uploaded_files)
-        uploaded_files[:] = [
-            f for f in uploaded_files if f["unique_filename"] in existing_files
-        ]
-        if len(uploaded_files) != original_count:
-            save_file_metadata()
-            print(
-                f"Folder sync complete: cleaned {original_count - len(uploaded_files)} invalid records"
-            )
-            print(f"Current valid files: {len(uploaded_files)}")
+        if os.path.exists(UPLOAD_DIR):
+            for filename in os.listdir(UPLOAD_DIR):
+                if filename.startswith(UPLOAD_TEMP_PREFIX):
+                    if remove_partial_uploads:
+                        # Left behind by an upload that was interrupted by a server crash
+                        os.remove(os.path.join(UPLOAD_DIR, filename))
+                    continue
+                if is_stored_file(filename) and os.path.isfile(
+                    os.path.join(UPLOAD_DIR, filename)
+                ):
+                    existing_files.add(filename)
+            expired = expire_partial_uploads(UPLOAD_DIR, RESUME_EXPIRY)
+            if expired:
+                print(f"Removed {expired} expired partial uploads")
+        with metadata_lock:
+            removed = [
+                f["unique_filename"]
+                for f in catalog.records()
+                if not (
+                    blob_store.exists(f["sha256"])
+                    if f.get("sha256")
+                    else f["unique_filename"] in existing_files
+                )
+            ]
+            for unique_filename in removed:
+                forget_file_metadata(unique_filename)
+            added = [filename for filename in existing_files if filename not in catalog]
+            for filename in added:
+                record_file_metadata(describe_untracked_file(filename))
+            if removed or added:
+                print(
+                    f"Folder sync complete: cleaned {len(removed)} invalid records, found {len(added)} untracked files"
+                )
+                print(f"Current valid files: {len(catalog)}")
 
     except Exception as e:
         print(f"\033[91mFailed to sync files and metadata: {e}\033[0m")
 
 
+def rescan_upload_dir_periodically():
+    while True:
+        time.sleep(CATALOG_RESCAN_INTERVAL)
+        sync_files_and_metadata()
+
+
+def create_listen_socket(reuse_port=False):
+    """Bind the listening socket, exiting with a message if the address is unusable"""
+    try:
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)  # Allow port reuse
+        if reuse_port:
+            # Every worker process listens on the port; the kernel spreads connections between them
+            listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        listener.bind((SERVER_HOST, SERVER_PORT))
+        listener.listen()
+        return listener
+    except OSError as e:
+        if e.errno == 10048:  # Windows: Address already in use
+            print(f"❌ Port {SERVER_PORT} is already in use, please check if another program is using this port")
+        elif e.errno == 10049:  # Windows: Cannot assign requested address
+            print(f"❌ Cannot bind to address {SERVER_HOST}, please check network configuration")
+        else:
+            print(f"❌ Server startup failed: {e}")
+        sys.exit(1)
+    except Exception as e:
+        print(f"❌ Server startup failed: {e}")
+        sys.exit(1)
+
+
 def initialize_server():
-    global SERVER_PASSWORD, server
+    global SERVER_PASSWORD, server, download_cache
     print("\033[92mInitializing server...\033[0m")
     
     # If no password is set in config file and interactive setup is enabled, prompt user for input
@@ -179,307 +671,165 @@ def initialize_server():
     else:
         print(f"Server password authentication: DISABLED")
     
-    # Create and bind socket
-    try:
-        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)  # Allow port reuse
-        server.bind((SERVER_HOST, SERVER_PORT))
-        server.listen()
+    # Worker processes bind their own sockets after forking
+    if SERVER_WORKERS == 1:
+        server = create_listen_socket()
         print(f"🚀 Server started successfully, listening on {SERVER_HOST}:{SERVER_PORT}")
-    except OSError as e:
-        if e.errno == 10048:  # Windows: Address already in use
-            print(f"❌ Port {SERVER_PORT} is already in use, please check if another program is using this port")
-        elif e.errno == 10049:  # Windows: Cannot assign requested address
-            print(f"❌ Cannot bind to address {SERVER_HOST}, please check network configuration")
-        else:
-            print(f"❌ Server startup failed: {e}")
-        sys.exit(1)
-    except Exception as e:
-        print(f"❌ Server startup failed: {e}")
-        sys.exit(1)
     
     load_file_metadata()
-    sync_files_and_metadata()
+    sync_files_and_metadata(remove_partial_uploads=True)
+    if CATALOG_RESCAN_INTERVAL > 0 and SERVER_WORKERS == 1:
+        threading.Thread(target=rescan_upload_dir_periodically, daemon=True).start()
+    download_cache = CompressedCache(CACHE_DIR, CACHE_MAX_SIZE, COMPRESS_LEVEL, BUFFER_SIZE)
+    print(
+        f"Download cache: {len(download_cache.entries)} renditions, {download_cache.total_size} bytes"
+    )
+    # Worker processes open the history after forking, worker 0 as its writer
+    if SERVER_WORKERS == 1:
+        open_chat_history(writable=True)
 
 
-def broadcast(message):
-    for client in clients:
-        try:
-            client.send(message)
-        except:
-            pass
+def open_chat_history(writable):
+    global history
+    try:
+        history = ChatHistory(
+            HISTORY_DIR, HISTORY_RING_SIZE, HISTORY_SEGMENT_SIZE, HISTORY_MAX_SEGMENTS, writable
+        )
+    except Exception as e:
+        print(f"\033[91mFailed to open chat history: {e}\033[0m")
+        sys.exit(1)
+    if writable:
+        print(f"Chat history: {history.next_offset - history.first_offset} messages on disk")
 
 
-def send_file_list(client):
-    global uploaded_files
+def record_chat(message):
+    """Append a broadcast chat line to the history, in the process that writes it"""
+    if history is None or not history.writable:
+        return
     try:
-        files = []
-        existing_files = set()
-        if os.path.exists(UPLOAD_DIR):
-            for filename in os.listdir(UPLOAD_DIR):
-                if filename == "file_metadata.json":  # Ignore metadata file
-                    continue
-                file_path = os.path.join(UPLOAD_DIR, filename)
-                if os.path.isfile(file_path):
-                    existing_files.add(filename)
-                    file_stats = os.stat(file_path)
-                    file_size = file_stats.st_size
-                    upload_time = datetime.fromtimestamp(file_stats.st_mtime).strftime(
-                        "%Y-%m-%d %H:%M:%S"
-                    )
-                    uploader = "Unknown"
-                    original_filename = filename
-                    original_size = file_size
-                    for stored_file in uploaded_files:
-                        if stored_file["unique_filename"] == filename:
-                            uploader = stored_file["uploader"]
-                            original_filename = stored_file["filename"]
-                            original_size = stored_file.get("size", file_size)
-                            break
-                    if uploader == "Unknown" and "_" in filename:
-                        original_filename = "_".join(filename.split("_")[1:])
-                    file_info = {
-                        "filename": original_filename,
-                        "unique_filename": filename,
-                        "uploader": uploader,
-                        "upload_time": upload_time,
-                        "size": original_size,
-                        "compressed_size": file_size,
-                    }
-                    files.append(file_info)
-        original_count = len(uploaded_files)
-        uploaded_files[:] = [
-            f for f in uploaded_files if f["unique_filename"] in existing_files
-        ]
-        if len(uploaded_files) != original_count:
-            save_file_metadata()
-            print(
-                f"Cleaned {original_count - len(uploaded_files)} metadata records for non-existent files"
-            )
-        files.sort(key=lambda x: x["upload_time"], reverse=True)
-        file_list = {"type": "file_list", "files": files}
-        message = json.dumps(file_list).encode("utf-8")
-        client.send(f"FILE_LIST:{len(message)}:".encode("utf-8") + message)
-
+        history.append(message)
     except Exception as e:
-        print(f"\033[91mError sending file list: {e}\033[0m")
-        empty_list = {"type": "file_list", "files": []}
-        message = json.dumps(empty_list).encode("utf-8")
-        client.send(f"FILE_LIST:{len(message)}:".encode("utf-8") + message)
+        print(f"\033[91mFailed to record chat history: {e}\033[0m")
 
 
-def handle_file_upload(client, filename, file_size, uploader):
+def build_history_message(request=b"HISTORY"):
+    """Answer HISTORY, HISTORY:last=<count> or HISTORY:since=<offset> with HISTORY:<length>:<json>"""
+    _, _, spec = request.decode("utf-8").partition(":")
+    key, _, value = spec.partition("=")
     try:
-        compressed_data = b""
-        bytes_received = 0
-        while bytes_received < file_size:
-            chunk_size = min(BUFFER_SIZE, file_size - bytes_received)
-            chunk = client.recv(chunk_size)
-            if not chunk:
-                break
-            compressed_data += chunk
-            bytes_received += len(chunk)
-        file_data = gzip.decompress(compressed_data)
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        unique_filename = f"{timestamp}_{filename}"
-        file_path = os.path.join(UPLOAD_DIR, unique_filename)
-        with open(file_path, "wb") as f:
-            f.write(file_data)
-        file_info = {
-            "filename": filename,
-            "unique_filename": unique_filename,
-            "uploader": uploader,
-            "upload_time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-            "size": len(file_data),
-            "compressed_size": len(compressed_data),
-        }
-        uploaded_files[:] = [
-            f for f in uploaded_files if f["unique_filename"] != unique_filename
-        ]
-        uploaded_files.append(file_info)
-        save_file_metadata()
-        notification = (
-            f"{uploader} uploaded a file: {filename} (size: {len(file_data)} bytes)"
-        )
-        broadcast(notification.encode("utf-8"))
+        value = int(value) if value else HISTORY_BACKLOG
+    except ValueError:
+        value = HISTORY_BACKLOG
+    if key == "since":
+        entries = history.since(max(value, 0), HISTORY_MAX_MESSAGES)
+    else:
+        entries = history.recent(min(max(value, 0), HISTORY_MAX_MESSAGES))
+    reply = {
+        "type": "history",
+        "messages": [
+            {"offset": offset, "time": timestamp, "text": message.decode("utf-8", errors="replace")}
+            for offset, timestamp, message in entries
+        ],
+        "next_offset": entries[-1][0] + 1 if entries else history.next_offset,
+    }
+    message = json.dumps(reply).encode("utf-8")
+    return f"HISTORY:{len(message)}:".encode("utf-8") + message
 
-        # Send upload success message
-        client.send("UPLOAD_SUCCESS".encode("utf-8"))
-        print(
-            f"File uploaded successfully: {filename} by {uploader} (original size: {len(file_data)}, compressed size: {len(compressed_data)})"
-        )
 
-    except Exception as e:
-        client.send("UPLOAD_ERROR".encode("utf-8"))
-        print(f"\033[91mFile upload error: {e}\033[0m")
+def send_auth_success(client, protocol_version):
+    """Acknowledge a login on either engine.
 
+    The legacy AUTH_SUCCESS is a fixed prefix that the old client splits off
+    whatever follows it in the same read, so nothing has to wait after it.
+    """
+    if protocol_version is not None:
+        client.send(auth_success_ack(protocol_version))
+    else:
+        client.send(b"AUTH_SUCCESS")
 
 
-def handle_file_download(client, unique_filename):
-    try:
-        file_path = os.path.join(UPLOAD_DIR, unique_filename)
-        if os.path.exists(file_path):
-            with open(file_path, "rb") as f:
-                file_data = f.read()
-            compressed_data = gzip.compress(file_data)
-            file_info = {
-                "type": "file_download",
-                "filename": unique_filename,
-                "size": len(file_data),
-                "compressed_size": len(compressed_data),
-            }
-
-            info_json = json.dumps(file_info).encode("utf-8")
-            client.send(f"FILE_INFO:{len(info_json)}:".encode("utf-8"))
-            client.send(info_json)
-            client.recv(1024)
-            client.send(f"FILE_DATA_START:{len(compressed_data)}".encode("utf-8"))
-            bytes_sent = 0
-            while bytes_sent < len(compressed_data):
-                chunk_size = min(BUFFER_SIZE, len(compressed_data) - bytes_sent)
-                chunk = compressed_data[bytes_sent : bytes_sent + chunk_size]
-                client.send(chunk)
-                bytes_sent += chunk_size
-
-            client.send("DOWNLOAD_COMPLETE".encode("utf-8"))
-        else:
-            client.send("FILE_NOT_FOUND".encode("utf-8"))
-    except Exception as e:
-        client.send("DOWNLOAD_ERROR".encode("utf-8"))
+def send_history_backlog(client):
+    """Replay the last HISTORY_BACKLOG chat lines to a framed client that just logged in"""
+    if client.framed and HISTORY_BACKLOG > 0:
+        client.send_command(build_history_message())
 
 
+def handle_bus_event(kind, payload, body):
+    """Apply an event published by another worker process"""
+    if kind == "chat":
+        channel = (payload or {}).get("channel", DEFAULT_CHANNEL)
+        broadcast_local(body, channel)
+        if channel == DEFAULT_CHANNEL:
+            record_chat(body)
+    elif kind == "file_added":
+        with metadata_lock:
+            add_to_catalog(payload, retain_blob=True)
+    elif kind == "file_updated":
+        with metadata_lock:
+            catalog.add(payload)
+    elif kind == "file_removed":
+        with metadata_lock:
+            remove_from_catalog(payload["unique_filename"])
+    elif kind == "transfer_granted":
+        store_parallel_transfer(
+            ParallelTransfer(
+                payload["token"],
+                None,
+                payload["nickname"],
+                payload["kind"],
+                payload["target"],
+                payload["codecs"] and tuple(payload["codecs"]),
+                payload["expires"],
+            )
+        )
+    elif kind == "upload_finished":
+        with transfers_lock:
+            grant = transfers.get(payload["token"])
+        if grant is not None and grant.owner is not None:
+            finish_file_upload(grant.owner, payload["file_info"])
+    elif kind == "tracing":
+        tracer.configure(payload)
+    elif kind == "direct_message":
+        if payload["worker"] == worker_index and not deliver_direct_message(payload["message"]):
+            mailboxes.put(payload["message"]["to"], payload["message"])
+    elif kind == "presence":
+        update_remote_presence(payload)
+    elif kind == "presence_snapshot":
+        replace_remote_presence(payload)
+    elif kind == "presence_sync":
+        publish_presence_snapshot()
 
-def handle(client):
-    nickname = None
-    try:
-        nickname_index = clients.index(client)
-        nickname = nicknames[nickname_index]
-    except:
-        pass
 
+def relay_bus_events():
+    """Bus reader thread of a threaded worker"""
     while True:
         try:
-            message = client.recv(1024)
-            message_str = message.decode("utf-8")
-            if message_str.startswith("UPLOAD_FILE:"):
-                parts = message_str.split(":", 3)
-                if len(parts) >= 4:
-                    filename = parts[1]
-                    file_size = int(parts[2])
-                    handle_file_upload(client, filename, file_size, nickname)
-                    continue
-            elif message_str == "GET_FILE_LIST":
-                send_file_list(client)
-                continue
-            elif message_str.startswith("DOWNLOAD_FILE:"):
-                unique_filename = message_str.split(":", 1)[1]
-                handle_file_download(client, unique_filename)
-                continue
-            else:
-                broadcast(message)
-
-        except:
-            if client in clients:
-                index = clients.index(client)
-                clients.remove(client)
-                client.close()
-                if index < len(nicknames):
-                    nickname = nicknames[index]
-                    nicknames.remove(nickname)
-                    broadcast(f"User {nickname} has left the chat room!".encode("utf-8"))
-                    print(
-                        f"\033[93mUser {nickname} has left, current online users: {len(clients)}\033[0m"
-                    )
+            handle_bus_event(*bus.receive())
+        except OSError:
             break
+        except Exception as e:
+            print(f"\033[91mWorker bus error: {e}\033[0m")
 
 
-# Handle new client connections
-def receive():
-    while True:
-        client, address = server.accept()
+def drain_bus_events():
+    """Event loop callback of an asyncio worker, called when the inbox is readable"""
+    for event in bus.receive_pending():
         try:
-            # Request nickname
-            client.send("NICK".encode("utf-8"))
-            nickname = client.recv(1024).decode("utf-8")
-            
-            # Request password
-            client.send("PASS".encode("utf-8"))
-            
-            # Use length prefix method to receive password
-            client.settimeout(3.0)  # 3秒超时
-            client_password = ""
-            try:
-                # 先接收4字节的长度信息
-                length_data = client.recv(4)
-                if len(length_data) == 4:
-                    password_length = int(length_data.decode("utf-8"))
-                    if password_length > 0:
-                        # 接收密码内容
-                        password_data = client.recv(password_length)
-                        client_password = password_data.decode("utf-8")
-                    else:
-                        # 密码长度为0，表示空密码
-                        client_password = ""
-                else:
-                    print(f"\033[91mInvalid password length data from {nickname}\033[0m")
-                    client_password = ""
-            except socket.timeout:
-                print(f"\033[93mPassword receive timeout for user {nickname}\033[0m")
-                client_password = ""
-            except Exception as e:
-                print(f"\033[91mError receiving password from {nickname}: {e}\033[0m")
-                client_password = ""
-            finally:
-                client.settimeout(None)  # 恢复阻塞模式
-            
-            # 密码验证逻辑
-            auth_success = False
-            if SERVER_PASSWORD:
-                if client_password == SERVER_PASSWORD:
-                    auth_success = True
-                    print(f"User {nickname} from {address} authentication successful")
-                else:
-                    client.send("AUTH_FAILED".encode("utf-8"))
-                    print(
-                        f"User {nickname} from {address} authentication failed - wrong password (received: '{client_password}')"
-                    )
-                    client.close()
-                    continue
-            else:
-                auth_success = True
-                print(f"User {nickname} from {address} authentication successful (no password required)")
-            
-            # 验证成功
-            if auth_success:
-                client.send("AUTH_SUCCESS".encode("utf-8"))
-                nicknames.append(nickname)
-                clients.append(client)
-
-                print(
-                    f"\033[95mUser {nickname} from {str(address)} has connected, current online users: {len(clients)}\033[0m"
-                )
-                
-                # 添加小延迟，确保AUTH_SUCCESS消息被客户端单独处理
-                time.sleep(0.1)
-                
-                broadcast(f"{nickname} has joined the chat room!".encode("utf-8"))
-                thread = threading.Thread(target=handle, args=(client,))
-                thread.start()
-                
+            handle_bus_event(*event)
         except Exception as e:
-            print(f"\033[91mError handling client connection from {address}: {e}\033[0m")
-            try:
-                client.close()
-            except:
-                pass
+            print(f"\033[91mWorker bus error: {e}\033[0m")
 
 
-# 启动服务器
-if __name__ == "__main__":
-    initialize_server()
+def serve():
+    start_metrics_endpoint()
     print("\033[92mServer is listening...\033[0m")
     try:
-        receive()
+        if SERVER_MODE == "asyncio":
+            asyncio.run(run_async_server())
+        else:
+            if bus:
+                threading.Thread(target=relay_bus_events, daemon=True).start()
+            receive()
     except KeyboardInterrupt:
         print("\n\033[93mServer is shutting down...\033[0m")
         server.close()
@@ -487,3 +837,1833 @@ if __name__ == "__main__":
     except Exception as e:
         print(f"\033[91mServer runtime error: {e}\033[0m")
         server.close()
+
+
+def run_worker(worker_id, bus_dir):
+    """Body of a forked worker process: its own listening socket, bus end and store handle"""
+    global server, bus, worker_index, tracer
+    worker_index = worker_id
+    metrics.reset()  # Startup work was counted in the parent
+    root, extension = os.path.splitext(TRACE_FILE)
+    tracer = Tracer(f"{root}.{worker_id}{extension}", TRACE_MAX_BYTES, TRACE_BACKUPS, TRACE_SAMPLE_RATE, worker_id)
+    server = create_listen_socket(reuse_port=True)
+    bus = WorkerBus(bus_dir, worker_id, SERVER_WORKERS)
+    reopen_metadata_store()
+    open_chat_history(writable=worker_id == 0)
+    # One worker rescans for everyone, the others learn about changes from the bus
+    if worker_id == 0 and CATALOG_RESCAN_INTERVAL > 0:
+        threading.Thread(target=rescan_upload_dir_periodically, daemon=True).start()
+    threading.Thread(target=sync_presence_periodically, daemon=True).start()
+    print(f"🚀 Worker {worker_id} (pid {os.getpid()}) listening on {SERVER_HOST}:{SERVER_PORT}")
+    serve()
+
+
+def run_worker_processes():
+    """Fork SERVER_WORKERS workers and wait for them; Ctrl+C or SIGTERM stops them all"""
+    metadata_store.close()  # Every worker opens its own handle
+    bus_dir = tempfile.mkdtemp(prefix="chat_bus_")
+    workers = {}
+    sys.stdout.flush()  # Or the children print the startup output again
+    for worker_id in range(SERVER_WORKERS):
+        pid = os.fork()
+        if pid == 0:
+            status = 0
+            try:
+                run_worker(worker_id, bus_dir)
+            except SystemExit as e:
+                status = e.code if isinstance(e.code, int) else 1
+            except BaseException as e:
+                print(f"\033[91mWorker {worker_id} failed: {e}\033[0m")
+                status = 1
+            finally:
+                os._exit(status)
+        workers[pid] = worker_id
+
+    def stop_workers(signum, frame):
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGTERM, stop_workers)
+    try:
+        while workers:
+            pid, status = os.wait()
+            worker_id = workers.pop(pid, None)
+            if worker_id is not None:
+                code = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+                print(f"\033[93mWorker {worker_id} exited with status {code}\033[0m")
+    except KeyboardInterrupt:
+        print("\n\033[93mServer is shutting down...\033[0m")
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in workers:
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+        print("\033[92mServer has been closed\033[0m")
+    finally:
+        shutil.rmtree(bus_dir, ignore_errors=True)
+
+
+class FileTransfer:
+    """Queued download rendition; the connection's writer sends it and closes the file"""
+
+    def __init__(self, file, count, offset=0, trace=NULL_TRACE):
+        self.file = file
+        self.count = count
+        self.offset = offset
+        self.trace = trace  # Held open by the download, finished once sent
+
+
+class OutboundQueue:
+    """Bounded send queue for one client.
+
+    Broadcasts and direct messages from other users are droppable: once
+    more than OUTBOUND_HIGH_WATER bytes are queued, SLOW_CONSUMER_POLICY
+    either drops the oldest queued ones or asks for the client to be
+    disconnected. Replies are never dropped; their senders wait for room
+    instead.
+    """
+
+    def __init__(self):
+        self.items = deque()
+        self.queued_bytes = 0
+        self.dropped = 0
+        self.closed = False
+
+    def put(self, item, size, droppable):
+        """Queue an item, returning False if the client should be disconnected"""
+        if droppable and self.queued_bytes + size > OUTBOUND_HIGH_WATER:
+            if SLOW_CONSUMER_POLICY == "disconnect":
+                return False
+            if not self._drop_oldest(self.queued_bytes + size - OUTBOUND_HIGH_WATER):
+                self._count_dropped(1)
+                return True
+        self.items.append((item, size, droppable))
+        self.queued_bytes += size
+        return True
+
+    def _drop_oldest(self, excess):
+        dropped = 0
+        while excess > 0 and self.items and self.items[0][2]:
+            _, size, _ = self.items.popleft()
+            self.queued_bytes -= size
+            excess -= size
+            dropped += 1
+        if excess > 0:
+            # Oldest entries are replies that must be delivered; drop broadcasts behind them
+            remaining = deque()
+            for entry in self.items:
+                if excess > 0 and entry[2]:
+                    self.queued_bytes -= entry[1]
+                    excess -= entry[1]
+                    dropped += 1
+                else:
+                    remaining.append(entry)
+            self.items = remaining
+        self._count_dropped(dropped)
+        return excess <= 0
+
+    def _count_dropped(self, count):
+        if count:
+            self.dropped += count
+            with outbound_counters_lock:
+                outbound_counters["dropped_messages"] += count
+
+    def get(self):
+        item, size, _ = self.items.popleft()
+        self.queued_bytes -= size
+        return item
+
+    def close(self):
+        self.closed = True
+        while self.items:
+            item = self.get()
+            if isinstance(item, FileTransfer):
+                item.file.close()
+                item.trace.finish(aborted=True)
+
+
+def count_slow_consumer_disconnect(nickname, queue):
+    with outbound_counters_lock:
+        outbound_counters["slow_consumer_disconnects"] += 1
+        total = outbound_counters["slow_consumer_disconnects"]
+    print(
+        f"\033[93mDisconnecting slow consumer {nickname} ({queue.queued_bytes} bytes queued), slow consumer disconnects so far: {total}\033[0m"
+    )
+
+
+class ClientConnection:
+    """A connected client socket, its negotiated wire format and its outbound queue.
+
+    A dedicated writer thread is the only thread that writes to the socket,
+    so broadcast() never blocks on a slow client.
+    """
+
+    def __init__(self, sock, nickname, framed=False):
+        self.sock = sock
+        self.nickname = nickname
+        self.framed = framed
+        self.codecs = None  # Set once the client lists the codecs it decodes
+        self.reader = FrameReader(sock, BUFFER_SIZE) if framed else None
+        self.upload_buffer = None
+        self.session = None  # Set once the connection joins the chat room
+        self.outbound = OutboundQueue()
+        self.outbound_ready = threading.Condition()
+        self.writer_thread = threading.Thread(target=self._write_loop, daemon=True)
+        self.writer_thread.start()
+
+    def _enqueue(self, item, size, droppable):
+        with self.outbound_ready:
+            if self.outbound.closed:
+                raise ConnectionError("Client connection closed")
+            while not droppable and self.outbound.queued_bytes > OUTBOUND_HIGH_WATER:
+                self.outbound_ready.wait()
+                if self.outbound.closed:
+                    raise ConnectionError("Client connection closed")
+            accepted = self.outbound.put(item, size, droppable)
+            self.outbound_ready.notify_all()
+        if not accepted:
+            count_slow_consumer_disconnect(self.nickname, self.outbound)
+            self.shutdown()
+
+    def _write_loop(self):
+        while True:
+            with self.outbound_ready:
+                while not self.outbound.items and not self.outbound.closed:
+                    self.outbound_ready.wait()
+                if self.outbound.closed:
+                    return
+                item = self.outbound.get()
+                self.outbound_ready.notify_all()
+            try:
+                if isinstance(item, FileTransfer):
+                    try:
+                        with item.trace.span("send"):
+                            self._send_file(item)
+                    finally:
+                        item.trace.finish()
+                    sent = item.count
+                else:
+                    self.sock.sendall(item)
+                    sent = len(item)
+                metrics.inc("bytes_sent_total", sent)
+                if self.session is not None:
+                    self.session.bytes_sent += sent
+            except OSError:
+                self.shutdown()
+                return
+
+    def _send_file(self, transfer):
+        """Copy a file straight from disk to the socket (os.sendfile where available)"""
+        with transfer.file:
+            if not self.framed:
+                self.sock.sendfile(transfer.file, transfer.offset, transfer.count)
+                return
+            offset = transfer.offset
+            end = transfer.offset + transfer.count
+            while offset < end:
+                size = min(BUFFER_SIZE, end - offset)
+                self.sock.sendall(encode_header(FRAME_DATA, size))
+                self.sock.sendfile(transfer.file, offset, size)
+                offset += size
+
+    def shutdown(self):
+        """Stop the writer and wake the handler thread blocked in recv()"""
+        with self.outbound_ready:
+            self.outbound.close()
+            self.outbound_ready.notify_all()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def close(self):
+        self.shutdown()
+        self.sock.close()
+
+    def send(self, data, droppable=False):
+        self._enqueue(data, len(data), droppable)
+
+    def recv(self, size):
+        data = self.sock.recv(size)
+        metrics.inc("bytes_received_total", len(data))
+        return data
+
+    def read_frame(self):
+        frame_type, payload = self.reader.read_frame()
+        metrics.inc("bytes_received_total", HEADER.size + len(payload))
+        return frame_type, payload
+
+    def send_frame(self, frame_type, payload, droppable=False):
+        if self.framed:
+            payload = encode_frame(frame_type, payload)
+        self.send(payload, droppable)
+
+    def send_message(self, message):
+        self.send_frame(FRAME_TEXT, message, droppable=True)
+
+    def send_command(self, command, droppable=False):
+        self.send_frame(FRAME_COMMAND, command, droppable)
+
+    def send_data(self, data):
+        self.send_frame(FRAME_DATA, data)
+
+    def send_file(self, file, count, offset=0, trace=NULL_TRACE):
+        """Queue a file for the writer, which takes ownership of it (and finishes trace once sent)"""
+        trace.hold()
+        try:
+            self._enqueue(FileTransfer(file, count, offset, trace), 0, False)
+        except ConnectionError:
+            trace.finish(aborted=True)
+            raise
+
+    def recv_data(self, max_size):
+        """Receive the next piece of an upload payload, valid until the next call"""
+        if not self.framed:
+            if self.upload_buffer is None:
+                self.upload_buffer = memoryview(bytearray(BUFFER_SIZE))
+            count = self.sock.recv_into(self.upload_buffer, min(max_size, BUFFER_SIZE))
+            metrics.inc("bytes_received_total", count)
+            return self.upload_buffer[:count]
+        frame_type, payload = self.read_frame()
+        if frame_type != FRAME_DATA:
+            raise ProtocolError(f"Expected file data, got frame type {frame_type}")
+        return payload
+
+
+def broadcast(message, channel=DEFAULT_CHANNEL):
+    """Queue a chat line for every member of channel; never waits on a client's socket.
+
+    Only the default channel is recorded in the chat history, which every
+    user gets replayed at login.
+    """
+    broadcast_local(message, channel)
+    if channel == DEFAULT_CHANNEL:
+        record_chat(message)
+    if bus:
+        bus.publish("chat", {"channel": channel} if channel != DEFAULT_CHANNEL else None, message, droppable=True)
+
+
+def broadcast_local(message, channel=DEFAULT_CHANNEL):
+    """Queue a chat line for the members of channel connected to this process"""
+    payload = encode_channel_text(channel, message)
+    with metrics.timer("broadcast_seconds"):
+        for client in sessions.members(channel):
+            try:
+                client.send_message(payload)
+            except:
+                pass
+
+
+def post_chat(session, payload):
+    """Broadcast a framed client's text frame in its channel, if the client is a member"""
+    channel, line = parse_channel_text(payload)
+    if channel in session.channels:
+        broadcast(line, channel)
+
+
+def handle_channel_command(session, message):
+    """Answer JOIN:<channel> and PART:<channel>; FOCUS:<channel> picks where uploads are announced and has no reply"""
+    command, _, channel = message.decode("utf-8", errors="replace").partition(":")
+    if not is_channel_name(channel):
+        return f"CHANNEL_ERROR:{channel}:invalid channel name".encode("utf-8")
+    if command == "JOIN":
+        if sessions.join(session.connection, channel):
+            broadcast(f"{session.nickname} has joined #{channel}".encode("utf-8"), channel)
+        return f"JOINED:{channel}".encode("utf-8")
+    if command == "PART":
+        if sessions.part(session.connection, channel):
+            broadcast(f"{session.nickname} has left #{channel}".encode("utf-8"), channel)
+        return f"PARTED:{channel}".encode("utf-8")
+    if channel in session.channels:
+        session.channel = channel
+    return None
+
+
+def encode_direct_message(message):
+    body = json.dumps(message).encode("utf-8")
+    return f"DM:{len(body)}:".encode("utf-8") + body
+
+
+def deliver_direct_message(message):
+    """Send a direct message to its recipient's sessions on this process; False if there are none"""
+    targets = sessions.find(message["to"])
+    if not targets:
+        return False
+    payload = encode_direct_message(message)
+    for session in targets:
+        # Droppable like a broadcast: a stalled recipient meets slow_consumer_policy
+        # instead of blocking the sender's handler or the bus thread
+        try:
+            if session.connection.framed:
+                session.connection.send_command(payload, droppable=True)
+            else:
+                session.connection.send_message(f"[DM] {message['from']}: {message['text']}".encode("utf-8"))
+        except ConnectionError:
+            pass
+    return True
+
+
+def route_direct_message(message):
+    """Deliver locally, pass on to the worker serving the recipient, or queue; returns "sent" or "queued" """
+    if deliver_direct_message(message):
+        return "sent"
+    worker = remote_worker_of(message["to"])
+    if worker is not None:
+        # That worker queues it itself should the recipient have just left
+        bus.publish("direct_message", {"worker": worker, "message": message})
+        return "sent"
+    mailboxes.put(message["to"], message)
+    return "queued"
+
+
+def handle_direct_message(session, request):
+    """Answer DM:<json {"to", "text"}> with DM_SENT:<nickname>, DM_QUEUED:<nickname> or DM_ERROR:<reason>"""
+    try:
+        fields = json.loads(request[len(b"DM:"):].decode("utf-8"))
+        recipient, text = fields["to"], fields["text"]
+    except (ValueError, KeyError, TypeError):
+        return b"DM_ERROR:malformed request"
+    if not isinstance(recipient, str) or not isinstance(text, str) or not recipient or not text:
+        return b"DM_ERROR:malformed request"
+    if len(text) > DM_MAX_LENGTH:
+        return f"DM_ERROR:message longer than {DM_MAX_LENGTH} characters".encode("utf-8")
+    message = {"from": session.nickname, "to": recipient, "text": text, "time": time.time()}
+    outcome = route_direct_message(message)
+    metrics.inc("direct_messages_total", outcome=outcome)
+    return f"DM_{outcome.upper()}:{recipient}".encode("utf-8")
+
+
+def add_session(connection, nickname):
+    """Register a connection that just logged in and announce it, returning its Session.
+
+    Nicknames are not authenticated, so mail waiting for one goes to the
+    first session that claims it; a second concurrent session gets none.
+    """
+    with local_presence_lock:
+        session = sessions.add(connection, nickname, DEFAULT_CHANNEL)
+        first = len(sessions.find(nickname)) == 1 and remote_worker_of(nickname) is None
+        publish_presence(nickname, True)
+    if first:
+        deliver_mailbox(nickname)
+    return session
+
+
+def remove_session(connection):
+    """Unregister a connection and announce it, returning its Session or None"""
+    with local_presence_lock:
+        session = sessions.remove(connection)
+        if session is not None:
+            publish_presence(session.nickname, False)
+    return session
+
+
+def deliver_mailbox(nickname):
+    """Hand a user who just logged in the direct messages sent while they were offline"""
+    for message in mailboxes.take(nickname):
+        message["offline"] = True
+        if not deliver_direct_message(message):
+            mailboxes.put(nickname, message)
+
+
+def forward_mailbox(nickname, worker):
+    for message in mailboxes.take(nickname):
+        message["offline"] = True
+        bus.publish("direct_message", {"worker": worker, "message": message})
+
+
+def publish_presence(nickname, online):
+    """Tell the other workers where nickname is logged in; those holding mail for it send it over"""
+    if bus:
+        bus.publish("presence", {"nickname": nickname, "worker": worker_index, "online": online})
+
+
+def publish_presence_snapshot():
+    """Send every user logged in on this worker, replacing what the others believe"""
+    with local_presence_lock:
+        bus.publish("presence_snapshot", {"worker": worker_index, "users": sessions.nickname_counts()})
+
+
+def sync_presence_periodically():
+    """Presence events can be dropped when the bus is congested; snapshots repair the tables"""
+    bus.publish("presence_sync")  # Workers started earlier send theirs right away
+    last_sync = time.monotonic()
+    dropped = bus.dropped
+    while True:
+        time.sleep(1)
+        if bus.dropped != dropped or time.monotonic() - last_sync >= PRESENCE_SYNC_INTERVAL:
+            dropped = bus.dropped
+            last_sync = time.monotonic()
+            publish_presence_snapshot()
+
+
+def update_remote_presence(payload):
+    nickname, worker = payload["nickname"], payload["worker"]
+    with remote_presence_lock:
+        workers = remote_presence.setdefault(nickname, {})
+        first = not workers
+        workers[worker] = workers.get(worker, 0) + (1 if payload["online"] else -1)
+        if workers[worker] <= 0:
+            del workers[worker]
+            if not workers:
+                del remote_presence[nickname]
+    if payload["online"] and first:
+        forward_mailbox(nickname, worker)
+
+
+def replace_remote_presence(payload):
+    worker, users = payload["worker"], payload["users"]
+    with remote_presence_lock:
+        for nickname in list(remote_presence):
+            workers = remote_presence[nickname]
+            if workers.pop(worker, None) is not None and not workers:
+                del remote_presence[nickname]
+        for nickname, count in users.items():
+            remote_presence.setdefault(nickname, {})[worker] = count
+    # Mail queued here because an online event never arrived
+    for nickname in mailboxes.nicknames():
+        if nickname in users:
+            forward_mailbox(nickname, worker)
+
+
+def remote_worker_of(nickname):
+    """A worker process that nickname is logged in on, None if there is none"""
+    with remote_presence_lock:
+        workers = remote_presence.get(nickname)
+        return next(iter(workers)) if workers else None
+
+
+def leave_channels(session):
+    """Tell the other members of a disconnected user's channels, beyond the default one"""
+    for channel in session.channels:
+        if channel != DEFAULT_CHANNEL:
+            broadcast(f"{session.nickname} has left #{channel}".encode("utf-8"), channel)
+
+
+def build_file_list_message():
+    return catalog.list_message()
+
+
+def send_file_list(client, trace=NULL_TRACE):
+    with trace.span("build"):
+        message = build_file_list_message()
+    with trace.span("queue"):
+        client.send_command(message)
+
+
+class UploadSink:
+    """Decompress an upload chunk by chunk into a temp file in UPLOAD_DIR.
+
+    Memory use is bounded by BUFFER_SIZE whatever the file size. Once the
+    decompressed size passes MAX_FILE_SIZE the rest of the stream is
+    discarded, so the caller can keep draining the socket and reply with
+    UPLOAD_ERROR. The client's compressed stream is kept as the file's
+    download rendition in the compressed cache. With dedup enabled the
+    content is hashed as it is written and stored as a blob named by its
+    digest.
+    """
+
+    def __init__(self, filename, uploader, expected_sha256=None, codec=DEFAULT_CODEC, trace=NULL_TRACE):
+        self.filename = filename
+        self.uploader = uploader
+        self.size = 0
+        self.compressed_size = 0
+        self.cpu_time = 0.0  # Spent decompressing, for compression_cpu_seconds_total
+        self.trace = trace
+        self.error = None
+        self.codec = codec
+        self.decompressor = StreamDecompressor(codec)
+        self.expected_sha256 = expected_sha256
+        self.hasher = hashlib.sha256() if DEDUP_UPLOADS or expected_sha256 else None
+        fd, self.temp_path = tempfile.mkstemp(
+            prefix=UPLOAD_TEMP_PREFIX, suffix=".part", dir=UPLOAD_DIR
+        )
+        self.file = os.fdopen(fd, "wb")
+        self.cache_file = None
+        if download_cache.enabled and codec != "none":
+            self.cache_file, self.cache_temp_path = download_cache.create_temp()
+
+    def _write_output(self, data):
+        if self.size + len(data) > MAX_FILE_SIZE:
+            self.error = f"file exceeds the {MAX_FILE_SIZE} byte limit"
+            self.abort()
+            return
+        self.file.write(data)
+        if self.hasher:
+            self.hasher.update(data)
+        self.size += len(data)
+
+    def write(self, chunk):
+        self.compressed_size += len(chunk)
+        if self.error:
+            return
+        if self.cache_file:
+            with self.trace.span("cache_write"):
+                self.cache_file.write(chunk)
+        started = time.thread_time()
+        mark = time.perf_counter()
+        for data in self.decompressor.decompress(chunk, BUFFER_SIZE):
+            decompressed = time.perf_counter()
+            self.trace.add("decompress", decompressed - mark)
+            self._write_output(data)
+            mark = time.perf_counter()
+            self.trace.add("write", mark - decompressed)
+            if self.error:
+                break
+        self.cpu_time += time.thread_time() - started
+
+    def finish(self):
+        """Move the completed upload into place and record its metadata"""
+        if not self.error:
+            with self.trace.span("decompress"):
+                data = self.decompressor.flush()
+            with self.trace.span("write"):
+                self._write_output(data)
+        if not self.error and not self.decompressor.eof:
+            self.error = f"incomplete {self.codec} stream"
+            self.abort()
+        if not self.error and self.expected_sha256 and self.hasher.hexdigest() != self.expected_sha256:
+            self.error = "content does not match the announced SHA-256"
+            self.abort()
+        if self.error:
+            raise ValueError(self.error)
+        self.file.close()
+        os.chmod(self.temp_path, 0o644)  # mkstemp creates owner-only files
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        unique_filename = f"{timestamp}_{self.filename}"
+        codec, ratio = self.codec, compression_ratio(self.size, self.compressed_size)
+        if self.codec != "none":
+            metrics.observe("compression_ratio", ratio, source="upload", codec=self.codec)
+            metrics.inc("compression_cpu_seconds_total", self.cpu_time, operation="decompress")
+        if ADAPTIVE_COMPRESSION and codec != "none" and ratio > INCOMPRESSIBLE_RATIO:
+            # Compression did not pay off for this upload, so downloads skip it
+            codec, ratio = "none", 1.0
+        file_info = {
+            "filename": self.filename,
+            "unique_filename": unique_filename,
+            "uploader": self.uploader,
+            "upload_time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "size": self.size,
+            "compressed_size": self.compressed_size,
+            "codec": codec,
+            "compression_ratio": ratio,
+        }
+        with metadata_lock:
+            with self.trace.span("store"):
+                if DEDUP_UPLOADS:
+                    digest = self.hasher.hexdigest()
+                    file_info["sha256"] = digest
+                    is_new = blob_store.store(self.temp_path, digest)
+                    file_path, cache_name = blob_store.path(digest), digest
+                else:
+                    file_path = os.path.join(UPLOAD_DIR, unique_filename)
+                    os.replace(self.temp_path, file_path)
+                    is_new, cache_name = True, unique_filename
+            with self.trace.span("metadata_save"):
+                record_file_metadata(file_info)
+        self.trace.set(size=self.size, compressed_size=self.compressed_size, codec=codec)
+        if self.cache_file:
+            self.cache_file.close()
+            if is_new and codec == self.codec:
+                download_cache.commit(
+                    self.cache_temp_path, cache_name, os.stat(file_path), codec
+                ).close()
+            else:
+                download_cache.discard_temp(self.cache_temp_path)
+        return file_info
+
+    def abort(self):
+        self.file.close()
+        if os.path.exists(self.temp_path):
+            os.remove(self.temp_path)
+        if self.cache_file:
+            self.cache_file.close()
+            download_cache.discard_temp(self.cache_temp_path)
+
+
+def accept_announced_upload(message, uploader):
+    """Handle UPLOAD_HASH:<filename>:<size>:<sha256>, sent by clients before uploading.
+
+    When the content is already stored the upload is recorded without any
+    data being transferred and its file info is returned, otherwise None.
+    """
+    if not DEDUP_UPLOADS:
+        return None
+    try:
+        _, filename, size, digest = message.decode("utf-8").rsplit(":", 3)
+        digest = digest.lower()
+        if not is_digest(digest) or not blob_store.add_reference(digest, int(size)):
+            return None
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        file_info = {
+            "filename": filename,
+            "unique_filename": f"{timestamp}_{filename}",
+            "uploader": uploader,
+            "upload_time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "size": int(size),
+            "compressed_size": 0,  # Nothing was transferred
+            "sha256": digest,
+        }
+        with metadata_lock:
+            record_file_metadata(file_info)
+        return file_info
+    except Exception as e:
+        print(f"\033[91mUpload announcement error: {e}\033[0m")
+        return None
+
+
+def begin_chunked_upload(message, with_codec=False):
+    """Handle UPLOAD_RESUME:<sha256>:<compressed_size>:<chunk_size>:<filename>.
+
+    Clients that negotiated codecs send <codec> before <filename>; the
+    others upload gzip. Returns the reply, UPLOAD_OFFSET:<sha256>:<index>
+    naming the first chunk the client still has to send.
+    """
+    try:
+        if with_codec:
+            _, upload_id, compressed_size, chunk_size, codec, filename = message.decode("utf-8").split(":", 5)
+            if codec not in CODECS:
+                raise ValueError(f"unknown codec {codec!r}")
+        else:
+            _, upload_id, compressed_size, chunk_size, filename = message.decode("utf-8").split(":", 4)
+            codec = DEFAULT_CODEC
+        upload_id = upload_id.lower()
+        compressed_size = int(compressed_size)
+        chunk_size = int(chunk_size)
+        if not is_digest(upload_id) or os.path.basename(filename) != filename or not filename:
+            raise ValueError("invalid chunked upload request")
+        if not 0 < chunk_size <= MAX_CHUNK_SIZE:
+            raise ValueError(f"chunk size must be between 1 and {MAX_CHUNK_SIZE} bytes")
+        # No codec grows data by more than a fraction of a percent
+        if not 0 < compressed_size <= MAX_FILE_SIZE + MAX_FILE_SIZE // 100 + 1024:
+            raise ValueError(f"file exceeds the {MAX_FILE_SIZE} byte limit")
+        with partial_uploads_lock:
+            partial = partial_uploads.get(upload_id)
+            # The files are gone once another worker process finished the same upload
+            if partial is None or not partial.matches(compressed_size, chunk_size, codec) or not partial.exists():
+                partial = PartialUpload.open(
+                    UPLOAD_DIR, upload_id, filename, compressed_size, chunk_size, codec
+                )
+                partial_uploads[upload_id] = partial
+        return f"UPLOAD_OFFSET:{upload_id}:{partial.next_chunk()}"
+    except Exception as e:
+        print(f"\033[91mFile upload error: {e}\033[0m")
+        return "UPLOAD_ERROR"
+
+
+def find_partial_upload(upload_id):
+    """The chunked upload in progress under upload_id, or None.
+
+    An upload begun by another worker process, or before a restart, is
+    loaded from disk.
+    """
+    if not is_digest(upload_id):
+        return None
+    with partial_uploads_lock:
+        partial = partial_uploads.get(upload_id)
+        if partial is None:
+            partial = PartialUpload.load(UPLOAD_DIR, upload_id)
+            if partial is not None:
+                partial_uploads[upload_id] = partial
+        return partial
+
+
+def finish_chunked_upload(partial, uploader, trace=NULL_TRACE):
+    """Decompress a completed chunked upload into place, like a streamed one"""
+    sink = UploadSink(
+        partial.filename, uploader, expected_sha256=partial.upload_id, codec=partial.codec, trace=trace
+    )
+    try:
+        with partial.open_stream() as stream:
+            while True:
+                with trace.span("read"):
+                    block = stream.read(BUFFER_SIZE)
+                if not block:
+                    break
+                sink.write(block)
+        return sink.finish()
+    except Exception:
+        sink.abort()
+        raise
+
+
+def store_upload_chunk(message, data, uploader, upload_id=None, trace=NULL_TRACE):
+    """Handle UPLOAD_CHUNK:<sha256>:<index>:<crc32> and the DATA frame after it.
+
+    Returns (reply, file_info). The reply is CHUNK_ACK for a stored chunk and
+    CHUNK_NACK for one that failed its checksum and has to be resent.
+    file_info is set once this chunk completed the upload. A data connection
+    passes the upload_id its transfer token was issued for.
+    """
+    partial = None
+    try:
+        _, chunk_upload_id, index, checksum = message.decode("utf-8").split(":")
+        chunk_upload_id = chunk_upload_id.lower()
+        if upload_id is not None and chunk_upload_id != upload_id:
+            raise ValueError(f"transfer token is not valid for upload {chunk_upload_id}")
+        index = int(index)
+        partial = find_partial_upload(chunk_upload_id)
+        if partial is None:
+            raise ValueError(f"no chunked upload {chunk_upload_id} in progress")
+        with trace.span("chunk_write"):
+            stored = partial.write_chunk(index, checksum, data)
+        if not stored:
+            return f"CHUNK_NACK:{partial.upload_id}:{index}", None
+        reply = f"CHUNK_ACK:{partial.upload_id}:{index}"
+        if not partial.take_completion():
+            return reply, None
+        with partial_uploads_lock:
+            partial_uploads.pop(partial.upload_id, None)
+        trace.set(completed=True)
+        try:
+            return reply, finish_chunked_upload(partial, uploader, trace)
+        finally:
+            partial.discard()
+    except Exception as e:
+        print(f"\033[91mFile upload error: {e}\033[0m")
+        return "UPLOAD_ERROR", None
+
+
+def reply_to_upload_chunk(client, reply, file_info, grant=None):
+    """Answer a chunk; a completed upload is acknowledged on the chat connection of its uploader"""
+    if reply:
+        client.send_command(reply.encode("utf-8"))
+    if not file_info:
+        return
+    if grant is None:
+        finish_file_upload(client, file_info)
+    elif grant.owner is not None:
+        finish_file_upload(grant.owner, file_info)
+    else:
+        # Granted by another worker process, which holds the chat connection
+        bus.publish("upload_finished", {"token": grant.token, "file_info": file_info})
+
+
+def finish_file_upload(client, file_info):
+    """Announce a stored upload in the uploader's focused channel and acknowledge it to the uploader"""
+    session = client.session
+    announce_file_upload(file_info, session.channel if session and session.channel else DEFAULT_CHANNEL)
+    client.send_command("UPLOAD_SUCCESS".encode("utf-8"))
+
+
+def announce_file_upload(file_info, channel=DEFAULT_CHANNEL):
+    notification = (
+        f"{file_info['uploader']} uploaded a file: {file_info['filename']} (size: {file_info['size']} bytes)"
+    )
+    broadcast(notification.encode("utf-8"), channel)
+    print(
+        f"File uploaded successfully: {file_info['filename']} by {file_info['uploader']} (original size: {file_info['size']}, compressed size: {file_info['compressed_size']}, codec: {file_info.get('codec', DEFAULT_CODEC)})"
+    )
+    if file_info.get("sha256"):
+        print(f"   Stored as blob {file_info['sha256']}")
+
+
+def handle_file_upload(client, filename, file_size, uploader, initial_data=b"", trace=NULL_TRACE):
+    sink = None
+    try:
+        sink = UploadSink(filename, uploader, trace=trace)
+        # Part of the payload may have arrived in the same read as the UPLOAD_FILE header
+        initial_data = initial_data[:file_size]
+        sink.write(initial_data)
+        bytes_received = len(initial_data)
+        while bytes_received < file_size:
+            chunk_size = min(BUFFER_SIZE, file_size - bytes_received)
+            with trace.span("recv"):
+                chunk = client.recv_data(chunk_size)
+            if not chunk:
+                raise ConnectionError("connection closed during upload")
+            sink.write(chunk)
+            bytes_received += len(chunk)
+        file_info = sink.finish()
+        with trace.span("announce"):
+            finish_file_upload(client, file_info)
+
+    except Exception as e:
+        if sink:
+            sink.abort()
+        client.send_command("UPLOAD_ERROR".encode("utf-8"))
+        print(f"\033[91mFile upload error: {e}\033[0m")
+
+
+def accepted_codecs(client):
+    """Codecs a client decodes; clients that never sent CODECS only know gzip"""
+    return client.codecs or (DEFAULT_CODEC,)
+
+
+def negotiate_codecs(client, message):
+    """Handle CODECS:<names>, returning the codecs both sides support in the same form"""
+    offered = parse_codecs(message.decode("utf-8").split(":", 1)[1])
+    client.codecs = tuple(codec for codec in CODECS if codec in offered) or (DEFAULT_CODEC,)
+    return "CODECS:" + ",".join(client.codecs)
+
+
+def stored_file_codec(file_info, file_path):
+    """The codec a stored file is sent with, sampled for files catalogued without one"""
+    if file_info and file_info.get("codec") in CODECS:
+        return file_info["codec"]
+    if not ADAPTIVE_COMPRESSION:
+        return COMPRESS_CODEC
+    filename = file_info["filename"] if file_info else os.path.basename(file_path)
+    return choose_codec(filename, read_sample(file_path), COMPRESS_CODEC)
+
+
+def open_file_download(unique_filename, codecs=(DEFAULT_CODEC,), trace=NULL_TRACE):
+    """Return (file_info, rendition opened for reading), or None if the file does not exist.
+
+    The rendition is compressed with the file's codec when the client
+    decodes it and with gzip otherwise; a file sent with "none" is read
+    straight from storage.
+    """
+    if os.path.basename(unique_filename) != unique_filename or not is_stored_file(unique_filename):
+        return None
+    file_path, cache_name = stored_file_location(unique_filename)
+    if not os.path.isfile(file_path):
+        with metadata_lock:
+            forget_file_metadata(unique_filename)
+        return None
+    stats = os.stat(file_path)
+    record = catalog.get(unique_filename)
+    with trace.span("choose_codec"):
+        chosen = stored_file_codec(record, file_path)
+    codec = chosen if chosen in codecs else DEFAULT_CODEC
+    trace.set(codec=codec)
+    if codec == "none":
+        rendition = open(file_path, "rb")
+    else:
+        with trace.span("cache_lookup"):
+            rendition = download_cache.open(cache_name, stats, codec)
+        if rendition is None:
+            started = time.thread_time()
+            with trace.span("compress"):
+                rendition = download_cache.build(cache_name, file_path, stats, codec)
+            metrics.inc("compression_cpu_seconds_total", time.thread_time() - started, operation="compress")
+            metrics.observe(
+                "compression_ratio",
+                compression_ratio(stats.st_size, os.fstat(rendition.fileno()).st_size),
+                source="rendition",
+                codec=codec,
+            )
+    rendition_stats = os.fstat(rendition.fileno())
+    if record is not None and "codec" not in record and codec == chosen:
+        # Sampled once; later downloads read the choice from the catalog
+        with metadata_lock:
+            if catalog.get(unique_filename) is record:
+                update_file_metadata(
+                    dict(
+                        record,
+                        codec=codec,
+                        compression_ratio=compression_ratio(stats.st_size, rendition_stats.st_size),
+                    )
+                )
+    file_info = {
+        "type": "file_download",
+        "filename": unique_filename,
+        "size": stats.st_size,
+        "compressed_size": rendition_stats.st_size,
+        "codec": codec,
+        "chunk_size": CHUNK_SIZE,
+        # Changes whenever the rendition is rebuilt, so a resumed download can tell it is stale
+        "etag": f"{rendition_stats.st_size:x}-{rendition_stats.st_mtime_ns:x}",
+    }
+    return file_info, rendition
+
+
+def parse_download_range(spec, compressed_size):
+    """Return (offset, count) for bytes=<start>-[<end>] or chunk=<index>, or None if unsatisfiable"""
+    try:
+        if spec.startswith("chunk="):
+            start = int(spec[len("chunk="):]) * CHUNK_SIZE
+            end = compressed_size
+        elif spec.startswith("bytes="):
+            start, _, end = spec[len("bytes="):].partition("-")
+            start = int(start)
+            end = min(int(end) + 1, compressed_size) if end else compressed_size
+        else:
+            return None
+    except ValueError:
+        return None
+    if start < 0 or start >= end:
+        return None
+    return start, end - start
+
+
+def download_data_start(file_info, spec):
+    """The command announcing the data, and the (offset, count) to send from the rendition"""
+    compressed_size = file_info["compressed_size"]
+    if spec is None:
+        return f"FILE_DATA_START:{compressed_size}", (0, compressed_size)
+    byte_range = parse_download_range(spec, compressed_size)
+    if byte_range is None:
+        raise ValueError(f"unsatisfiable range {spec}")
+    offset, count = byte_range
+    return f"FILE_RANGE_START:{offset}:{count}", byte_range
+
+
+def handle_file_download(client, unique_filename, spec=None, trace=NULL_TRACE):
+    try:
+        prepared = open_file_download(unique_filename, accepted_codecs(client), trace)
+        if prepared:
+            file_info, rendition = prepared
+            try:
+                info_json = json.dumps(file_info).encode("utf-8")
+                info_header = f"FILE_INFO:{len(info_json)}:".encode("utf-8")
+                if client.framed:
+                    # One frame carries the whole header, no READY round trip needed
+                    client.send_command(info_header + info_json)
+                else:
+                    client.send(info_header)
+                    client.send(info_json)
+                    with trace.span("ready_wait"):
+                        client.recv(1024)
+                start_command, (offset, count) = download_data_start(file_info, spec)
+                trace.set(bytes=count)
+                client.send_command(start_command.encode("utf-8"))
+                client.send_file(rendition, count, offset, trace)
+            except Exception:
+                rendition.close()
+                raise
+
+            client.send_command("DOWNLOAD_COMPLETE".encode("utf-8"))
+        else:
+            client.send_command("FILE_NOT_FOUND".encode("utf-8"))
+    except Exception as e:
+        print(f"\033[91mError sending {unique_filename} to {client.nickname}: {e}\033[0m")
+        client.send_command("DOWNLOAD_ERROR".encode("utf-8"))
+
+
+
+class ParallelTransfer:
+    """Grant letting extra data connections move one file for an authenticated client"""
+
+    def __init__(self, token, owner, nickname, kind, target, codecs, expires=None):
+        self.token = token
+        # Connection that asked for the transfer, told when an upload completes;
+        # None for a grant made by another worker process
+        self.owner = owner
+        self.nickname = nickname
+        self.kind = kind  # "download" of a unique_filename or "upload" of a chunked upload id
+        self.target = target
+        self.codecs = codecs  # What the owner decodes, for the FILE_INFO of every range
+        self.expires = expires or time.time() + TRANSFER_TOKEN_TTL
+
+
+def store_parallel_transfer(grant):
+    now = time.time()
+    with transfers_lock:
+        for expired in [
+            t for t, held in transfers.items() if held.expires + TRANSFER_GRANT_RETENTION < now
+        ]:
+            del transfers[expired]
+        transfers[grant.token] = grant
+
+
+def grant_parallel_transfer(owner, nickname, kind, target):
+    grant = ParallelTransfer(secrets.token_hex(16), owner, nickname, kind, target, owner.codecs)
+    store_parallel_transfer(grant)
+    if bus:
+        # Data connections may be accepted by any worker
+        bus.publish(
+            "transfer_granted",
+            {
+                "token": grant.token,
+                "nickname": nickname,
+                "kind": kind,
+                "target": target,
+                "codecs": grant.codecs,
+                "expires": grant.expires,
+            },
+        )
+    return grant.token
+
+
+def redeem_parallel_transfer(token):
+    with transfers_lock:
+        grant = transfers.get(token)
+    if grant is None or grant.expires < time.time():
+        return None
+    return grant
+
+
+def begin_parallel_transfer(owner, nickname, message):
+    """Handle PARALLEL_DOWNLOAD:<unique_filename> and PARALLEL_UPLOAD:<sha256>.
+
+    Returns TRANSFER_TOKEN:<token>:<streams>:<json>, where the JSON is the
+    file's FILE_INFO for a download and lists the chunks still missing for
+    an upload. The client then opens up to <streams> data connections.
+    """
+    command, target = message.decode("utf-8").split(":", 1)
+    try:
+        if command == "PARALLEL_DOWNLOAD":
+            prepared = open_file_download(target, accepted_codecs(owner))
+            if prepared is None:
+                return "FILE_NOT_FOUND"
+            details, rendition = prepared
+            rendition.close()
+            kind = "download"
+        else:
+            target = target.lower()
+            partial = find_partial_upload(target)
+            if partial is None:
+                raise ValueError(f"no chunked upload {target} in progress")
+            details = {"upload_id": target, "missing": partial.missing_chunks()}
+            kind = "upload"
+        token = grant_parallel_transfer(owner, nickname, kind, target)
+        return f"TRANSFER_TOKEN:{token}:{PARALLEL_STREAMS}:{json.dumps(details)}"
+    except Exception as e:
+        print(f"\033[91mParallel transfer error: {e}\033[0m")
+        return "DOWNLOAD_ERROR" if command == "PARALLEL_DOWNLOAD" else "UPLOAD_ERROR"
+
+
+def handle_data_connection(connection, grant):
+    """Serve the DOWNLOAD_RANGE or UPLOAD_CHUNK requests of one parallel transfer"""
+    try:
+        while True:
+            frame_type, payload = connection.read_frame()
+            if frame_type != FRAME_COMMAND:
+                continue
+            message = bytes(payload)
+            command = command_name(message)
+            trace = tracer.start(command, grant.nickname, data_connection=True)
+            profile = tracer.start_profile(command, grant.nickname)
+            try:
+                if grant.kind == "download" and message.startswith(b"DOWNLOAD_RANGE:"):
+                    parts = message.decode("utf-8").split(":", 2)
+                    if len(parts) == 3 and parts[2] == grant.target:
+                        handle_file_download(connection, parts[2], parts[1], trace)
+                    else:
+                        connection.send_command("FILE_NOT_FOUND".encode("utf-8"))
+                elif grant.kind == "upload" and message.startswith(b"UPLOAD_CHUNK:"):
+                    with trace.span("recv"):
+                        data = connection.recv_data(MAX_CHUNK_SIZE)
+                    reply = store_upload_chunk(message, data, grant.nickname, grant.target, trace)
+                    with trace.span("reply"):
+                        reply_to_upload_chunk(connection, *reply, grant=grant)
+            finally:
+                profile.stop()
+                trace.finish()
+    except Exception:
+        pass
+    finally:
+        connection.close()
+
+
+def accept_data_connection(sock, address, token):
+    grant = redeem_parallel_transfer(token)
+    if grant is None:
+        metrics.inc("auth_failures_total")
+        sock.send("AUTH_FAILED".encode("utf-8"))
+        sock.close()
+        print(f"\033[93mRejected data connection from {address}: unknown or expired transfer token\033[0m")
+        return
+    connection = ClientConnection(sock, grant.nickname, framed=True)
+    connection.codecs = grant.codecs
+    connection.send(auth_success_ack(PROTOCOL_VERSION))
+    threading.Thread(
+        target=handle_data_connection, args=(connection, grant), daemon=True
+    ).start()
+
+
+def handle(client):
+    nickname = client.nickname
+    session = client.session
+
+    while True:
+        try:
+            if client.framed:
+                frame_type, payload = client.read_frame()
+                session.touch()
+                if frame_type == FRAME_TEXT:
+                    post_chat(session, bytes(payload))
+                    continue
+                if frame_type != FRAME_COMMAND:
+                    continue
+                message = bytes(payload)
+            else:
+                message = client.recv(1024)
+                if not message:
+                    raise ConnectionError("Client disconnected")
+                session.touch()
+            command = command_name(message)
+            started = time.perf_counter()
+            trace = tracer.start(command, nickname)
+            profile = tracer.start_profile(command, nickname)
+            try:
+                if message.startswith(b"UPLOAD_FILE:"):
+                    parts = message.split(b":", 3)
+                    if len(parts) >= 4:
+                        filename = parts[1].decode("utf-8")
+                        file_size = int(parts[2])
+                        handle_file_upload(client, filename, file_size, nickname, parts[3], trace)
+                        continue
+                elif message.startswith(b"UPLOAD_HASH:"):
+                    file_info = accept_announced_upload(message, nickname)
+                    if file_info:
+                        finish_file_upload(client, file_info)
+                    else:
+                        client.send_command("UPLOAD_HASH_UNKNOWN".encode("utf-8"))
+                    continue
+                elif message == b"GET_FILE_LIST":
+                    send_file_list(client, trace)
+                    continue
+                elif client.framed and (message == b"HISTORY" or message.startswith(b"HISTORY:")):
+                    client.send_command(build_history_message(message))
+                    continue
+                elif message.startswith(b"DOWNLOAD_FILE:"):
+                    unique_filename = message.decode("utf-8").split(":", 1)[1]
+                    handle_file_download(client, unique_filename, trace=trace)
+                    continue
+                elif message.startswith(b"DOWNLOAD_RANGE:"):
+                    parts = message.decode("utf-8").split(":", 2)
+                    if len(parts) == 3:
+                        handle_file_download(client, parts[2], parts[1], trace)
+                    continue
+                elif client.framed and message.startswith(b"CODECS:"):
+                    client.send_command(negotiate_codecs(client, message).encode("utf-8"))
+                    continue
+                elif client.framed and message.startswith(b"UPLOAD_RESUME:"):
+                    reply = begin_chunked_upload(message, with_codec=client.codecs is not None)
+                    client.send_command(reply.encode("utf-8"))
+                    continue
+                elif client.framed and message.startswith(b"UPLOAD_CHUNK:"):
+                    with trace.span("recv"):
+                        data = client.recv_data(MAX_CHUNK_SIZE)
+                    reply = store_upload_chunk(message, data, nickname, trace=trace)
+                    with trace.span("reply"):
+                        reply_to_upload_chunk(client, *reply)
+                    continue
+                elif client.framed and message.startswith((b"PARALLEL_DOWNLOAD:", b"PARALLEL_UPLOAD:")):
+                    client.send_command(begin_parallel_transfer(client, nickname, message).encode("utf-8"))
+                    continue
+                elif client.framed and (message == b"STATS" or message.startswith(b"STATS:")):
+                    client.send_command(build_stats_message(message, client.sock.getpeername()[0]))
+                    continue
+                elif client.framed and (message == b"TRACE" or message.startswith(b"TRACE:")):
+                    client.send_command(build_trace_message(message, client.sock.getpeername()[0]))
+                    continue
+                elif client.framed and message.startswith((b"JOIN:", b"PART:", b"FOCUS:")):
+                    reply = handle_channel_command(session, message)
+                    if reply:
+                        client.send_command(reply)
+                    continue
+                elif client.framed and message.startswith(b"DM:"):
+                    client.send_command(handle_direct_message(session, message))
+                    continue
+                elif not client.framed:
+                    broadcast(message)
+            finally:
+                profile.stop()
+                trace.finish()
+                record_command(command, started)
+
+        except:
+            client.close()
+            if remove_session(client) is not None:
+                broadcast(f"User {nickname} has left the chat room!".encode("utf-8"))
+                leave_channels(session)
+                print(
+                    f"\033[93mUser {nickname} has left, current online users: {len(sessions)}\033[0m"
+                )
+                if client.outbound.dropped:
+                    print(f"   {client.outbound.dropped} queued chat messages were dropped for {nickname}")
+            break
+
+
+def recv_exactly(sock, count, deadline):
+    """Read count bytes before the time.monotonic() deadline; fewer if the peer closed"""
+    data = b""
+    while len(data) < count:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise socket.timeout("handshake stage deadline passed")
+        sock.settimeout(remaining)
+        chunk = sock.recv(count - len(data))
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+
+def receive_password(client, nickname):
+    """Read the length prefixed password within one HANDSHAKE_TIMEOUT; "" if it does not arrive"""
+    deadline = time.monotonic() + HANDSHAKE_TIMEOUT
+    try:
+        # 先接收4字节的长度信息
+        length_data = recv_exactly(client, 4, deadline)
+        if len(length_data) != 4:
+            print(f"\033[91mInvalid password length data from {nickname}\033[0m")
+            return ""
+        password_length = int(length_data.decode("utf-8"))
+        # 密码长度为0，表示空密码
+        return recv_exactly(client, password_length, deadline).decode("utf-8") if password_length > 0 else ""
+    except socket.timeout:
+        print(f"\033[93mPassword receive timeout for user {nickname}\033[0m")
+    except Exception as e:
+        print(f"\033[91mError receiving password from {nickname}: {e}\033[0m")
+    return ""
+
+
+def authenticate_client(client, address, accepted):
+    """Run the NICK/PASS handshake of an accepted socket on a handshake pool thread.
+
+    Each stage has HANDSHAKE_TIMEOUT to complete, so a stalled client holds
+    one pool thread for at most a few seconds and never the accept loop.
+    """
+    trace = tracer.start("handshake")
+    trace.add("queued", time.perf_counter() - accepted)
+    mark = time.perf_counter()
+    try:
+        # Request nickname
+        client.send("NICK".encode("utf-8"))
+        client.settimeout(HANDSHAKE_TIMEOUT)
+        raw_nickname = client.recv(1024).decode("utf-8")
+        client.settimeout(None)  # 恢复阻塞模式
+        trace.add("nick", time.perf_counter() - mark)
+        mark = time.perf_counter()
+        token = parse_transfer_token(raw_nickname)
+        if token is not None:
+            accept_data_connection(client, address, token)
+            trace.finish(outcome="data_connection")
+            return
+        nickname, protocol_version = parse_nickname(raw_nickname)
+
+        # Request password, sent with a length prefix
+        client.send("PASS".encode("utf-8"))
+        client_password = receive_password(client, nickname)
+        client.settimeout(None)
+        trace.add("password", time.perf_counter() - mark)
+        mark = time.perf_counter()
+
+        # 密码验证逻辑
+        if SERVER_PASSWORD and client_password != SERVER_PASSWORD:
+            client.send("AUTH_FAILED".encode("utf-8"))
+            metrics.inc("auth_failures_total")
+            print(
+                f"User {nickname} from {address} authentication failed - wrong password (received: '{client_password}')"
+            )
+            client.close()
+            trace.finish(nick=nickname, outcome="auth_failed")
+            return
+        if SERVER_PASSWORD:
+            print(f"User {nickname} from {address} authentication successful")
+        else:
+            print(f"User {nickname} from {address} authentication successful (no password required)")
+
+        # 验证成功
+        connection = ClientConnection(client, nickname, framed=protocol_version is not None)
+        send_auth_success(connection, protocol_version)
+        send_history_backlog(connection)
+        metrics.observe("handshake_seconds", time.perf_counter() - accepted)
+        trace.add("ack", time.perf_counter() - mark)
+        mark = time.perf_counter()
+        connection.session = add_session(connection, nickname)
+
+        print(
+            f"\033[95mUser {nickname} from {str(address)} has connected, current online users: {len(sessions)}\033[0m"
+        )
+        broadcast(f"{nickname} has joined the chat room!".encode("utf-8"))
+        thread = threading.Thread(target=handle, args=(connection,))
+        thread.start()
+        trace.add("join", time.perf_counter() - mark)
+        trace.finish(nick=nickname, outcome="ok")
+
+    except socket.timeout:
+        trace.finish(outcome="timeout")
+        metrics.inc("handshake_timeouts_total")
+        print(f"\033[93mHandshake timeout for connection from {address}\033[0m")
+        client.close()
+    except Exception as e:
+        trace.finish(outcome="error")
+        print(f"\033[91mError handling client connection from {address}: {e}\033[0m")
+        try:
+            client.close()
+        except:
+            pass
+    finally:
+        handshake_slots.release()
+
+
+# Handle new client connections
+def receive():
+    """Accept loop of the threaded engine; handshakes run on the handshake pool"""
+    pool = ThreadPoolExecutor(max_workers=HANDSHAKE_WORKERS, thread_name_prefix="handshake")
+    while True:
+        client, address = server.accept()
+        accepted = time.perf_counter()
+        metrics.inc("connections_total")
+        if not handshake_slots.acquire(blocking=False):
+            # Every pool thread is busy and the queue is full; shed the connection
+            metrics.inc("handshakes_rejected_total")
+            print(f"\033[93mToo many pending handshakes, dropping connection from {address}\033[0m")
+            client.close()
+            continue
+        pool.submit(authenticate_client, client, address, accepted)
+
+
+class AsyncClient:
+    """Asyncio counterpart of ClientConnection; a writer task drains the outbound queue"""
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.nickname = None
+        self.session = None  # Set once the connection joins the chat room
+        self.framed = False
+        self.codecs = None
+        self.frames = None
+        self.outbound = OutboundQueue()
+        self.outbound_ready = asyncio.Event()
+        self.outbound_progress = asyncio.Event()
+        self.writer_task = asyncio.ensure_future(self._write_loop())
+
+    def enable_framing(self):
+        self.framed = True
+        self.frames = FrameBuffer(BUFFER_SIZE)
+
+    def _enqueue(self, item, size, droppable):
+        if self.outbound.closed:
+            raise ConnectionError("Client connection closed")
+        if not self.outbound.put(item, size, droppable):
+            count_slow_consumer_disconnect(self.nickname, self.outbound)
+            self.shutdown()
+            return
+        self.outbound_ready.set()
+
+    async def _write_loop(self):
+        try:
+            while True:
+                while not self.outbound.items:
+                    if self.outbound.closed:
+                        return
+                    self.outbound_ready.clear()
+                    await self.outbound_ready.wait()
+                item = self.outbound.get()
+                if isinstance(item, FileTransfer):
+                    try:
+                        with item.trace.span("send"):
+                            await self._send_file(item)
+                    finally:
+                        item.trace.finish()
+                    sent = item.count
+                else:
+                    self.writer.write(item)
+                    sent = len(item)
+                    await self.writer.drain()
+                metrics.inc("bytes_sent_total", sent)
+                if self.session is not None:
+                    self.session.bytes_sent += sent
+                self.outbound_progress.set()
+        except (ConnectionError, OSError):
+            self.shutdown()
+
+    async def _send_file(self, transfer):
+        with transfer.file:
+            await run_blocking(transfer.file.seek, transfer.offset)
+            remaining = transfer.count
+            while remaining > 0:
+                chunk = await run_blocking(transfer.file.read, min(BUFFER_SIZE, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                if self.framed:
+                    chunk = encode_frame(FRAME_DATA, chunk)
+                self.writer.write(chunk)
+                await self.writer.drain()
+
+    async def drain(self):
+        """Wait until the outbound queue is back under its high-water mark"""
+        while self.outbound.queued_bytes > OUTBOUND_HIGH_WATER and not self.outbound.closed:
+            self.outbound_progress.clear()
+            await self.outbound_progress.wait()
+
+    async def flush(self):
+        """Wait until everything queued so far has been handed to the transport"""
+        while self.outbound.items and not self.outbound.closed:
+            self.outbound_progress.clear()
+            await self.outbound_progress.wait()
+
+    def shutdown(self):
+        """Drop the connection without waiting for queued data (slow consumers, write errors)"""
+        self.outbound.close()
+        self.outbound_ready.set()
+        self.outbound_progress.set()
+        self.writer.transport.abort()
+
+    def close(self):
+        self.outbound.close()
+        self.outbound_ready.set()
+        self.outbound_progress.set()
+        self.writer.close()
+
+    def send(self, data, droppable=False):
+        self._enqueue(data, len(data), droppable)
+
+    def send_frame(self, frame_type, payload, droppable=False):
+        if self.framed:
+            payload = encode_frame(frame_type, payload)
+        self.send(payload, droppable)
+
+    def send_message(self, message):
+        self.send_frame(FRAME_TEXT, message, droppable=True)
+
+    def send_command(self, command, droppable=False):
+        self.send_frame(FRAME_COMMAND, command, droppable)
+
+    def send_data(self, data):
+        self.send_frame(FRAME_DATA, data)
+
+    def send_file(self, file, count, offset=0, trace=NULL_TRACE):
+        """Queue a file for the writer task, which takes ownership of it (and finishes trace once sent)"""
+        trace.hold()
+        try:
+            self._enqueue(FileTransfer(file, count, offset, trace), 0, False)
+        except ConnectionError:
+            trace.finish(aborted=True)
+            raise
+
+    async def read_frame(self):
+        while True:
+            frame = self.frames.next_frame()
+            if frame is not None:
+                return frame
+            data = await self.read(BUFFER_SIZE)
+            if not data:
+                raise ConnectionError("Connection closed by peer")
+            self.frames.feed(data)
+
+    async def read(self, size):
+        data = await self.reader.read(size)
+        metrics.inc("bytes_received_total", len(data))
+        return data
+
+    async def read_data(self, max_size):
+        """Receive the next piece of an upload payload"""
+        if not self.framed:
+            return await self.read(max_size)
+        frame_type, payload = await self.read_frame()
+        if frame_type != FRAME_DATA:
+            raise ProtocolError(f"Expected file data, got frame type {frame_type}")
+        return payload
+
+
+async def run_blocking(func, *args):
+    """Run disk or compression work on the executor so the event loop keeps serving clients"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, func, *args)
+
+
+async def async_read_password(client):
+    length_data = await client.reader.readexactly(4)
+    password_length = int(length_data.decode("utf-8"))
+    if password_length > 0:
+        password_data = await client.reader.readexactly(password_length)
+        return password_data.decode("utf-8")
+    return ""
+
+
+async def async_receive_password(client, nickname):
+    """The length prefixed password if it arrives within one HANDSHAKE_TIMEOUT, "" otherwise"""
+    try:
+        return await asyncio.wait_for(async_read_password(client), HANDSHAKE_TIMEOUT)
+    except asyncio.TimeoutError:
+        print(f"\033[93mPassword receive timeout for user {nickname}\033[0m")
+    except asyncio.IncompleteReadError:
+        print(f"\033[91mInvalid password length data from {nickname}\033[0m")
+    except Exception as e:
+        print(f"\033[91mError receiving password from {nickname}: {e}\033[0m")
+    return ""
+
+
+async def async_authenticate(client, address, trace=NULL_TRACE):
+    """Run the NICK/PASS handshake, returning (nickname, protocol version).
+
+    Returns None if the client was rejected, or if it was a parallel
+    transfer data connection, which is served here until it closes.
+    """
+    client.send("NICK".encode("utf-8"))
+    try:
+        with trace.span("nick"):
+            nickname_data = await asyncio.wait_for(client.reader.read(1024), HANDSHAKE_TIMEOUT)
+    except asyncio.TimeoutError:
+        trace.finish(outcome="timeout")
+        metrics.inc("handshake_timeouts_total")
+        print(f"\033[93mHandshake timeout for connection from {address}\033[0m")
+        return None
+    if not nickname_data:
+        return None
+    token = parse_transfer_token(nickname_data.decode("utf-8"))
+    if token is not None:
+        trace.finish(outcome="data_connection")
+        await async_serve_data_connection(client, address, token)
+        return None
+    nickname, protocol_version = parse_nickname(nickname_data.decode("utf-8"))
+    trace.set(nick=nickname)
+
+    client.send("PASS".encode("utf-8"))
+    with trace.span("password"):
+        client_password = await async_receive_password(client, nickname)
+
+    if SERVER_PASSWORD and client_password != SERVER_PASSWORD:
+        trace.finish(outcome="auth_failed")
+        metrics.inc("auth_failures_total")
+        client.send("AUTH_FAILED".encode("utf-8"))
+        await client.flush()
+        print(
+            f"User {nickname} from {address} authentication failed - wrong password (received: '{client_password}')"
+        )
+        return None
+    if SERVER_PASSWORD:
+        print(f"User {nickname} from {address} authentication successful")
+    else:
+        print(f"User {nickname} from {address} authentication successful (no password required)")
+    return nickname, protocol_version
+
+
+async def async_serve_data_connection(client, address, token):
+    grant = redeem_parallel_transfer(token)
+    if grant is None:
+        metrics.inc("auth_failures_total")
+        client.send("AUTH_FAILED".encode("utf-8"))
+        await client.flush()
+        print(f"\033[93mRejected data connection from {address}: unknown or expired transfer token\033[0m")
+        return
+    client.nickname = grant.nickname
+    client.codecs = grant.codecs
+    client.enable_framing()
+    client.send(auth_success_ack(PROTOCOL_VERSION))
+    try:
+        while True:
+            frame_type, payload = await client.read_frame()
+            if frame_type != FRAME_COMMAND:
+                continue
+            message = bytes(payload)
+            command = command_name(message)
+            trace = tracer.start(command, grant.nickname, data_connection=True)
+            profile = tracer.start_profile(command, grant.nickname)
+            try:
+                if grant.kind == "download" and message.startswith(b"DOWNLOAD_RANGE:"):
+                    parts = message.decode("utf-8").split(":", 2)
+                    if len(parts) == 3 and parts[2] == grant.target:
+                        await async_handle_file_download(client, parts[2], parts[1], trace)
+                    else:
+                        client.send_command("FILE_NOT_FOUND".encode("utf-8"))
+                elif grant.kind == "upload" and message.startswith(b"UPLOAD_CHUNK:"):
+                    with trace.span("recv"):
+                        data = await client.read_data(MAX_CHUNK_SIZE)
+                    reply = await run_blocking(
+                        store_upload_chunk, message, data, grant.nickname, grant.target, trace
+                    )
+                    with trace.span("reply"):
+                        reply_to_upload_chunk(client, *reply, grant=grant)
+            finally:
+                profile.stop()
+                trace.finish()
+            await client.drain()
+    except (ConnectionError, ProtocolError):
+        pass
+
+
+async def async_handle_file_upload(client, filename, file_size, uploader, initial_data, trace=NULL_TRACE):
+    sink = None
+    try:
+        sink = await run_blocking(UploadSink, filename, uploader, None, DEFAULT_CODEC, trace)
+        # Part of the payload may have arrived in the same read as the UPLOAD_FILE header
+        initial_data = initial_data[:file_size]
+        await run_blocking(sink.write, initial_data)
+        bytes_received = len(initial_data)
+        while bytes_received < file_size:
+            with trace.span("recv"):
+                chunk = await client.read_data(min(BUFFER_SIZE, file_size - bytes_received))
+            if not chunk:
+                raise ConnectionError("connection closed during upload")
+            await run_blocking(sink.write, chunk)
+            bytes_received += len(chunk)
+        file_info = await run_blocking(sink.finish)
+        with trace.span("announce"):
+            finish_file_upload(client, file_info)
+
+    except Exception as e:
+        if sink:
+            await run_blocking(sink.abort)
+        client.send_command("UPLOAD_ERROR".encode("utf-8"))
+        print(f"\033[91mFile upload error: {e}\033[0m")
+
+
+async def async_handle_file_download(client, unique_filename, spec=None, trace=NULL_TRACE):
+    try:
+        prepared = await run_blocking(open_file_download, unique_filename, accepted_codecs(client), trace)
+        if prepared:
+            file_info, rendition = prepared
+            try:
+                info_json = json.dumps(file_info).encode("utf-8")
+                info_header = f"FILE_INFO:{len(info_json)}:".encode("utf-8")
+                if client.framed:
+                    client.send_command(info_header + info_json)
+                else:
+                    client.send(info_header)
+                    client.send(info_json)
+                    with trace.span("ready_wait"):
+                        await client.read(1024)
+                start_command, (offset, count) = download_data_start(file_info, spec)
+                trace.set(bytes=count)
+                client.send_command(start_command.encode("utf-8"))
+                client.send_file(rendition, count, offset, trace)
+            except Exception:
+                rendition.close()
+                raise
+
+            client.send_command("DOWNLOAD_COMPLETE".encode("utf-8"))
+        else:
+            client.send_command("FILE_NOT_FOUND".encode("utf-8"))
+    except Exception as e:
+        print(f"\033[91mError sending {unique_filename} to {client.nickname}: {e}\033[0m")
+        client.send_command("DOWNLOAD_ERROR".encode("utf-8"))
+
+
+async def async_handle(client, nickname):
+    session = client.session
+    while True:
+        if client.framed:
+            frame_type, payload = await client.read_frame()
+            session.touch()
+            if frame_type == FRAME_TEXT:
+                post_chat(session, bytes(payload))
+                continue
+            if frame_type != FRAME_COMMAND:
+                continue
+            message = bytes(payload)
+        else:
+            message = await client.read(1024)
+            if not message:
+                break
+            session.touch()
+        command = command_name(message)
+        started = time.perf_counter()
+        trace = tracer.start(command, nickname)
+        profile = tracer.start_profile(command, nickname)
+        try:
+            if message.startswith(b"UPLOAD_FILE:"):
+                parts = message.split(b":", 3)
+                if len(parts) >= 4:
+                    filename = parts[1].decode("utf-8")
+                    file_size = int(parts[2])
+                    await async_handle_file_upload(client, filename, file_size, nickname, parts[3], trace)
+            elif message.startswith(b"UPLOAD_HASH:"):
+                file_info = await run_blocking(accept_announced_upload, message, nickname)
+                if file_info:
+                    finish_file_upload(client, file_info)
+                else:
+                    client.send_command("UPLOAD_HASH_UNKNOWN".encode("utf-8"))
+            elif message == b"GET_FILE_LIST":
+                send_file_list(client, trace)
+            elif client.framed and (message == b"HISTORY" or message.startswith(b"HISTORY:")):
+                client.send_command(await run_blocking(build_history_message, message))
+            elif message.startswith(b"DOWNLOAD_FILE:"):
+                unique_filename = message.decode("utf-8").split(":", 1)[1]
+                await async_handle_file_download(client, unique_filename, trace=trace)
+            elif message.startswith(b"DOWNLOAD_RANGE:"):
+                parts = message.decode("utf-8").split(":", 2)
+                if len(parts) == 3:
+                    await async_handle_file_download(client, parts[2], parts[1], trace)
+            elif client.framed and message.startswith(b"CODECS:"):
+                client.send_command(negotiate_codecs(client, message).encode("utf-8"))
+            elif client.framed and message.startswith(b"UPLOAD_RESUME:"):
+                reply = await run_blocking(begin_chunked_upload, message, client.codecs is not None)
+                client.send_command(reply.encode("utf-8"))
+            elif client.framed and message.startswith(b"UPLOAD_CHUNK:"):
+                with trace.span("recv"):
+                    data = await client.read_data(MAX_CHUNK_SIZE)
+                reply = await run_blocking(store_upload_chunk, message, data, nickname, None, trace)
+                with trace.span("reply"):
+                    reply_to_upload_chunk(client, *reply)
+            elif client.framed and message.startswith((b"PARALLEL_DOWNLOAD:", b"PARALLEL_UPLOAD:")):
+                reply = await run_blocking(begin_parallel_transfer, client, nickname, message)
+                client.send_command(reply.encode("utf-8"))
+            elif client.framed and (message == b"STATS" or message.startswith(b"STATS:")):
+                peer = client.writer.get_extra_info("peername")
+                client.send_command(await run_blocking(build_stats_message, message, peer[0] if peer else ""))
+            elif client.framed and (message == b"TRACE" or message.startswith(b"TRACE:")):
+                peer = client.writer.get_extra_info("peername")
+                client.send_command(build_trace_message(message, peer[0] if peer else ""))
+            elif client.framed and message.startswith((b"JOIN:", b"PART:", b"FOCUS:")):
+                reply = handle_channel_command(session, message)
+                if reply:
+                    client.send_command(reply)
+            elif client.framed and message.startswith(b"DM:"):
+                client.send_command(handle_direct_message(session, message))
+            elif not client.framed:
+                broadcast(message)
+        finally:
+            profile.stop()
+            trace.finish()
+            record_command(command, started)
+        await client.drain()
+
+
+# Handle one client connection on the event loop
+async def async_client_connected(reader, writer):
+    address = writer.get_extra_info("peername")
+    accepted = time.perf_counter()
+    metrics.inc("connections_total")
+    client = AsyncClient(reader, writer)
+    trace = tracer.start("handshake")
+    try:
+        authenticated = await async_authenticate(client, address, trace)
+        if authenticated is None:
+            trace.finish(outcome="closed")
+            return
+        nickname, protocol_version = authenticated
+        client.nickname = nickname
+        with trace.span("ack"):
+            if protocol_version is not None:
+                client.enable_framing()
+            send_auth_success(client, protocol_version)
+            if client.framed and HISTORY_BACKLOG > 0:
+                client.send_command(await run_blocking(build_history_message))
+        metrics.observe("handshake_seconds", time.perf_counter() - accepted)
+        client.session = add_session(client, nickname)
+        print(
+            f"\033[95mUser {nickname} from {str(address)} has connected, current online users: {len(sessions)}\033[0m"
+        )
+        with trace.span("join"):
+            await client.flush()
+            broadcast(f"{nickname} has joined the chat room!".encode("utf-8"))
+        trace.finish(outcome="ok")
+        await async_handle(client, nickname)
+    except Exception as e:
+        if client not in sessions:
+            trace.finish(outcome="error")
+            print(f"\033[91mError handling client connection from {address}: {e}\033[0m")
+    finally:
+        session = remove_session(client)
+        if session is not None:
+            nickname = session.nickname
+            broadcast(f"User {nickname} has left the chat room!".encode("utf-8"))
+            leave_channels(session)
+            print(
+                f"\033[93mUser {nickname} has left, current online users: {len(sessions)}\033[0m"
+            )
+            if client.outbound.dropped:
+                print(f"   {client.outbound.dropped} queued chat messages were dropped for {nickname}")
+        client.close()
+
+
+async def run_async_server():
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=EXECUTOR_WORKERS))
+    if bus:
+        loop.add_reader(bus.fileno(), drain_bus_events)
+    async_server = await asyncio.start_server(async_client_connected, sock=server)
+    async with async_server:
+        await async_server.serve_forever()
+
+
+# 启动服务器
+if __name__ == "__main__":
+    initialize_server()
+    if SERVER_WORKERS > 1:
+        run_worker_processes()
+    else:
+        serve()
@@ -0,0 +1,248 @@
+"""Counters and histograms cheap enough to leave on in production.
+
+Every thread records into its own shard, a plain dict that only that
+thread writes, so recording takes no lock: a counter increment is one
+dict update, a histogram observation a bisect and two list updates.
+Readers copy each shard (a single C-level copy, atomic under the GIL) and
+add them up, so a snapshot may miss an update in flight but never sees a
+torn one. Shards of finished threads are folded into one retired shard so
+one thread per connection does not grow the list forever.
+
+Snapshots are served as JSON by the STATS command and in the Prometheus
+text format by an optional HTTP endpoint (MetricsHTTPServer).
+"""
+import bisect
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+RATIO_BUCKETS = (0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0, 1.1)
+RETIRE_EVERY = 256  # New shards between sweeps for shards of finished threads
+
+
+class Timer:
+    """with metrics.timer(name, **labels): observes the block's wall time"""
+
+    __slots__ = ("metrics", "name", "labels", "started")
+
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.observe(self.name, time.perf_counter() - self.started, **self.labels)
+
+
+class Metrics:
+    def __init__(self, prefix="chat", enabled=True):
+        self.prefix = prefix
+        self.enabled = enabled  # When off, inc() and observe() return at once
+        self.started = time.time()
+        self.definitions = {}  # name -> (kind, help, buckets)
+        self.gauges = {}  # name -> (help, function returning the current value)
+        self.local = threading.local()
+        self.shards = []  # (thread, shard) of every thread that recorded something
+        self.retired = {}
+        self.lock = threading.Lock()  # Only taken to add, retire or read shards
+        self.new_shards = 0
+
+    def counter(self, name, help):
+        self.definitions[name] = ("counter", help, None)
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS):
+        self.definitions[name] = ("histogram", help, tuple(buckets))
+
+    def gauge(self, name, help, function):
+        """A value computed when read, such as the number of connected clients"""
+        self.gauges[name] = (help, function)
+
+    def reset(self):
+        """Start from zero, e.g. in a forked worker that inherited its parent's shards"""
+        with self.lock:
+            self.local = threading.local()
+            self.shards = []
+            self.retired = {}
+            self.new_shards = 0
+            self.started = time.time()
+
+    def _shard(self):
+        try:
+            return self.local.shard
+        except AttributeError:
+            shard = self.local.shard = {}
+            with self.lock:
+                self.shards.append((threading.current_thread(), shard))
+                self.new_shards += 1
+                if self.new_shards >= RETIRE_EVERY:
+                    self._retire_finished()
+            return shard
+
+    def _retire_finished(self):
+        """Fold the shards of finished threads into the retired shard; caller holds lock"""
+        self.new_shards = 0
+        alive = []
+        for thread, shard in self.shards:
+            if thread.is_alive():
+                alive.append((thread, shard))
+            else:
+                _merge(self.retired, shard)
+        self.shards = alive
+
+    def inc(self, name, amount=1, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items()))) if labels else (name, ())
+        shard = self._shard()
+        shard[key] = shard.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items()))) if labels else (name, ())
+        shard = self._shard()
+        counts = shard.get(key)
+        if counts is None:
+            buckets = self.definitions[name][2]
+            # One count per bucket, one for +Inf, then the sum of the observed values
+            counts = shard[key] = [0] * (len(buckets) + 2)
+        counts[bisect.bisect_left(self.definitions[name][2], value)] += 1
+        counts[-1] += value
+
+    def timer(self, name, **labels):
+        return Timer(self, name, labels)
+
+    def snapshot(self):
+        """{(name, labels): total} over every thread; histograms as [bucket counts..., +Inf, sum]"""
+        with self.lock:
+            self._retire_finished()
+            totals = {}
+            _merge(totals, self.retired)
+            for _, shard in self.shards:
+                _merge(totals, shard.copy())
+        return totals
+
+    def gauge_values(self):
+        values = {}
+        for name, (_, function) in self.gauges.items():
+            try:
+                values[name] = function()
+            except Exception:
+                values[name] = None
+        return values
+
+    def as_dict(self):
+        """A summary for STATS: counters, gauges and histogram count/sum/mean/p50/p99 (bucket bounds)"""
+        result = {"uptime": time.time() - self.started, "counters": {}, "gauges": self.gauge_values(), "histograms": {}}
+        for (name, labels), value in sorted(self.snapshot().items()):
+            kind, _, buckets = self.definitions.get(name, ("counter", "", None))
+            label = name + ("{" + ",".join(f"{key}={label_value}" for key, label_value in labels) + "}" if labels else "")
+            if kind == "counter":
+                result["counters"][label] = value
+                continue
+            count = sum(value[:-1])
+            result["histograms"][label] = {
+                "count": count,
+                "sum": value[-1],
+                "mean": value[-1] / count if count else None,
+                "p50": _quantile(buckets, value, 0.5),
+                "p99": _quantile(buckets, value, 0.99),
+            }
+        return result
+
+    def prometheus_text(self):
+        """Every metric in the Prometheus text exposition format"""
+        lines = []
+        by_name = {}
+        for (name, labels), value in self.snapshot().items():
+            by_name.setdefault(name, []).append((labels, value))
+        for name, (kind, help, buckets) in sorted(self.definitions.items()):
+            full_name = f"{self.prefix}_{name}"
+            lines.append(f"# HELP {full_name} {help}")
+            lines.append(f"# TYPE {full_name} {kind}")
+            for labels, value in sorted(by_name.get(name, ())):
+                if kind == "counter":
+                    lines.append(f"{full_name}{_labels(labels)} {value}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(buckets + ("+Inf",), value[:-1]):
+                    cumulative += count
+                    lines.append(f"{full_name}_bucket{_labels(labels + (('le', bound),))} {cumulative}")
+                lines.append(f"{full_name}_sum{_labels(labels)} {value[-1]}")
+                lines.append(f"{full_name}_count{_labels(labels)} {cumulative}")
+        for name, value in sorted(self.gauge_values().items()):
+            if value is None:
+                continue
+            full_name = f"{self.prefix}_{name}"
+            lines.append(f"# HELP {full_name} {self.gauges[name][0]}")
+            lines.append(f"# TYPE {full_name} gauge")
+            lines.append(f"{full_name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def _merge(totals, shard):
+    for key, value in shard.items():
+        if isinstance(value, list):
+            existing = totals.get(key)
+            if existing is None:
+                totals[key] = list(value)
+            else:
+                for i, count in enumerate(value):
+                    existing[i] += count
+        else:
+            totals[key] = totals.get(key, 0) + value
+
+
+def _quantile(buckets, counts, q):
+    """Upper bound of the bucket holding the q quantile; None past the last bound"""
+    total = sum(counts[:-1])
+    if not total:
+        return None
+    rank = q * total
+    seen = 0
+    for bound, count in zip(buckets, counts):
+        seen += count
+        if seen >= rank:
+            return bound
+    return None
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    escaped = (
+        f'{key}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+        for key, value in labels
+    )
+    return "{" + ",".join(escaped) + "}"
+
+
+class MetricsHTTPServer(ThreadingHTTPServer):
+    """GET /metrics answers with metrics.prometheus_text(); run serve_forever() on a thread"""
+
+    daemon_threads = True
+
+    def __init__(self, address, metrics):
+        self.metrics = metrics
+        super().__init__(address, MetricsRequestHandler)
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?", 1)[0] not in ("/metrics", "/"):
+            self.send_error(404)
+            return
+        body = self.server.metrics.prometheus_text().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # Scrapes every few seconds would drown the server's own output
@@ -0,0 +1,358 @@
+"""Sampled per-operation traces and on-demand cProfile runs for the server.
+
+A trace times the stages of one operation (an upload chunk, a download,
+a file list, a login handshake) and is written as one JSON line:
+
+    {"ts": 1700000000.123, "op": "UPLOAD_CHUNK", "ms": 12.345, "nick": "alice",
+     "worker": 0, "stages": {"recv": [1.2, 3], "chunk_write": [0.5, 1]}}
+
+where every stage holds [milliseconds, times entered]. Operations that are
+not sampled get NULL_TRACE, whose methods do nothing, so tracing costs one
+random() call per operation while it is off. Trace files rotate at a size
+limit; `python server_tracing.py <files>` summarizes them per operation
+and stage.
+
+A profile request runs cProfile around the next matching commands, by
+command name and/or nickname, and dumps each run as a .prof file next to
+the trace file (read it with `python -m pstats`).
+"""
+import cProfile
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+
+
+class Trace:
+    __slots__ = ("tracer", "op", "attrs", "started", "wall", "stages", "holds", "done", "lock")
+
+    def __init__(self, tracer, op, attrs):
+        self.tracer = tracer
+        self.op = op
+        self.attrs = attrs
+        self.started = time.perf_counter()
+        self.wall = time.time()
+        self.stages = {}  # stage -> [seconds, count]
+        self.holds = 0
+        self.done = False
+        self.lock = threading.Lock()
+
+    def add(self, stage, seconds):
+        entry = self.stages.get(stage)
+        if entry is None:
+            self.stages[stage] = [seconds, 1]
+        else:
+            entry[0] += seconds
+            entry[1] += 1
+
+    def span(self, stage):
+        return Span(self, stage)
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def hold(self):
+        """Keep the trace open past the next finish(), for work handed to another thread"""
+        with self.lock:
+            self.holds += 1
+
+    def finish(self, **attrs):
+        """Write the trace, unless hold() asked for one more finish() first; later calls do nothing"""
+        with self.lock:
+            if self.done:
+                return
+            self.attrs.update(attrs)
+            if self.holds:
+                self.holds -= 1
+                return
+            self.done = True
+        self.tracer.write(self)
+
+
+class Span:
+    __slots__ = ("trace", "stage", "started")
+
+    def __init__(self, trace, stage):
+        self.trace = trace
+        self.stage = stage
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.trace.add(self.stage, time.perf_counter() - self.started)
+
+
+class NullTrace:
+    """Stand-in for an operation that is not sampled"""
+
+    __slots__ = ()
+
+    def add(self, stage, seconds):
+        pass
+
+    def span(self, stage):
+        return NULL_SPAN
+
+    def set(self, **attrs):
+        pass
+
+    def hold(self):
+        pass
+
+    def finish(self, **attrs):
+        pass
+
+
+class NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+NULL_TRACE = NullTrace()
+NULL_SPAN = NullSpan()
+
+
+class Profile:
+    """One cProfile run, dumped to the profile directory when stopped"""
+
+    def __init__(self, tracer, command, nickname):
+        self.tracer = tracer
+        self.command = command
+        self.nickname = nickname
+        self.profiler = cProfile.Profile()
+        self.profiler.enable()
+
+    def stop(self):
+        self.profiler.disable()
+        try:
+            self.tracer.dump_profile(self)
+        finally:
+            self.tracer.profile_lock.release()
+
+
+class NullProfile:
+    __slots__ = ()
+
+    def stop(self):
+        pass
+
+
+NULL_PROFILE = NullProfile()
+
+
+class RotatingFile:
+    """Append-only text file renamed to <path>.1 .. <path>.<backups> when full"""
+
+    def __init__(self, path, max_bytes, backups):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.file = None
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def write(self, line):
+        with self.lock:
+            if self.file is None:
+                directory = os.path.dirname(self.path)
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+                self.file = open(self.path, "a", encoding="utf-8")
+                self.size = self.file.tell()
+            self.file.write(line)
+            self.file.flush()
+            self.size += len(line)
+            if self.max_bytes and self.size >= self.max_bytes:
+                self._rotate()
+
+    def _rotate(self):
+        self.file.close()
+        self.file = None
+        if self.backups <= 0:
+            os.remove(self.path)
+            return
+        for index in range(self.backups - 1, 0, -1):
+            older = f"{self.path}.{index}"
+            if os.path.exists(older):
+                os.replace(older, f"{self.path}.{index + 1}")
+        os.replace(self.path, f"{self.path}.1")
+
+
+class Tracer:
+    def __init__(self, path, max_bytes=10485760, backups=5, sample_rate=0.0, worker=None):
+        self.output = RotatingFile(path, max_bytes, backups)
+        self.profile_dir = os.path.dirname(path) or "."
+        self.worker = worker
+        self.sample_rate = sample_rate
+        self.users = set()  # Nicknames whose every operation is traced
+        self.profile_requests = []  # [command or None, nickname or None, runs left]
+        self.profile_lock = threading.Lock()  # One cProfile run at a time
+        self.profiles_written = 0
+        self.errors = 0
+
+    def start(self, op, nickname=None, **attrs):
+        """A Trace for op if it is sampled, NULL_TRACE otherwise"""
+        if op is None:
+            return NULL_TRACE
+        if not (self.users and nickname in self.users) and (
+            not self.sample_rate or random.random() >= self.sample_rate
+        ):
+            return NULL_TRACE
+        if nickname is not None:
+            attrs["nick"] = nickname
+        return Trace(self, op, attrs)
+
+    def write(self, trace):
+        record = {"ts": round(trace.wall, 3), "op": trace.op, "ms": round((time.perf_counter() - trace.started) * 1000, 3)}
+        if self.worker is not None:
+            record["worker"] = self.worker
+        record.update(trace.attrs)
+        record["stages"] = {stage: [round(seconds * 1000, 3), count] for stage, (seconds, count) in trace.stages.items()}
+        try:
+            self.output.write(json.dumps(record, separators=(",", ":")) + "\n")
+        except (OSError, TypeError, ValueError):
+            self.errors += 1
+
+    def start_profile(self, command, nickname=None):
+        """Profile this command if a request matches it, returning something with stop()"""
+        if not self.profile_requests or command is None:
+            return NULL_PROFILE
+        if not self.profile_lock.acquire(blocking=False):
+            return NULL_PROFILE  # Another command is being profiled
+        for request in list(self.profile_requests):
+            wanted_command, wanted_nickname, _ = request
+            if wanted_command not in (None, command) or wanted_nickname not in (None, nickname):
+                continue
+            request[2] -= 1
+            if request[2] <= 0:
+                try:
+                    self.profile_requests.remove(request)
+                except ValueError:
+                    pass
+            try:
+                return Profile(self, command, nickname)
+            except ValueError:
+                break  # Python 3.12+ allows one profiler per process, e.g. a debugger's
+        self.profile_lock.release()
+        return NULL_PROFILE
+
+    def dump_profile(self, profile):
+        name = "-".join(
+            re.sub(r"[^\w.-]", "_", part)
+            for part in (profile.command, profile.nickname or "", time.strftime("%Y%m%d_%H%M%S"), str(os.getpid()))
+        )
+        self.profiles_written += 1
+        path = os.path.join(self.profile_dir, f"profile-{name}-{self.profiles_written}.prof")
+        try:
+            os.makedirs(self.profile_dir, exist_ok=True)
+            profile.profiler.dump_stats(path)
+        except OSError:
+            self.errors += 1
+
+    def configure(self, settings):
+        """Apply rate=<0..1>, user=<nickname>, profile=<COMMAND|*>, profile_user=<nickname>, count=<n>.
+
+        settings is a dict of those keys as strings; an empty user= stops
+        tracing every operation of particular users. Raises ValueError.
+        """
+        if "rate" in settings:
+            rate = float(settings["rate"])
+            if not 0.0 <= rate <= 1.0:
+                raise ValueError("rate must be between 0 and 1")
+            self.sample_rate = rate
+        if "user" in settings:
+            if settings["user"]:
+                self.users = self.users | {settings["user"]}
+            else:
+                self.users = set()
+        if "profile" in settings or "profile_user" in settings:
+            command = settings.get("profile") or "*"
+            count = int(settings.get("count", 1))
+            if count < 0:
+                raise ValueError("count must not be negative")
+            if count == 0:
+                self.profile_requests = []
+            else:
+                self.profile_requests.append(
+                    [None if command == "*" else command, settings.get("profile_user") or None, count]
+                )
+
+    def state(self):
+        return {
+            "file": self.output.path,
+            "rate": self.sample_rate,
+            "users": sorted(self.users),
+            "profiles_pending": [
+                {"command": command or "*", "user": nickname, "count": count}
+                for command, nickname, count in self.profile_requests
+            ],
+            "profiles_written": self.profiles_written,
+            "errors": self.errors,
+        }
+
+
+def parse_settings(text):
+    """key=value,key=value into a dict"""
+    settings = {}
+    for item in filter(None, text.split(",")):
+        key, separator, value = item.partition("=")
+        if not separator:
+            raise ValueError(f"expected key=value, got {item!r}")
+        settings[key.strip()] = value.strip()
+    return settings
+
+
+def summarize(paths):
+    """Per operation: count and p50/p99 total ms; per stage: mean ms and share of the total"""
+    operations = {}
+    for path in paths:
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                entry = operations.setdefault(record["op"], {"totals": [], "stages": {}})
+                entry["totals"].append(record["ms"])
+                for stage, (ms, _) in record.get("stages", {}).items():
+                    entry["stages"][stage] = entry["stages"].get(stage, 0.0) + ms
+    summary = {}
+    for op, entry in operations.items():
+        totals = sorted(entry["totals"])
+        total_ms = sum(totals)
+        summary[op] = {
+            "count": len(totals),
+            "p50_ms": totals[len(totals) // 2],
+            "p99_ms": totals[min(len(totals) - 1, int(len(totals) * 0.99))],
+            "stages": {
+                stage: {"mean_ms": ms / len(totals), "share": ms / total_ms if total_ms else None}
+                for stage, ms in sorted(entry["stages"].items(), key=lambda item: -item[1])
+            },
+        }
+    return summary
+
+
+def main(argv):
+    if not argv:
+        print("usage: python server_tracing.py <trace file>...")
+        return 2
+    for op, entry in sorted(summarize(argv).items()):
+        print(f"{op}: {entry['count']} traced, p50 {entry['p50_ms']:.2f}ms p99 {entry['p99_ms']:.2f}ms")
+        for stage, numbers in entry["stages"].items():
+            share = f"{numbers['share'] * 100:.0f}%" if numbers["share"] is not None else "n/a"
+            print(f"    {stage:<16} {numbers['mean_ms']:9.3f}ms  {share}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,173 @@
+"""Connected chat users, indexed by connection, session id, nickname and channel."""
+import itertools
+import threading
+import time
+
+
+class Session:
+    """One logged-in user on one connection and what it has done so far"""
+
+    __slots__ = ("id", "connection", "nickname", "joined", "last_active", "bytes_sent", "channels", "channel")
+
+    def __init__(self, session_id, connection, nickname):
+        self.id = session_id
+        self.connection = connection
+        self.nickname = nickname
+        self.joined = time.time()
+        self.last_active = self.joined
+        self.bytes_sent = 0  # Updated by the connection's writer only
+        self.channels = frozenset()  # Replaced, never modified, so other threads can test membership
+        self.channel = None  # Channel the user's uploads are announced in, None for the default
+
+    def touch(self):
+        self.last_active = time.time()
+
+    def describe(self, now=None):
+        now = now or time.time()
+        return {
+            "id": self.id,
+            "nick": self.nickname,
+            "joined": self.joined,
+            "idle": now - self.last_active,
+            "bytes_sent": self.bytes_sent,
+            "channels": sorted(self.channels),
+        }
+
+
+class SessionRegistry:
+    """Sessions with O(1) join, leave and lookup.
+
+    Broadcasts iterate connections() or members(channel), tuples rebuilt
+    at most once per change and then shared, so they take no lock and
+    never see a list being modified by a join or leave on another thread.
+    A channel exists while it has members.
+    """
+
+    def __init__(self):
+        self.sessions = {}  # session id -> Session
+        self.by_connection = {}  # connection -> Session
+        self.by_nickname = {}  # nickname -> {session id: Session}, in join order
+        self.channels = {}  # channel -> {connection: Session}
+        self.lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._connections = ()
+        self._stale = False
+        self._members = {}  # channel -> tuple of connections, dropped when the channel changes
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def __contains__(self, connection):
+        return connection in self.by_connection
+
+    def add(self, connection, nickname, channel=None):
+        """Register a logged-in connection, in channel if given, returning its new Session"""
+        with self.lock:
+            session = Session(next(self._ids), connection, nickname)
+            self.sessions[session.id] = session
+            self.by_connection[connection] = session
+            self.by_nickname.setdefault(nickname, {})[session.id] = session
+            self._stale = True
+            if channel is not None:
+                self._join(session, channel)
+            return session
+
+    def remove(self, connection):
+        """Unregister a connection, returning its Session or None if it was not registered"""
+        with self.lock:
+            session = self.by_connection.pop(connection, None)
+            if session is None:
+                return None
+            del self.sessions[session.id]
+            same_name = self.by_nickname.get(session.nickname)
+            if same_name is not None:
+                same_name.pop(session.id, None)
+                if not same_name:
+                    del self.by_nickname[session.nickname]
+            for channel in session.channels:
+                self._leave(session, channel)
+            self._stale = True
+            return session
+
+    def _join(self, session, channel):
+        """Caller holds lock"""
+        self.channels.setdefault(channel, {})[session.connection] = session
+        self._members.pop(channel, None)
+        session.channels = session.channels | {channel}
+
+    def _leave(self, session, channel):
+        """Caller holds lock; leaves session.channels alone"""
+        subscribers = self.channels.get(channel)
+        if subscribers is not None:
+            subscribers.pop(session.connection, None)
+            if not subscribers:
+                del self.channels[channel]
+        self._members.pop(channel, None)
+
+    def join(self, connection, channel):
+        """Subscribe a registered connection to channel; False if it was not registered or already there"""
+        with self.lock:
+            session = self.by_connection.get(connection)
+            if session is None or channel in session.channels:
+                return False
+            self._join(session, channel)
+            return True
+
+    def part(self, connection, channel):
+        """Unsubscribe a connection from channel; False if it was not there"""
+        with self.lock:
+            session = self.by_connection.get(connection)
+            if session is None or channel not in session.channels:
+                return False
+            self._leave(session, channel)
+            session.channels = session.channels - {channel}
+            if session.channel == channel:
+                session.channel = None
+            return True
+
+    def get(self, connection):
+        return self.by_connection.get(connection)
+
+    def get_by_id(self, session_id):
+        return self.sessions.get(session_id)
+
+    def find(self, nickname):
+        """Sessions logged in under nickname, oldest first"""
+        with self.lock:
+            same_name = self.by_nickname.get(nickname)
+            return tuple(same_name.values()) if same_name else ()
+
+    def nickname_counts(self):
+        """{nickname: sessions logged in under it}"""
+        with self.lock:
+            return {nickname: len(same_name) for nickname, same_name in self.by_nickname.items()}
+
+    def connections(self):
+        """Every registered connection, as a snapshot that later changes leave alone"""
+        if self._stale:
+            with self.lock:
+                if self._stale:
+                    self._connections = tuple(self.by_connection)
+                    self._stale = False
+        return self._connections
+
+    def members(self, channel):
+        """Connections subscribed to channel, as a snapshot that later changes leave alone"""
+        members = self._members.get(channel)
+        if members is None:
+            with self.lock:
+                subscribers = self.channels.get(channel)
+                if not subscribers:
+                    return ()
+                members = self._members[channel] = tuple(subscribers)
+        return members
+
+    def channel_sizes(self):
+        with self.lock:
+            return {channel: len(subscribers) for channel, subscribers in self.channels.items()}
+
+    def describe(self):
+        now = time.time()
+        with self.lock:
+            sessions = list(self.sessions.values())
+        return [session.describe(now) for session in sessions]
@@ -0,0 +1,45 @@
+import unittest
+
+from direct_messages import Mailboxes
+
+
+class MailboxesTest(unittest.TestCase):
+    def test_take_returns_oldest_first_and_empties(self):
+        mailboxes = Mailboxes(size=5)
+        for index in range(3):
+            self.assertTrue(mailboxes.put("bob", index))
+        self.assertEqual(len(mailboxes), 3)
+        self.assertEqual(mailboxes.take("bob"), [0, 1, 2])
+        self.assertEqual(mailboxes.take("bob"), [])
+        self.assertEqual(len(mailboxes), 0)
+
+    def test_full_mailbox_drops_oldest(self):
+        mailboxes = Mailboxes(size=2)
+        self.assertTrue(mailboxes.put("bob", "a"))
+        self.assertTrue(mailboxes.put("bob", "b"))
+        self.assertFalse(mailboxes.put("bob", "c"))
+        self.assertEqual(mailboxes.dropped, 1)
+        self.assertEqual(len(mailboxes), 2)
+        self.assertEqual(mailboxes.take("bob"), ["b", "c"])
+
+    def test_least_recently_written_mailbox_is_evicted(self):
+        mailboxes = Mailboxes(size=5, max_users=2)
+        mailboxes.put("alice", 1)
+        mailboxes.put("bob", 2)
+        mailboxes.put("alice", 3)  # bob is now the least recently written
+        mailboxes.put("carol", 4)
+        self.assertEqual(sorted(mailboxes.nicknames()), ["alice", "carol"])
+        self.assertEqual(mailboxes.take("bob"), [])
+        self.assertEqual(mailboxes.dropped, 1)
+        self.assertEqual(len(mailboxes), 3)
+
+    def test_mailboxes_are_per_nickname(self):
+        mailboxes = Mailboxes()
+        mailboxes.put("alice", "for alice")
+        mailboxes.put("bob", "for bob")
+        self.assertEqual(mailboxes.take("alice"), ["for alice"])
+        self.assertEqual(mailboxes.nicknames(), ["bob"])
+
+
+if __name__ == "__main__":
+    unittest.main()
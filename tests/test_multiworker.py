@@ -0,0 +1,93 @@
+"""Logins, channels and direct messages against server.py with several asyncio workers"""
+import asyncio
+import sys
+import time
+import unittest
+
+from bench.local_server import LocalServer
+from chat_client import AsyncChatClient
+
+USERS = 64
+LOGIN_BUDGET = 5.0  # Seconds for every user to log in and join a channel
+
+
+@unittest.skipUnless(sys.platform.startswith("linux"), "server.workers needs os.fork and SO_REUSEPORT")
+class MultiWorkerTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = LocalServer("asyncio", 3, extra_config={"direct_messages": {"presence_sync_interval": 1}}).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+
+    def connect(self, nickname, **callbacks):
+        return AsyncChatClient("127.0.0.1", self.server.port, nickname, **callbacks)
+
+    def test_concurrent_logins_and_joins(self):
+        async def run():
+            clients = [self.connect(f"login{index}") for index in range(USERS)]
+            started = time.monotonic()
+            await asyncio.gather(*(client.connect() for client in clients))
+            await asyncio.gather(*(client.join(f"room{index % 4}") for index, client in enumerate(clients)))
+            elapsed = time.monotonic() - started
+            workers = {(await client.stats())["worker"] for client in clients}
+            await asyncio.gather(*(client.close() for client in clients))
+            return elapsed, workers
+
+        elapsed, workers = asyncio.run(run())
+        self.assertLess(elapsed, LOGIN_BUDGET)
+        self.assertGreater(len(workers), 1)  # Otherwise nothing crossed the bus
+
+    def test_direct_messages_cross_workers(self):
+        async def run():
+            received = {}
+            clients = []
+            for index in range(6):
+                nickname = f"dm{index}"
+                received[nickname] = []
+                clients.append(self.connect(nickname, on_direct_message=received[nickname].append))
+            await asyncio.gather(*(client.connect() for client in clients))
+            await asyncio.sleep(0.3)  # Presence events reach the other workers
+            results = [
+                await sender.send_direct_message(recipient.nickname, f"from {sender.nickname}")
+                for sender in clients
+                for recipient in clients
+                if sender is not recipient
+            ]
+            await asyncio.sleep(0.5)
+            await asyncio.gather(*(client.close() for client in clients))
+            return results, received
+
+        results, received = asyncio.run(run())
+        self.assertTrue(all(results))
+        for nickname, messages in received.items():
+            self.assertEqual(len(messages), 5, nickname)
+            self.assertTrue(all(message["to"] == nickname for message in messages))
+
+    def test_offline_messages_wait_for_login(self):
+        async def run():
+            sender = self.connect("mail_sender")
+            await sender.connect()
+            queued = [await sender.send_direct_message("mail_reader", f"note {index}") for index in range(3)]
+            received = []
+            first = self.connect("mail_reader", on_direct_message=received.append)
+            await first.connect()
+            await asyncio.sleep(0.5)
+            second_received = []
+            second = self.connect("mail_reader", on_direct_message=second_received.append)
+            await second.connect()
+            await asyncio.sleep(0.5)
+            for client in (sender, first, second):
+                await client.close()
+            return queued, received, second_received
+
+        queued, received, second_received = asyncio.run(run())
+        self.assertEqual(queued, [False, False, False])
+        self.assertEqual([message["text"] for message in received], ["note 0", "note 1", "note 2"])
+        self.assertTrue(all(message["offline"] for message in received))
+        self.assertEqual(second_received, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,109 @@
+import unittest
+
+from protocol import (
+    DEFAULT_CHANNEL,
+    FRAME_COMMAND,
+    FRAME_DATA,
+    FRAME_TEXT,
+    HEADER,
+    MAX_FRAME_SIZE,
+    PROTOCOL_VERSION,
+    FrameBuffer,
+    ProtocolError,
+    auth_success_ack,
+    encode_channel_text,
+    encode_frame,
+    encode_header,
+    is_channel_name,
+    offer_nickname,
+    parse_channel_text,
+    parse_nickname,
+)
+
+
+def frames_of(buffer):
+    frames = []
+    while True:
+        frame = buffer.next_frame()
+        if frame is None:
+            return frames
+        frames.append((frame[0], bytes(frame[1])))
+
+
+class FrameBufferTest(unittest.TestCase):
+    def test_frames_fed_at_once(self):
+        buffer = FrameBuffer(64)
+        buffer.feed(encode_frame(FRAME_TEXT, b"hello") + encode_frame(FRAME_COMMAND, b"GET_FILE_LIST"))
+        self.assertEqual(frames_of(buffer), [(FRAME_TEXT, b"hello"), (FRAME_COMMAND, b"GET_FILE_LIST")])
+
+    def test_frames_fed_byte_by_byte(self):
+        buffer = FrameBuffer(16)
+        stream = encode_frame(FRAME_TEXT, b"a" * 40) + encode_frame(FRAME_DATA, b"")
+        frames = []
+        for index in range(len(stream)):
+            buffer.feed(stream[index:index + 1])
+            frames.extend(frames_of(buffer))
+        self.assertEqual(frames, [(FRAME_TEXT, b"a" * 40), (FRAME_DATA, b"")])
+
+    def test_payload_larger_than_buffer(self):
+        buffer = FrameBuffer(32)
+        payload = bytes(range(256)) * 100
+        buffer.feed(encode_frame(FRAME_DATA, payload))
+        self.assertEqual(frames_of(buffer), [(FRAME_DATA, payload)])
+
+    def test_recv_into_writable(self):
+        buffer = FrameBuffer(32)
+        stream = encode_frame(FRAME_TEXT, b"x" * 20) * 3
+        received = []
+        while stream:
+            space = buffer.writable()
+            count = min(len(space), 7, len(stream))
+            space[:count] = stream[:count]
+            buffer.advance(count)
+            stream = stream[count:]
+            received.extend(frames_of(buffer))
+        self.assertEqual(received, [(FRAME_TEXT, b"x" * 20)] * 3)
+
+    def test_wrong_version(self):
+        buffer = FrameBuffer()
+        buffer.feed(HEADER.pack(PROTOCOL_VERSION + 1, FRAME_TEXT, 0))
+        with self.assertRaises(ProtocolError):
+            buffer.next_frame()
+
+    def test_oversized_frame(self):
+        buffer = FrameBuffer()
+        buffer.feed(encode_header(FRAME_DATA, MAX_FRAME_SIZE + 1))
+        with self.assertRaises(ProtocolError):
+            buffer.next_frame()
+
+
+class HandshakeTest(unittest.TestCase):
+    def test_nickname_offer(self):
+        self.assertEqual(parse_nickname(offer_nickname("alice")), ("alice", PROTOCOL_VERSION))
+
+    def test_legacy_nickname(self):
+        self.assertEqual(parse_nickname("alice"), ("alice", None))
+
+    def test_auth_success_ack(self):
+        self.assertTrue(auth_success_ack(PROTOCOL_VERSION).startswith(b"AUTH_SUCCESS"))
+
+
+class ChannelTextTest(unittest.TestCase):
+    def test_default_channel_is_bare(self):
+        self.assertEqual(encode_channel_text(DEFAULT_CHANNEL, b"bob: hi"), b"bob: hi")
+        self.assertEqual(parse_channel_text(b"bob: hi"), (DEFAULT_CHANNEL, b"bob: hi"))
+
+    def test_round_trip(self):
+        payload = encode_channel_text("dev-ops", "bob: 你好".encode("utf-8"))
+        self.assertEqual(parse_channel_text(payload), ("dev-ops", "bob: 你好".encode("utf-8")))
+
+    def test_channel_names(self):
+        self.assertTrue(is_channel_name("general"))
+        self.assertTrue(is_channel_name("频道_1"))
+        self.assertFalse(is_channel_name(""))
+        self.assertFalse(is_channel_name("a b"))
+        self.assertFalse(is_channel_name("x" * 33))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,65 @@
+import unittest
+
+from session_registry import SessionRegistry
+
+
+class SessionRegistryTest(unittest.TestCase):
+    def setUp(self):
+        self.registry = SessionRegistry()
+
+    def test_add_find_remove(self):
+        alice = self.registry.add("conn-a", "alice", "general")
+        other_alice = self.registry.add("conn-a2", "alice")
+        self.assertEqual(len(self.registry), 2)
+        self.assertIn("conn-a", self.registry)
+        self.assertIs(self.registry.get("conn-a"), alice)
+        self.assertIs(self.registry.get_by_id(alice.id), alice)
+        self.assertEqual(self.registry.find("alice"), (alice, other_alice))
+        self.assertEqual(self.registry.nickname_counts(), {"alice": 2})
+        self.assertIs(self.registry.remove("conn-a"), alice)
+        self.assertIsNone(self.registry.remove("conn-a"))
+        self.assertEqual(self.registry.find("alice"), (other_alice,))
+        self.registry.remove("conn-a2")
+        self.assertEqual(self.registry.find("alice"), ())
+        self.assertEqual(self.registry.nickname_counts(), {})
+
+    def test_connections_snapshot_is_not_modified(self):
+        self.registry.add("conn-a", "alice")
+        snapshot = self.registry.connections()
+        self.registry.add("conn-b", "bob")
+        self.assertEqual(snapshot, ("conn-a",))
+        self.assertEqual(set(self.registry.connections()), {"conn-a", "conn-b"})
+
+    def test_channels(self):
+        alice = self.registry.add("conn-a", "alice", "general")
+        self.registry.add("conn-b", "bob", "general")
+        self.assertTrue(self.registry.join("conn-a", "dev"))
+        self.assertFalse(self.registry.join("conn-a", "dev"))
+        self.assertFalse(self.registry.join("unknown", "dev"))
+        self.assertEqual(self.registry.members("dev"), ("conn-a",))
+        self.assertEqual(self.registry.channel_sizes(), {"general": 2, "dev": 1})
+        alice.channel = "dev"
+        self.assertTrue(self.registry.part("conn-a", "dev"))
+        self.assertIsNone(alice.channel)
+        self.assertFalse(self.registry.part("conn-a", "dev"))
+        self.assertEqual(self.registry.members("dev"), ())
+        self.assertNotIn("dev", self.registry.channel_sizes())
+
+    def test_remove_leaves_channels(self):
+        alice = self.registry.add("conn-a", "alice", "general")
+        self.registry.join("conn-a", "dev")
+        self.registry.remove("conn-a")
+        self.assertEqual(self.registry.members("general"), ())
+        self.assertEqual(self.registry.members("dev"), ())
+        self.assertEqual(alice.channels, {"general", "dev"})  # Kept, to notify those channels
+
+    def test_describe(self):
+        self.registry.add("conn-a", "alice", "general")
+        (entry,) = self.registry.describe()
+        self.assertEqual(entry["nick"], "alice")
+        self.assertEqual(entry["channels"], ["general"])
+        self.assertEqual(entry["bytes_sent"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
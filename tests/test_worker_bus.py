@@ -0,0 +1,84 @@
+import shutil
+import tempfile
+import time
+import unittest
+
+import worker_bus
+from worker_bus import WorkerBus
+
+
+def receive_for(bus, seconds):
+    """Events reaching bus within seconds, read as they arrive"""
+    events = []
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        events.extend(bus.receive_pending())
+        time.sleep(0.005)
+    return events
+
+
+class WorkerBusTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="bus_test_")
+        self.sender = WorkerBus(self.directory, 0, 2)
+        self.receiver = WorkerBus(self.directory, 1, 2)
+
+    def tearDown(self):
+        self.sender.close()
+        self.receiver.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_events_arrive_in_order(self):
+        for index in range(20):
+            self.sender.publish("chat", {"index": index}, b"body")
+        events = receive_for(self.receiver, 0.5)
+        self.assertEqual([payload["index"] for _, payload, _ in events], list(range(20)))
+        self.assertEqual(events[0][2], b"body")
+
+    def test_publish_does_not_wait_for_a_full_inbox(self):
+        started = time.monotonic()
+        for index in range(200):
+            self.sender.publish("chat", {"index": index}, b"x" * 1000, droppable=True)
+            self.sender.publish("file_added", {"index": index})
+        self.assertLess(time.monotonic() - started, 0.2)
+
+    def test_full_inbox_drops_droppable_events_only(self):
+        for index in range(200):
+            self.sender.publish("chat", {"index": index}, droppable=True)
+        for index in range(50):
+            self.sender.publish("file_added", {"index": index})
+        time.sleep(0.3)  # Nobody reads the inbox meanwhile
+        events = receive_for(self.receiver, 1.0)
+        chats = [payload["index"] for kind, payload, _ in events if kind == "chat"]
+        files = [payload["index"] for kind, payload, _ in events if kind == "file_added"]
+        self.assertLess(len(chats), 200)
+        self.assertEqual(self.sender.dropped, 200 - len(chats))
+        self.assertEqual(chats, sorted(chats))
+        self.assertEqual(files, list(range(50)))
+
+    def test_undeliverable_event_is_dropped_after_timeout(self):
+        original = worker_bus.SEND_TIMEOUT
+        worker_bus.SEND_TIMEOUT = 0.1
+        try:
+            for index in range(100):
+                self.sender.publish("file_added", {"index": index})
+            deadline = time.monotonic() + 5
+            while not self.sender.dropped and time.monotonic() < deadline:
+                time.sleep(0.05)
+        finally:
+            worker_bus.SEND_TIMEOUT = original
+        self.assertGreater(self.sender.dropped, 0)
+
+    def test_oversized_event_is_refused(self):
+        self.assertFalse(self.sender.publish("chat", None, b"x" * (worker_bus.MAX_DATAGRAM + 1)))
+        self.assertEqual(self.sender.dropped, 1)
+
+    def test_missing_peer_is_skipped(self):
+        self.receiver.close()
+        self.assertTrue(self.sender.publish("file_added", {}))
+        time.sleep(0.1)
+        self.assertEqual(self.sender.dropped, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
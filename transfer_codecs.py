@@ -0,0 +1,156 @@
+"""Compression codecs for file transfers.
+
+Files travel compressed with one of:
+
+    none   stored bytes as they are, for content that does not compress
+    gzip   zlib's gzip container, the only codec legacy clients understand
+    bz2    bz2 streams, slower but smaller for text
+    lzma   xz streams, slowest and usually smallest
+
+A framed client lists the codecs it can decode with CODECS:<names> and
+the server answers with the ones both sides support. Each file is then
+sent with a codec picked for it: already-compressed media is recognised
+by its extension or by how little a sample of its first blocks shrinks,
+and goes out uncompressed instead of burning CPU to grow slightly.
+
+Every compressor here is deterministic, so the same file compresses to
+the same bytes on every attempt of a resumable upload.
+"""
+import bz2
+import lzma
+import os
+import zlib
+
+CODECS = ("none", "gzip", "bz2", "lzma")
+DEFAULT_CODEC = "gzip"
+SAMPLE_SIZE = 256 * 1024
+# A sample that keeps more than this share of its size is not worth compressing
+INCOMPRESSIBLE_RATIO = 0.95
+INCOMPRESSIBLE_EXTENSIONS = frozenset(
+    (
+        ".7z", ".aac", ".apk", ".avi", ".br", ".bz2", ".docx", ".flac", ".gif", ".gz",
+        ".heic", ".jar", ".jpeg", ".jpg", ".m4a", ".mkv", ".mov", ".mp3", ".mp4", ".ogg",
+        ".png", ".pptx", ".rar", ".tgz", ".webm", ".webp", ".xlsx", ".xz", ".zip", ".zst",
+    )
+)
+# Suffixes of compressed renditions in the download cache
+SUFFIXES = {"none": "", "gzip": ".gz", "bz2": ".bz2", "lzma": ".xz"}
+
+
+class _Passthrough:
+    """Compressor of the "none" codec"""
+
+    def compress(self, data):
+        return bytes(data)
+
+    def flush(self):
+        return b""
+
+
+class StreamDecompressor:
+    """Incremental decompressor with output bounded per call, whatever the codec"""
+
+    def __init__(self, codec):
+        if codec not in CODECS:
+            raise ValueError(f"unknown codec: {codec!r}")
+        self.codec = codec
+        if codec == "gzip":
+            self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif codec == "bz2":
+            self._decompressor = bz2.BZ2Decompressor()
+        elif codec == "lzma":
+            self._decompressor = lzma.LZMADecompressor()
+        else:
+            self._decompressor = None
+
+    @property
+    def eof(self):
+        return self._decompressor is None or self._decompressor.eof
+
+    def decompress(self, data, max_length):
+        """Yield the output for data in blocks of at most max_length bytes"""
+        if self._decompressor is None:
+            for offset in range(0, len(data), max_length):
+                yield bytes(data[offset:offset + max_length])
+        elif self.codec == "gzip":
+            yield self._decompressor.decompress(data, max_length)
+            while self._decompressor.unconsumed_tail:
+                yield self._decompressor.decompress(self._decompressor.unconsumed_tail, max_length)
+        else:
+            yield self._decompressor.decompress(data, max_length)
+            while not self._decompressor.needs_input and not self._decompressor.eof:
+                yield self._decompressor.decompress(b"", max_length)
+
+    def flush(self):
+        if self.codec == "gzip":
+            return self._decompressor.flush()
+        return b""
+
+
+def compressor(codec, level=6):
+    """Streaming compressor with compress() and flush() for a codec"""
+    if codec == "gzip":
+        return zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    if codec == "bz2":
+        return bz2.BZ2Compressor(min(max(level, 1), 9))
+    if codec == "lzma":
+        return lzma.LZMACompressor(preset=min(max(level, 0), 9))
+    if codec == "none":
+        return _Passthrough()
+    raise ValueError(f"unknown codec: {codec!r}")
+
+
+def compress(codec, data, level=6):
+    stream = compressor(codec, level)
+    return stream.compress(data) + stream.flush()
+
+
+def decompress(codec, data):
+    if codec == "gzip":
+        return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+    if codec == "bz2":
+        return bz2.decompress(data)
+    if codec == "lzma":
+        return lzma.decompress(data)
+    if codec == "none":
+        return bytes(data)
+    raise ValueError(f"unknown codec: {codec!r}")
+
+
+def parse_codecs(names):
+    """Known codecs from a comma separated list, in the order given"""
+    return tuple(name for name in names.split(",") if name in CODECS)
+
+
+def looks_incompressible(sample):
+    """True if a fast compression pass barely shrinks the sample"""
+    if not sample:
+        return False
+    return len(zlib.compress(sample, 1)) > len(sample) * INCOMPRESSIBLE_RATIO
+
+
+def choose_codec(filename, sample, preferred=DEFAULT_CODEC, accepted=CODECS):
+    """Codec for one file: none for media that does not compress, otherwise preferred.
+
+    accepted lists what the receiving side can decode; gzip is assumed to
+    be understood by everyone.
+    """
+    if "none" in accepted:
+        extension = os.path.splitext(filename)[1].lower()
+        if extension in INCOMPRESSIBLE_EXTENSIONS or looks_incompressible(sample):
+            return "none"
+    if preferred in accepted:
+        return preferred
+    return DEFAULT_CODEC
+
+
+def read_sample(path):
+    with open(path, "rb") as f:
+        return f.read(SAMPLE_SIZE)
+
+
+def compression_ratio(size, compressed_size):
+    """Compressed size as a share of the original size, rounded for metadata"""
+    if not size:
+        return 1.0
+    return round(compressed_size / size, 4)
@@ -0,0 +1,160 @@
+"""Message bus between the worker processes of one server.
+
+With server.workers above 1 the server forks that many processes, each
+accepting on the same port through SO_REUSEPORT. Every worker binds a Unix
+datagram socket in a directory created by the parent, and an event
+published by one worker is sent to the sockets of all the others: chat
+lines, join and leave notices, catalog changes and parallel transfer
+grants. Each datagram is a JSON header line followed by a raw body.
+
+publish() never blocks: it hands the datagram to one sender thread per
+peer, so a worker whose inbox is full cannot stall the event loop or
+handler thread that published, nor delivery to the other peers. Droppable
+events (chat) are dropped when the peer's inbox is full, just like
+broadcasts to a slow client; the others are retried for up to
+SEND_TIMEOUT seconds and then dropped and counted.
+"""
+import json
+import os
+import socket
+import threading
+import time
+from collections import deque
+
+SEND_TIMEOUT = 1.0
+RETRY_INTERVAL = 0.005
+MAX_PENDING = 10000  # Datagrams waiting for one peer; droppable ones are refused past it
+SOCKET_BUFFER = 4 * 1024 * 1024
+MAX_DATAGRAM = 4 * 1024 * 1024 - 1024
+
+
+def worker_socket_path(directory, worker_id):
+    return os.path.join(directory, f"worker-{worker_id}.sock")
+
+
+class WorkerBus:
+    """One worker's end of the bus: an inbox socket and a socket to send with"""
+
+    def __init__(self, directory, worker_id, worker_count):
+        self.directory = directory
+        self.worker_id = worker_id
+        self.peers = [
+            worker_socket_path(directory, peer) for peer in range(worker_count) if peer != worker_id
+        ]
+        self.dropped = 0
+        self.lock = threading.Lock()
+        self.closed = False
+        self.inbox = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.inbox.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER)
+        path = worker_socket_path(directory, worker_id)
+        if os.path.exists(path):
+            os.remove(path)
+        self.inbox.bind(path)
+        self.outbox = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.outbox.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER)
+        self.outbox.setblocking(False)
+        self.senders = [PeerSender(self, peer) for peer in self.peers]
+
+    def fileno(self):
+        return self.inbox.fileno()
+
+    def publish(self, kind, payload=None, body=b"", droppable=False):
+        """Queue an event for every other worker; returns False if it was dropped right away"""
+        header = json.dumps({"kind": kind, "origin": self.worker_id, "payload": payload})
+        datagram = header.encode("utf-8") + b"\n" + bytes(body)
+        if len(datagram) > MAX_DATAGRAM:
+            self._count_dropped(len(self.peers))
+            return False
+        queued = True
+        for sender in self.senders:
+            queued = sender.put(datagram, droppable) and queued
+        return queued
+
+    def send_now(self, peer, datagram):
+        """One non-blocking send; True once sent or once the peer is known to be gone"""
+        try:
+            self.outbox.sendto(datagram, peer)
+        except (FileNotFoundError, ConnectionRefusedError):
+            pass  # Worker not started yet or already gone
+        except BlockingIOError:
+            return False
+        return True
+
+    def _count_dropped(self, count):
+        with self.lock:
+            self.dropped += count
+
+    @staticmethod
+    def decode(datagram):
+        header, _, body = datagram.partition(b"\n")
+        event = json.loads(header)
+        return event["kind"], event["payload"], body
+
+    def receive(self):
+        """Block until the next event and return (kind, payload, body)"""
+        return self.decode(self.inbox.recv(MAX_DATAGRAM))
+
+    def receive_pending(self):
+        """Every event already waiting in the inbox, without blocking"""
+        events = []
+        while True:
+            try:
+                datagram = self.inbox.recv(MAX_DATAGRAM, socket.MSG_DONTWAIT)
+            except BlockingIOError:
+                return events
+            events.append(self.decode(datagram))
+
+    def close(self):
+        self.closed = True
+        for sender in self.senders:
+            sender.wake()
+        self.inbox.close()
+        self.outbox.close()
+
+
+class PeerSender:
+    """Thread sending one worker's queued datagrams to one peer, in order"""
+
+    def __init__(self, bus, peer):
+        self.bus = bus
+        self.peer = peer
+        self.pending = deque()  # (datagram, droppable)
+        self.ready = threading.Condition()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def put(self, datagram, droppable):
+        with self.ready:
+            if droppable and len(self.pending) >= MAX_PENDING:
+                self.bus._count_dropped(1)
+                return False
+            self.pending.append((datagram, droppable))
+            self.ready.notify()
+        return True
+
+    def wake(self):
+        with self.ready:
+            self.ready.notify()
+
+    def _run(self):
+        while True:
+            with self.ready:
+                while not self.pending and not self.bus.closed:
+                    self.ready.wait()
+                if self.bus.closed:
+                    return
+                datagram, droppable = self.pending.popleft()
+            try:
+                self._send(datagram, droppable)
+            except OSError:
+                if self.bus.closed:
+                    return
+                self.bus._count_dropped(1)
+
+    def _send(self, datagram, droppable):
+        deadline = time.monotonic() + SEND_TIMEOUT
+        while not self.bus.send_now(self.peer, datagram):
+            if droppable or time.monotonic() >= deadline:
+                self.bus._count_dropped(1)
+                return
+            time.sleep(RETRY_INTERVAL)